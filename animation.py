@@ -0,0 +1,107 @@
+"""Renders sequences of views of one world to numbered PNG frames
+
+    views = animation.get_turntable_views((0, 0, 0), 12, 3, 90)
+    animation.render_frames(world, views, '/tmp/frames', 320, 240, 7, 7, processes=8)
+
+The world's BVH and the constants its objects cache are built once and
+shared by every frame. With processes > 1, a pool of workers is handed the
+world once and each renders whole frames, writing them itself.
+"""
+import multiprocessing
+import os
+import sys
+import numpy
+import parallel
+import raycast
+
+def get_turntable_views(target, radius, height, num_frames, distance=4, up=(0,1,0)):
+    """Returns num_frames views from cameras circling target at radius,
+    height above it, each looking at target
+
+    >>> views = get_turntable_views((0,0,0), 10, 2, 2)
+    >>> [numpy.round(v.camera_position).tolist() for v in views]
+    [[0.0, 2.0, -10.0], [0.0, 2.0, 10.0]]
+    """
+    views = []
+    for angle in numpy.linspace(0, 2 * numpy.pi, num_frames, endpoint=False):
+        camera_position = numpy.add(target, (radius * numpy.sin(angle), height, -radius * numpy.cos(angle)))
+        views.append(raycast.View.from_camera(camera_position, target, distance, up))
+    return views
+
+def get_camera_path(keyframes, num_frames):
+    """Returns num_frames views moving at a steady pace from keyframe to
+    keyframe, each camera looking at the center of a view plane moving the
+    same way
+
+    >>> path = get_camera_path([raycast.View.from_camera((0,0,-10), (0,0,0)),
+    ...         raycast.View.from_camera((0,0,-20), (0,0,0))], 3)
+    >>> [v.camera_position.tolist() for v in path]
+    [[0.0, 0.0, -10.0], [0.0, 0.0, -15.0], [0.0, 0.0, -20.0]]
+    """
+    cameras = numpy.array([view.camera_position for view in keyframes])
+    centers = numpy.array([view.screen_width_ray[0] for view in keyframes])
+    ups = numpy.array([view.unit_h_vec for view in keyframes])
+    distances = numpy.array([abs(view.camera_distance) for view in keyframes])
+    keyframe_times = numpy.arange(len(keyframes))
+    times = numpy.linspace(0, len(keyframes) - 1, num_frames)
+    def interpolate(values):
+        return numpy.array([numpy.interp(times, keyframe_times, column) for column in values.T]).T
+    return [raycast.View.from_camera(camera, center, distance, up) for camera, center, distance, up in
+            zip(interpolate(cameras), interpolate(centers), numpy.interp(times, keyframe_times, distances),
+                interpolate(ups))]
+
+def render_frame(world, view, path, w_samples, h_samples, viewscreen_width, viewscreen_height,
+        batch=True, settings=None, stats=None):
+    values = world.render_view_values(view, w_samples, h_samples, viewscreen_width, viewscreen_height,
+            batch, settings=settings, stats=stats)
+    raycast.save_image(raycast.get_image(values), path)
+    return path, stats
+
+def render_frame_in_worker(args):
+    return render_frame(parallel.world, *args)
+
+def render_frames(world, views, directory, w_samples, h_samples, viewscreen_width, viewscreen_height,
+        batch=True, processes=None, settings=None, stats=None, filename='frame%04d.png'):
+    """Renders each of views to a PNG in directory named by filename with
+    its frame number, returning the paths of the frames
+
+    processes > 1 renders whole frames in that many worker processes,
+    each counting on its own RenderStats which are added to stats.
+
+    >>> import tempfile
+    >>> w = raycast.World()
+    >>> w.add_object(raycast.Sphere((0,0,0), 1))
+    >>> w.add_light(raycast.Light((0, 10, 0)))
+    >>> directory = tempfile.mkdtemp()
+    >>> paths = render_frames(w, get_turntable_views((0,0,0), 5, 1, 3), directory, 8, 6, 4, 3)
+    >>> [os.path.basename(path) for path in paths]
+    ['frame0000.png', 'frame0001.png', 'frame0002.png']
+    >>> paths == render_frames(w, get_turntable_views((0,0,0), 5, 1, 3), directory, 8, 6, 4, 3, processes=2)
+    True
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    world.get_bvh() # build once here rather than for every frame or in every worker
+
+    tasks = [(view, os.path.join(directory, filename % i), w_samples, h_samples, viewscreen_width,
+                viewscreen_height, batch, settings, type(stats)() if stats is not None else None)
+            for i, view in enumerate(views)]
+    if processes and processes > 1:
+        pool = multiprocessing.Pool(processes, parallel.init_worker, (world,))
+        try:
+            finished = list(report_frames(pool.imap(render_frame_in_worker, tasks), len(tasks), stats))
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        return finished
+    return list(report_frames((render_frame(world, *task) for task in tasks), len(tasks), stats))
+
+def report_frames(finished, num_frames, stats=None):
+    """Yields the path of each finished frame, writing progress to stderr
+    and adding the frame's stats to stats"""
+    for i, (path, frame_stats) in enumerate(finished):
+        if stats is not None:
+            stats.add(frame_stats)
+        sys.stderr.write('frame '+str(i + 1)+'/'+str(num_frames)+'\n')
+        yield path
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+"""Times renders of a fixed set of seeded scenes and writes the results as JSON
+
+    python benchmark.py --sizes 64x48,128x96 --output before.json
+    python benchmark.py --output after.json --compare before.json
+
+Every case runs in a fresh process, so peak_rss_kb is the high water mark
+of that one render rather than of everything run before it. With
+--processes, peak_worker_rss_kb is the largest of the render's worker
+processes. Each result keeps the RenderStats of its fastest run under
+'stats': rays traced at each depth, intersection tests by object type and
+seconds spent in each stage.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+import traceback
+import numpy
+import demo
+import packed
+from raycast import World, Sphere, Light, View, Checkerboard, RenderStats
+
+def get_demo_world():
+    return demo.get_world(), (7, 7)
+
+def get_sphere_grid_world(n=8):
+    """n**3 spheres on a grid above a checkerboard"""
+    w = World()
+    for x in range(n):
+        for y in range(n):
+            for z in range(n):
+                w.add_object(Sphere((2.5*x - 1.25*n, 2.5*y - 1.25*n, 2.5*z), .8, .3))
+    w.add_object(Checkerboard(((0,-1.25*n-1,0), (0,-1.25*n-1,5)), ((0,-1.25*n-1,0), (5,-1.25*n-1,0))))
+    w.add_light(Light((100, 100, -50)))
+    w.add_view(View(((0,0,-12), (2,0,-12)), ((0,0,-12), (0,2,-12)), -4))
+    return w, (7, 7)
+
+def get_mirror_box_world():
+    """Nearly perfect mirror spheres inside four mirrored walls, so most
+    pixels bounce until the depth or weight limit"""
+    w = World()
+    for center in [(-2,0,4), (2,0,4), (0,2.5,6), (0,-2.5,2)]:
+        w.add_object(Sphere(center, 1.5, .95))
+    for origin, axis1, axis2 in [((-6,0,0), (0,0,3), (0,3,0)), ((6,0,0), (0,3,0), (0,0,3)),
+            ((0,-6,0), (3,0,0), (0,0,3)), ((0,6,0), (0,0,3), (3,0,0))]:
+        w.add_object(Checkerboard((origin, numpy.add(origin, axis1)), (origin, numpy.add(origin, axis2)), 1.8))
+    w.add_light(Light((0, 0, -10)))
+    w.add_view(View(((0,0,-3), (2,0,-3)), ((0,0,-3), (0,2,-3)), -4))
+    return w, (7, 7)
+
+def get_shadow_floor_world(n=300):
+    """n small spheres scattered over a large checkerboard lit by two lights"""
+    rs = numpy.random.RandomState(0)
+    w = World()
+    for x, z, radius in zip(rs.uniform(-40, 40, n), rs.uniform(0, 80, n), rs.uniform(.3, 1.5, n)):
+        w.add_object(Sphere((x, radius + rs.uniform(0, 3), z), radius, .2))
+    w.add_object(Checkerboard(((0,0,0), (0,0,2)), ((0,0,0), (2,0,0)), .3))
+    w.add_light(Light((60, 80, -20)))
+    w.add_light(Light((-60, 40, 100)))
+    w.add_view(View(((0,8,-20), (2,8,-20)), ((0,8,-20), (0,9.8,-19)), -4))
+    return w, (7, 5)
+
+def get_city_lights_world(n=2000):
+    """n dim lights, each reaching 12 units, scattered among spheres over a
+    checkerboard, so every point is in range of a few dozen lights"""
+    rs = numpy.random.RandomState(0)
+    w = World()
+    for x, z in zip(rs.uniform(-40, 40, 40), rs.uniform(0, 80, 40)):
+        w.add_object(Sphere((x, rs.uniform(-1, 3), z), 1, .3))
+    w.add_object(Checkerboard(((0,-2,0), (0,-2,5)), ((0,-2,0), (5,-2,0)), .2))
+    for position in zip(rs.uniform(-60, 60, n), rs.uniform(0, 6, n), rs.uniform(-10, 100, n)):
+        w.add_light(Light(position, .3, radius=12))
+    w.add_view(View.from_camera((0, 5, -20), (0, 0, 30)))
+    return w, (7, 7)
+
+SCENES = [
+        ('demo', get_demo_world),
+        ('sphere_grid', get_sphere_grid_world),
+        ('mirror_box', get_mirror_box_world),
+        ('shadow_floor', get_shadow_floor_world),
+        ('city_lights', get_city_lights_world),
+        ]
+
+ENGINES = ('scalar', 'batch', 'packed')
+
+def get_scene(name):
+    """Returns (world, (viewscreen width, viewscreen height)) for a scene
+    name, the same every time"""
+    random.seed(0)
+    return dict(SCENES)[name]()
+
+def run_case(case):
+    """Renders one case, returning its result dict; run in a fresh process
+
+    >>> result = run_case(get_cases(['demo'], ['batch'], ['render_view'], [(4, 3)])[0])
+    >>> result['primary_rays'], result['reflection_rays'] > 0, result['shadow_rays'] > 0
+    (12, True, True)
+    """
+    world, (viewscreen_width, viewscreen_height) = get_scene(case['scene'])
+    if case['engine'] == 'packed':
+        world = packed.PackedWorld.from_world(world)
+    view = world.views[0]
+    render = world.render_view if case['method'] == 'render_view' else world.render_ascii
+    batch = case['engine'] != 'scalar'
+
+    world.get_bvh()
+    runs = []
+    stderr = sys.stderr
+    sys.stderr = open(os.devnull, 'w')
+    try:
+        for _ in range(case['repeat']):
+            stats = RenderStats()
+            start = time.time()
+            render(view, case['width'], case['height'], viewscreen_width, viewscreen_height, batch, case['processes'],
+                    stats=stats)
+            runs.append((time.time() - start, stats))
+    finally:
+        sys.stderr.close()
+        sys.stderr = stderr
+
+    result = dict(case)
+    seconds, stats = min(runs, key=lambda run: run[0])
+    result['seconds'] = seconds
+    result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if case['processes'] and case['processes'] > 1:
+        result['peak_worker_rss_kb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    result['stats'] = stats.get_dict()
+    result['primary_rays'] = stats.primary_rays
+    result['reflection_rays'] = stats.reflection_rays
+    result['shadow_rays'] = stats.shadow_rays
+    result['rays_per_second'] = (stats.primary_rays + stats.reflection_rays + stats.shadow_rays) / seconds
+    result['pixels_per_second'] = case['width'] * case['height'] / seconds
+    return result
+
+def get_cases(scenes, engines, methods, sizes, processes=None, repeat=1):
+    """Returns a case dict for every combination
+
+    >>> [(c['scene'], c['width']) for c in get_cases(['demo'], ['batch'], ['render_view'], [(8, 6), (16, 12)])]
+    [('demo', 8), ('demo', 16)]
+    """
+    return [{'scene': scene, 'engine': engine, 'method': method, 'width': width, 'height': height,
+                'processes': processes, 'repeat': repeat}
+            for scene in scenes for engine in engines for method in methods for width, height in sizes]
+
+def get_case_key(result):
+    return (result['scene'], result['engine'], result['method'], result['width'], result['height'],
+            result['processes'])
+
+def get_git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                cwd=os.path.dirname(os.path.abspath(__file__)), stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def put_case_result(queue, case):
+    try:
+        queue.put(run_case(case))
+    except Exception:
+        queue.put(traceback.format_exc())
+
+def run_case_in_process(case):
+    """Returns run_case(case), run in a new process which may start a pool of its own"""
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=put_case_result, args=(queue, case))
+    process.start()
+    result = queue.get()
+    process.join()
+    if not isinstance(result, dict):
+        raise RuntimeError('Benchmark case '+repr(case)+' failed:\n'+result)
+    return result
+
+def run(cases):
+    """Runs each case in its own process, returning the report dict"""
+    results = []
+    for case in cases:
+        result = run_case_in_process(case)
+        sys.stderr.write('%(scene)s %(engine)s %(method)s %(width)dx%(height)d: %(seconds).3fs\n' % result)
+        results.append(result)
+    return {
+            'git_revision': get_git_revision(),
+            'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'platform': platform.platform(),
+            'cpu_count': multiprocessing.cpu_count(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'results': results,
+            }
+
+def compare(report, baseline):
+    """Returns lines comparing the times of report with those of the same
+    cases in baseline"""
+    baseline_results = dict((get_case_key(result), result) for result in baseline['results'])
+    lines = []
+    for result in report['results']:
+        old = baseline_results.get(get_case_key(result))
+        if old is None:
+            continue
+        lines.append('%-12s %-6s %-11s %4dx%-4d %8.3fs -> %8.3fs  %5.2fx faster' % (
+                result['scene'], result['engine'], result['method'], result['width'], result['height'],
+                old['seconds'], result['seconds'], old['seconds'] / result['seconds']))
+    return lines
+
+def parse_sizes(s):
+    """
+    >>> parse_sizes('64x48,128x96')
+    [(64, 48), (128, 96)]
+    """
+    return [tuple(int(n) for n in size.split('x')) for size in s.split(',')]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scenes', default=','.join(name for name, _ in SCENES),
+            help='comma separated scene names')
+    parser.add_argument('--engines', default='batch,packed',
+            help='comma separated engines from '+', '.join(ENGINES))
+    parser.add_argument('--methods', default='render_view,render_ascii')
+    parser.add_argument('--sizes', default='64x48,128x96,256x192', type=parse_sizes,
+            help='comma separated WIDTHxHEIGHT sample counts')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--repeat', type=int, default=1, help='runs of each case, the fastest is kept')
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--compare', help='earlier results to compare times with')
+    args = parser.parse_args(argv)
+    scenes = args.scenes.split(',')
+    engines = args.engines.split(',')
+    methods = args.methods.split(',')
+    for name, names, known in [('scene', scenes, dict(SCENES)), ('engine', engines, ENGINES),
+            ('method', methods, ('render_view', 'render_ascii'))]:
+        for unknown in set(names) - set(known):
+            parser.error('unknown '+name+' '+unknown)
+
+    cases = get_cases(scenes, engines, methods, args.sizes, args.processes, args.repeat)
+    report = run(cases)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            for line in compare(report, json.load(f)):
+                print line
+
+if __name__ == '__main__':
+    main()
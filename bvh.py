@@ -0,0 +1,431 @@
+"""Bounding volume hierarchy for finding the first object a ray hits
+
+Objects report an axis aligned box with get_bounds(); objects without one
+(infinite planes) are kept in a separate list and always tested.
+
+Single rays are passed around as lines, (origin, direction, length) tuples
+of floats from get_line, and hits on them are (projection along ray,
+object index, t) tuples, ordered so that the smaller tuple is the hit that
+should be rendered. The intersection point is origin + t*direction.
+
+Functions taking stats count the ray tests they do on it when it's given,
+see raycast.RenderStats
+"""
+import math
+import numpy
+
+MIN_PROJECTION = .0001 # intersections closer than this to a ray's origin are ignored
+
+def get_line(ray):
+    """Returns the origin, direction and length of a ray given as two
+    points, the first two as tuples of floats
+
+    >>> get_line(((0, 0, 1), numpy.array([0., 3, 5])))
+    ((0.0, 0.0, 1.0), (0.0, 3.0, 4.0), 5.0)
+    """
+    x1, y1, z1 = [float(x) for x in ray[0]]
+    x2, y2, z2 = [float(x) for x in ray[1]]
+    dx, dy, dz = x2 - x1, y2 - y1, z2 - z1
+    return (x1, y1, z1), (dx, dy, dz), math.sqrt(dx*dx + dy*dy + dz*dz)
+
+def get_nearest_hit(line, index, obj, best=None, stats=None):
+    """Returns whichever of best and obj's nearest intersection with line is closer
+
+    >>> class Wall(object):
+    ...     def get_ray_t(self, origin, direction, min_t=0.):
+    ...         return 2. if 2 > min_t else float('nan')
+    >>> get_nearest_hit(get_line(((0,0,0), (0,0,2))), 3, Wall())
+    (4.0, 3, 2.0)
+    >>> get_nearest_hit(get_line(((0,0,0), (0,0,2))), 3, Wall(), (1.0, 7, .5))
+    (1.0, 7, 0.5)
+    """
+    if stats is not None:
+        stats.count_tests(type(obj).__name__, 1)
+    origin, direction, length = line
+    t = obj.get_ray_t(origin, direction, MIN_PROJECTION / length)
+    proj = t * length
+    if not proj >= MIN_PROJECTION: # no intersection, or rounding in min_t
+        return best
+    if best is None or proj < best[0] or (proj == best[0] and index < best[1]):
+        return proj, index, t
+    return best
+
+def update_nearest_hits(index, obj, origins, directions, rays, best_projs, best_objects, best_points, stats=None,
+        best_parts=None):
+    """Batched get_nearest_hit for the rays at indices rays
+
+    best_projs, best_objects and best_points hold the nearest hit found so
+    far for every ray and are updated in place, as is best_parts, the part
+    of the object hit (see raycast.Solid.get_ray_hits), if it's given
+    """
+    if stats is not None:
+        stats.count_tests(type(obj).__name__, len(rays))
+    ray_origins = origins[rays]
+    ray_directions = directions[rays]
+    ts, parts = obj.get_ray_hits(ray_origins, ray_directions, stats)
+    projs = ts * numpy.sqrt(numpy.sum(ray_directions**2, axis=1))
+    projs[numpy.isnan(projs)] = -numpy.inf
+    for row, (t, proj) in enumerate(zip(ts, projs)):
+        current_projs = best_projs[rays]
+        closer = numpy.flatnonzero((proj >= MIN_PROJECTION) & ((proj < current_projs) |
+                ((proj == current_projs) & (index < best_objects[rays]))))
+        closer_rays = rays[closer]
+        best_projs[closer_rays] = proj[closer]
+        best_objects[closer_rays] = index
+        best_points[closer_rays] = ray_origins[closer] + t[closer, numpy.newaxis] * ray_directions[closer]
+        if best_parts is not None:
+            best_parts[closer_rays] = 0 if parts is None else parts[row, closer]
+
+def get_inverse_directions(directions):
+    """Returns 1/directions, with zero components treated as tiny so box
+    tests need no special cases for axis aligned rays"""
+    directions = numpy.where(directions == 0, 1e-30, directions)
+    return 1 / directions
+
+def get_inverse_direction(direction):
+    """get_inverse_directions for the direction of a single line"""
+    return tuple(1 / (d if d != 0 else 1e-30) for d in direction)
+
+def is_blocking(line, obj, max_proj, stats=None):
+    """Returns whether obj intersects line between its origin and max_proj along it"""
+    if stats is not None:
+        stats.count_tests(type(obj).__name__, 1)
+    origin, direction, length = line
+    return obj.get_ray_t(origin, direction, 0.) * length < max_proj
+
+def update_blocked_rays(index, obj, origins, directions, rays, max_projs, blocked, stats=None):
+    """Batched is_blocking for the rays at indices rays, setting blocked in place"""
+    if stats is not None:
+        stats.count_tests(type(obj).__name__, len(rays))
+    ray_directions = directions[rays]
+    ts = obj.get_ray_hits(origins[rays], ray_directions, stats)[0]
+    projs = ts * numpy.sqrt(numpy.sum(ray_directions**2, axis=1))
+    projs[numpy.isnan(projs)] = -numpy.inf
+    blocking = ((projs > 0) & (projs < max_projs[rays])).any(axis=0)
+    blocked[rays[blocking]] = True
+
+def get_box_entries(mins, maxs, origins, inverse_directions):
+    """Returns parametric distances at which rays enter and leave a box
+
+    A ray misses when the exit is before the entry or behind the origin
+
+    >>> near, far = get_box_entries(numpy.array([-1., -1, -1]), numpy.array([1., 1, 1]),
+    ...         numpy.array([[0., 0, -5], [3, 0, -5]]), get_inverse_directions(numpy.array([[0., 0, 1]]*2)))
+    >>> near.tolist(), far[0], far[1] < near[1]
+    ([4.0, 4.0], 6.0, True)
+    """
+    t1 = (mins - origins) * inverse_directions
+    t2 = (maxs - origins) * inverse_directions
+    near = numpy.minimum(t1, t2).max(axis=-1)
+    far = numpy.maximum(t1, t2).min(axis=-1)
+    return near, far
+
+def get_box_entry(bounds, origin, inverse_direction):
+    """get_box_entries for a single line, with the box given as a
+    (min x, min y, min z, max x, max y, max z) tuple, all in floats
+
+    >>> get_box_entry((-1., -1., -1., 1., 1., 1.), (0., 0., -5.), get_inverse_direction((0., 0., 1.)))
+    (4.0, 6.0)
+    """
+    x1, y1, z1, x2, y2, z2 = bounds
+    ox, oy, oz = origin
+    ix, iy, iz = inverse_direction
+    tx1, tx2 = (x1 - ox) * ix, (x2 - ox) * ix
+    ty1, ty2 = (y1 - oy) * iy, (y2 - oy) * iy
+    tz1, tz2 = (z1 - oz) * iz, (z2 - oz) * iz
+    if tx1 > tx2:
+        tx1, tx2 = tx2, tx1
+    if ty1 > ty2:
+        ty1, ty2 = ty2, ty1
+    if tz1 > tz2:
+        tz1, tz2 = tz2, tz1
+    return max(tx1, ty1, tz1), min(tx2, ty2, tz2)
+
+class BVH(object):
+    """Bounding volume hierarchy over a list of objects
+
+    Nodes are stored in flat arrays; leaves own the slice
+    indices[start:start+count] of object indices
+
+    >>> class Ball(object):
+    ...     def __init__(self, x): self.x = x
+    ...     def get_bounds(self): return (self.x - 1, self.x + 1)
+    >>> class Plane(object):
+    ...     def get_bounds(self): return None
+    >>> bvh = BVH([Ball(numpy.array([i, 0., 0])) for i in range(10)] + [Plane()], leaf_size=2)
+    >>> bvh.num_objects, bvh.unbounded, len(bvh.indices)
+    (11, [10], 10)
+    >>> bvh.node_count[0], sorted(bvh.indices.tolist()) == range(10)
+    (10, True)
+    """
+    def __init__(self, objects, leaf_size=1):
+        self.num_objects = len(objects)
+        self.unbounded = []
+        bounded = []
+        mins = []
+        maxs = []
+        for i, obj in enumerate(objects):
+            bounds = obj.get_bounds()
+            if bounds is None:
+                self.unbounded.append(i)
+            else:
+                bounded.append(i)
+                mins.append(bounds[0])
+                maxs.append(bounds[1])
+        self.build(numpy.array(bounded, dtype=int), mins, maxs, leaf_size)
+
+    @classmethod
+    def from_bounds(cls, mins, maxs, leaf_size=1):
+        """Returns a BVH over boxes given as (N, 3) arrays of corners, the
+        index of each box being its row
+
+        >>> bvh = BVH.from_bounds(numpy.zeros((5, 3)), numpy.ones((5, 3)), leaf_size=2)
+        >>> bvh.num_objects, bvh.unbounded, sorted(bvh.indices.tolist())
+        (5, [], [0, 1, 2, 3, 4])
+        """
+        bvh = cls.__new__(cls)
+        bvh.num_objects = len(mins)
+        bvh.unbounded = []
+        bvh.build(numpy.arange(len(mins)), mins, maxs, leaf_size)
+        return bvh
+
+    def build(self, bounded, mins, maxs, leaf_size):
+        """Builds the tree over the objects with indices bounded and corners mins and maxs"""
+        self.leaf_size = leaf_size
+        self.object_mins = numpy.array(mins, dtype=numpy.float_).reshape(-1, 3)
+        self.object_maxs = numpy.array(maxs, dtype=numpy.float_).reshape(-1, 3)
+
+        self.node_mins = []
+        self.node_maxs = []
+        self.node_left = []
+        self.node_right = []
+        self.node_axis = []
+        self.node_start = []
+        self.node_count = []
+        order = numpy.arange(len(bounded))
+        if len(bounded):
+            order = self.build_node(order, 0)
+        self.indices = bounded[order]
+        self.node_mins = numpy.array(self.node_mins).reshape(-1, 3)
+        self.node_maxs = numpy.array(self.node_maxs).reshape(-1, 3)
+        self.node_bounds = None
+
+    def add_node(self, mins, maxs, start, count):
+        self.node_mins.append(mins)
+        self.node_maxs.append(maxs)
+        self.node_left.append(-1)
+        self.node_right.append(-1)
+        self.node_axis.append(0)
+        self.node_start.append(start)
+        self.node_count.append(count)
+        return len(self.node_mins) - 1
+
+    def build_node(self, order, start):
+        """Adds a node for the bounded objects at positions order, and its
+        children, returning order rearranged so each leaf's objects are contiguous"""
+        mins = self.object_mins[order]
+        maxs = self.object_maxs[order]
+        node = self.add_node(mins.min(axis=0), maxs.max(axis=0), start, len(order))
+        if len(order) <= self.leaf_size:
+            return order
+
+        # median split along the axis the object centers are most spread out on
+        centers = (mins + maxs) / 2
+        axis = numpy.argmax(centers.max(axis=0) - centers.min(axis=0))
+        half = len(order) // 2
+        split = numpy.argpartition(centers[:, axis], half)
+        left = self.build_node(order[split[:half]], start)
+        self.node_left[node] = node + 1
+        self.node_right[node] = len(self.node_mins)
+        right = self.build_node(order[split[half:]], start + half)
+        self.node_axis[node] = axis
+        return numpy.concatenate([left, right])
+
+    def get_node_bounds(self):
+        """Returns a list of the box of every node as a tuple of floats for
+        get_box_entry, made the first time it's needed"""
+        if self.node_bounds is None:
+            self.node_bounds = [tuple(mins) + tuple(maxs)
+                    for mins, maxs in zip(self.node_mins.tolist(), self.node_maxs.tolist())]
+        return self.node_bounds
+
+    def get_children_in_order(self, node, direction):
+        """Returns the children of node, the one a ray travelling in direction
+        probably reaches first first"""
+        left, right = self.node_left[node], self.node_right[node]
+        if direction[self.node_axis[node]] < 0:
+            return right, left
+        return left, right
+
+    def get_first_ray_intersection(self, line, objects, best=None, stats=None):
+        """Returns the nearest hit of line on the bounded objects, or best if
+        that is closer
+
+        Nodes are visited nearest first and skipped once they start
+        beyond the closest hit found so far
+        """
+        if not len(self.indices):
+            return best
+        origin, direction, length = line
+        inverse_direction = get_inverse_direction(direction)
+        bounds = self.get_node_bounds()
+
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            if stats is not None:
+                stats.count_tests('box', 1)
+            near, far = get_box_entry(bounds[node], origin, inverse_direction)
+            if far < near or far < 0:
+                continue
+            if best is not None and near * length > best[0]:
+                continue
+            if self.node_left[node] == -1:
+                start = self.node_start[node]
+                for i in self.indices[start:start+self.node_count[node]].tolist():
+                    best = get_nearest_hit(line, i, objects[i], best, stats)
+            else:
+                first, second = self.get_children_in_order(node, direction)
+                stack.append(second)
+                stack.append(first)
+        return best
+
+    def update_first_ray_intersections(self, objects, origins, directions, best_projs, best_objects, best_points,
+            stats=None, packets=None, best_parts=None):
+        """Batched get_first_ray_intersection, updating the best_ arrays in place"""
+        def update_leaf(indices, rays):
+            for i in indices:
+                update_nearest_hits(i, objects[i], origins, directions, rays,
+                        best_projs, best_objects, best_points, stats, best_parts)
+        self.traverse_nearest(origins, directions, best_projs, update_leaf, stats, packets)
+
+    def traverse_nearest(self, origins, directions, best_projs, update_leaf, stats=None, packets=None):
+        """Calls update_leaf(indices, rays) with the object indices of each leaf
+        and the rays that might hit them before the closest hit so far
+
+        Rays travel down the tree together as packets, each node only passing
+        on the rays that enter its box before best_projs, which update_leaf
+        is expected to lower as it finds hits. packets is a list of arrays
+        of ray indices, see packets.get_packets, each traced down the whole
+        tree before the next; by default all the rays are one packet.
+        """
+        if not len(self.indices) or not len(origins):
+            return
+        lengths = numpy.sqrt(numpy.sum(directions**2, axis=1))
+        inverse_directions = get_inverse_directions(directions)
+
+        if packets is None:
+            packets = [numpy.arange(len(origins))]
+        stack = [(0, rays) for rays in reversed(packets)]
+        while stack:
+            node, rays = stack.pop()
+            if stats is not None:
+                stats.count_tests('box', len(rays))
+            near, far = get_box_entries(self.node_mins[node], self.node_maxs[node],
+                    origins[rays], inverse_directions[rays])
+            rays = rays[(far >= near) & (far >= 0) & (near * lengths[rays] <= best_projs[rays])]
+            if not len(rays):
+                continue
+            if self.node_left[node] == -1:
+                start = self.node_start[node]
+                update_leaf(self.indices[start:start+self.node_count[node]], rays)
+            else:
+                first, second = self.get_children_in_order(node, directions[rays[0]])
+                stack.append((second, rays))
+                stack.append((first, rays))
+
+    def is_ray_blocked(self, line, objects, max_proj, stats=None):
+        """Returns whether any bounded object intersects line before max_proj,
+        stopping at the first one found"""
+        if not len(self.indices):
+            return False
+        origin, direction, length = line
+        inverse_direction = get_inverse_direction(direction)
+        bounds = self.get_node_bounds()
+
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            if stats is not None:
+                stats.count_tests('box', 1)
+            near, far = get_box_entry(bounds[node], origin, inverse_direction)
+            if far < near or far < 0 or near * length > max_proj:
+                continue
+            if self.node_left[node] == -1:
+                start = self.node_start[node]
+                for i in self.indices[start:start+self.node_count[node]].tolist():
+                    if is_blocking(line, objects[i], max_proj, stats):
+                        return True
+            else:
+                stack.append(self.node_right[node])
+                stack.append(self.node_left[node])
+        return False
+
+    def update_blocked_rays(self, objects, origins, directions, max_projs, blocked, stats=None, packets=None):
+        """Batched is_ray_blocked, setting blocked in place"""
+        def update_leaf(indices, rays):
+            for i in indices:
+                update_blocked_rays(i, objects[i], origins, directions, rays[~blocked[rays]],
+                        max_projs, blocked, stats)
+        self.traverse_blocked(origins, directions, max_projs, blocked, update_leaf, stats, packets)
+
+    def traverse_blocked(self, origins, directions, max_projs, blocked, update_leaf, stats=None, packets=None):
+        """Calls update_leaf(indices, rays) with the object indices of each leaf
+        and the unblocked rays that might hit them before max_projs
+
+        Rays drop out of their packet as soon as update_leaf sets them
+        blocked; packets are as for traverse_nearest
+        """
+        if not len(self.indices) or not len(origins):
+            return
+        lengths = numpy.sqrt(numpy.sum(directions**2, axis=1))
+        inverse_directions = get_inverse_directions(directions)
+
+        if packets is None:
+            packets = [numpy.arange(len(origins))]
+        stack = [(0, rays[~blocked[rays]]) for rays in reversed(packets)]
+        while stack:
+            node, rays = stack.pop()
+            rays = rays[~blocked[rays]]
+            if stats is not None:
+                stats.count_tests('box', len(rays))
+            near, far = get_box_entries(self.node_mins[node], self.node_maxs[node],
+                    origins[rays], inverse_directions[rays])
+            rays = rays[(far >= near) & (far >= 0) & (near * lengths[rays] <= max_projs[rays])]
+            if not len(rays):
+                continue
+            if self.node_left[node] == -1:
+                start = self.node_start[node]
+                update_leaf(self.indices[start:start+self.node_count[node]], rays)
+            else:
+                stack.append((self.node_right[node], rays))
+                stack.append((self.node_left[node], rays))
+
+    def traverse_points(self, points, tolerances, update_leaf):
+        """Calls update_leaf(indices, inside) with the object indices of each
+        leaf and the indices of the points inside its box, grown by
+        tolerances, an (N,) array of distances
+
+        >>> bvh = BVH.from_bounds(numpy.array([[0., 0, 0], [2, 0, 0]]), numpy.array([[1., 1, 1], [3, 1, 1]]))
+        >>> found = []
+        >>> bvh.traverse_points(numpy.array([[.5, .5, .5], [2.5, 1, 1], [5, 0, 0]]), numpy.zeros(3),
+        ...         lambda indices, inside: found.extend(zip(inside.tolist(), indices.tolist())))
+        >>> sorted(found)
+        [(0, 0), (1, 1)]
+        """
+        if not len(self.indices) or not len(points):
+            return
+        stack = [(0, numpy.arange(len(points)))]
+        while stack:
+            node, inside = stack.pop()
+            grown_by = tolerances[inside, numpy.newaxis]
+            inside = inside[((points[inside] >= self.node_mins[node] - grown_by) &
+                    (points[inside] <= self.node_maxs[node] + grown_by)).all(axis=1)]
+            if not len(inside):
+                continue
+            if self.node_left[node] == -1:
+                start = self.node_start[node]
+                update_leaf(self.indices[start:start+self.node_count[node]], inside)
+            else:
+                stack.append((self.node_right[node], inside))
+                stack.append((self.node_left[node], inside))
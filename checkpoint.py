@@ -0,0 +1,139 @@
+"""Saves rows of a render to disk as they finish, so a restarted render
+can pick up where a killed one stopped
+
+A checkpoint directory holds
+  values.npy     memory mapped (h_samples, w_samples) array of rendered values,
+                 rows counted from the bottom of the image
+  done.npy       a flag for each row of values.npy, set once the row is saved
+  manifest.json  the scene hash and sample counts the rows belong to
+"""
+import hashlib
+import json
+import os
+import sys
+import numpy
+import parallel
+import raycast
+
+def update_hash(hash, values):
+    """Adds nested tuples and lists of numbers, strings and arrays to a
+    hashlib hash, the same way whatever process they were made in"""
+    if isinstance(values, numpy.ndarray):
+        hash.update(repr((values.dtype.str, values.shape)))
+        hash.update(numpy.ascontiguousarray(values).tostring())
+    elif isinstance(values, (tuple, list)):
+        hash.update('(%d' % len(values))
+        for value in values:
+            update_hash(hash, value)
+        hash.update(')')
+    else:
+        hash.update(repr(values))
+
+def get_scene_hash(world, view, w_samples, h_samples, viewscreen_width, viewscreen_height, settings=None):
+    """Returns a hex digest identifying everything that affects rendered values
+
+    Only what World.get_scene returns goes in, so the same scene built again
+    hashes the same, even with its spheres' random colors different.
+
+    >>> import random
+    >>> def get_hash(seed):
+    ...     random.seed(seed)
+    ...     w = raycast.World()
+    ...     w.add_object(raycast.Sphere((0,0,0), 1))
+    ...     w.add_light(raycast.Light((10, 10, -10)))
+    ...     return get_scene_hash(w, raycast.getTestView(), 4, 3, 6, 6)
+    >>> get_hash(0) == get_hash(1)
+    True
+    """
+    if settings is None:
+        settings = world.settings
+    scene = (world.get_scene(), (view.screen_width_ray, view.screen_height_ray, view.camera_distance),
+            w_samples, h_samples, viewscreen_width, viewscreen_height, sorted(vars(settings).items()))
+    hash = hashlib.sha1()
+    update_hash(hash, scene)
+    return hash.hexdigest()
+
+class Checkpoint(object):
+    """Rows of one render, saved in a directory
+
+    >>> import tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> c = Checkpoint(directory, {'scene_hash': 'abc', 'w_samples': 3, 'h_samples': 2})
+    >>> c.save_rows(1, numpy.ones((1, 3)))
+    >>> c = Checkpoint(directory, {'scene_hash': 'abc', 'w_samples': 3, 'h_samples': 2})
+    >>> c.done.tolist(), c.values[1].tolist()
+    ([0, 1], [1.0, 1.0, 1.0])
+    >>> Checkpoint(directory, {'scene_hash': 'def', 'w_samples': 3, 'h_samples': 2}).done.tolist()
+    [0, 0]
+    """
+    def __init__(self, directory, manifest):
+        self.directory = directory
+        self.manifest = manifest
+        shape = (manifest['h_samples'], manifest['w_samples'])
+        if self.read_manifest() == manifest:
+            self.values = numpy.lib.format.open_memmap(self.get_path('values.npy'), 'r+')
+            self.done = numpy.lib.format.open_memmap(self.get_path('done.npy'), 'r+')
+            return
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        elif os.path.exists(self.get_path('manifest.json')):
+            sys.stderr.write('Checkpoint in '+directory+' is for a different render, starting over\n')
+        self.values = numpy.lib.format.open_memmap(self.get_path('values.npy'), 'w+', numpy.float32, shape)
+        self.done = numpy.lib.format.open_memmap(self.get_path('done.npy'), 'w+', numpy.uint8, shape[:1])
+        self.done.flush()
+        with raycast.atomic_write(self.get_path('manifest.json')) as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+
+    def get_path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def read_manifest(self):
+        try:
+            with open(self.get_path('manifest.json')) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def save_rows(self, start_row, values):
+        """Saves values for rows from start_row, flagging them done only once
+        the values are on disk"""
+        self.values[start_row:start_row+len(values)] = values
+        self.values.flush()
+        self.done[start_row:start_row+len(values)] = 1
+        self.done.flush()
+
+    def get_bands_to_do(self, band_rows):
+        """Returns (start_row, end_row) bands covering the rows not done yet"""
+        return [(start, end) for start, end in parallel.get_bands(len(self.done), band_rows)
+                if not self.done[start:end].all()]
+
+def render_rows(world, view, w_samples, h_samples, viewscreen_width, viewscreen_height, directory,
+        batch=True, processes=None, settings=None, band_rows=None, stats=None):
+    """Returns the same values as world.render_rows for all rows of the view,
+    saving each band of rows to a checkpoint in directory as it finishes and
+    skipping the bands a previous run already saved there"""
+    manifest = {
+            'scene_hash': get_scene_hash(world, view, w_samples, h_samples,
+                viewscreen_width, viewscreen_height, settings),
+            'w_samples': w_samples,
+            'h_samples': h_samples,
+            'viewscreen_width': viewscreen_width,
+            'viewscreen_height': viewscreen_height,
+            }
+    checkpoint = Checkpoint(directory, manifest)
+    if band_rows is None:
+        band_rows = parallel.get_band_rows(h_samples, processes) if processes and processes > 1 else 16
+    bands = checkpoint.get_bands_to_do(band_rows)
+    sys.stderr.write(str(int(checkpoint.done.sum()))+'/'+str(h_samples)+' rows already rendered\n')
+
+    if processes and processes > 1:
+        finished = parallel.render_bands(world, view, w_samples, h_samples, viewscreen_width, viewscreen_height,
+                bands, batch, processes, settings, stats)
+    else:
+        finished = ((start_row, world.render_rows(view, w_samples, h_samples, viewscreen_width, viewscreen_height,
+                start_row, end_row, batch, settings, stats)) for start_row, end_row in bands)
+    for start_row, values in finished:
+        checkpoint.save_rows(start_row, values)
+        sys.stderr.write(str(int(checkpoint.done.sum()))+'/'+str(h_samples)+'\n')
+    return numpy.array(checkpoint.values)
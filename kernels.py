@@ -0,0 +1,209 @@
+"""Kernels for tracing a single ray, compiled with Numba when it's installed
+
+Scalar rendering follows one ray at a time down the recursive reflection
+path, where numpy's per call overhead on 3-vectors costs more than the
+arithmetic. These kernels take and return plain floats and tuples of floats
+instead, so the same source runs either as ordinary Python or compiled by
+numba.njit. Misses are nan rather than None so that both give the same
+types.
+
+The backend is chosen on import from the RAYCAST_KERNELS environment
+variable: "numba", "python", or by default numba if it can be imported and
+python if not. Compiled kernels are cached on disk next to this file (or
+in NUMBA_CACHE_DIR), so worker processes load them rather than compiling
+them again.
+
+Each kernel does the same arithmetic as the batched numpy version it
+stands in for, so scalar and batched renders stay the same. Running the
+doctests of this module and of raycast with RAYCAST_KERNELS=python and
+again with RAYCAST_KERNELS=numba checks both backends against them:
+
+>>> import numpy, vectormath
+>>> rs = numpy.random.RandomState(0)
+>>> origins, directions = rs.normal(size=(200, 3)) * 5, rs.normal(size=(200, 3))
+>>> ts = vectormath.get_rays_ts_with_sphere(origins, directions, numpy.array([.5, 0, 0]), .25, 9.)
+>>> with numpy.errstate(invalid='ignore'):
+...     expected = numpy.where(ts > 0, ts, numpy.inf).min(axis=0)
+>>> got = numpy.array([get_sphere_t(o[0], o[1], o[2], d[0], d[1], d[2], .5, 0., 0., .25, 9., 0.)
+...         for o, d in zip(origins.tolist(), directions.tolist())])
+>>> hit = ~numpy.isnan(got)
+>>> numpy.array_equal(hit, expected < numpy.inf), numpy.abs(got[hit] - expected[hit]).max()
+(True, 0.0)
+
+Compiled kernels can differ from Python in ways a few fixed values don't
+show, such as math.floor returning an int under numba and a float in
+Python 2, so with numba every kernel is also run on seeded random
+arguments and checked against its uncompiled python_kernels entry, the
+checkerboard exactly and the rest to within rounding:
+
+>>> def count_mismatches(name, calls=2000):
+...     kernel, python_kernel = globals()[name], python_kernels[name]
+...     rs = numpy.random.RandomState(0)
+...     mismatches = 0
+...     for args in (rs.normal(size=(calls, python_kernel.__code__.co_argcount)) * 5).tolist():
+...         got = numpy.array(kernel(*args), dtype=numpy.float_)
+...         expected = numpy.array(python_kernel(*args), dtype=numpy.float_)
+...         if name == 'get_checker_color':
+...             mismatches += not numpy.array_equal(got, expected)
+...         else:
+...             mismatches += not numpy.allclose(got, expected, rtol=1e-9, atol=0, equal_nan=True)
+...     return mismatches
+>>> [(name, count_mismatches(name)) for name in KERNELS if count_mismatches(name)]
+[]
+"""
+import math
+import os
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+BACKENDS = ('numba', 'python')
+NAN = float('nan')
+INF = float('inf')
+
+def get_sphere_t(ox, oy, oz, dx, dy, dz, cx, cy, cz, center_square, radius_square, min_t):
+    """Returns the parametric distance t at which the ray o + t*d first
+    crosses a sphere beyond min_t, or nan, as vectormath.get_rays_ts_with_sphere
+
+    >>> get_sphere_t(0., 0., 3., 0., 0., -1., 0., 0., 0., 0., 1., 0.)
+    2.0
+    >>> get_sphere_t(0., 0., 3., 0., 0., -1., 0., 0., 0., 0., 1., 2.5)
+    4.0
+    >>> get_sphere_t(0., 5., 3., 0., 0., -1., 0., 0., 0., 0., 1., 0.)
+    nan
+    """
+    a = dx*dx + dy*dy + dz*dz
+    b = 2*(dx*(ox - cx) + dy*(oy - cy) + dz*(oz - cz))
+    c = center_square + ox*ox + oy*oy + oz*oz - 2*(cx*ox + cy*oy + cz*oz) - radius_square
+    radicand = b*b - 4*a*c
+    if radicand < 0:
+        return NAN
+    q = (b + math.copysign(math.sqrt(radicand), b)) * -.5
+    if q == 0:
+        return NAN
+    near = q / a
+    far = c / q
+    if near > far:
+        near, far = far, near
+    if near > min_t:
+        return near
+    if far > min_t:
+        return far
+    return NAN
+
+def get_plane_t(ox, oy, oz, dx, dy, dz, nx, ny, nz, offset, min_t):
+    """Returns the parametric distance t at which the ray o + t*d crosses
+    the plane of points p with dot(p, n) == offset if it's beyond min_t,
+    or nan, as vectormath.get_rays_ts_with_plane
+
+    >>> get_plane_t(0., 0., -10., 0., 0., 5., 0., 0., 1., 0., 0.), get_plane_t(3., 3., 3., 1., 0., 0., 0., 0., 1., 0., 0.)
+    (2.0, nan)
+    """
+    speed = dx*nx + dy*ny + dz*nz
+    if speed == 0:
+        return NAN
+    t = (offset - (ox*nx + oy*ny + oz*nz)) / speed
+    if min_t < t < INF:
+        return t
+    return NAN
+
+def get_triangle_t(ox, oy, oz, dx, dy, dz, px, py, pz, e1x, e1y, e1z, e2x, e2y, e2z, min_t):
+    """Returns the parametric distance t at which the ray o + t*d crosses the
+    triangle with corner p and edges e1 and e2 from it if it's beyond min_t,
+    or nan, as vectormath.get_rays_ts_with_triangles
+
+    >>> get_triangle_t(.2, .2, -1., 0., 0., 1., 0., 0., 0., 1., 0., 0., 0., 1., 0., 0.)
+    1.0
+    >>> get_triangle_t(2., 2., -1., 0., 0., 1., 0., 0., 0., 1., 0., 0., 0., 1., 0., 0.)
+    nan
+    """
+    hx = dy*e2z - dz*e2y
+    hy = dz*e2x - dx*e2z
+    hz = dx*e2y - dy*e2x
+    determinant = e1x*hx + e1y*hy + e1z*hz
+    if determinant == 0:
+        return NAN
+    inverse = 1 / determinant
+    sx, sy, sz = ox - px, oy - py, oz - pz
+    u = (sx*hx + sy*hy + sz*hz) * inverse
+    if not 0 <= u <= 1:
+        return NAN
+    qx = sy*e1z - sz*e1y
+    qy = sz*e1x - sx*e1z
+    qz = sx*e1y - sy*e1x
+    v = (dx*qx + dy*qy + dz*qz) * inverse
+    if not (v >= 0 and u + v <= 1):
+        return NAN
+    t = (e2x*qx + e2y*qy + e2z*qz) * inverse
+    if t > min_t:
+        return t
+    return NAN
+
+def get_reflection(dx, dy, dz, nx, ny, nz):
+    """Returns the unit direction of a ray travelling along d reflected
+    across the unit normal n, as Solid.get_bounced_rays
+
+    >>> get_reflection(0., -1., -1., 0., 1., 0.)
+    (0.0, 0.7071067811865475, -0.7071067811865475)
+    """
+    length = math.sqrt(dx*dx + dy*dy + dz*dz)
+    ux, uy, uz = dx / length, dy / length, dz / length
+    dot = ux*nx + uy*ny + uz*nz
+    return ux - 2 * nx * dot, uy - 2 * ny * dot, uz - 2 * nz * dot
+
+def get_cos_theta(px, py, pz, nx, ny, nz, lx, ly, lz):
+    """Returns the cosine of the angle between the unit normal n at the point
+    p and the direction from p to a light at l, as World.render_light_values
+
+    >>> get_cos_theta(0., 0., 0., 0., 1., 0., 0., 2., 0.)
+    1.0
+    >>> get_cos_theta(0., 0., 0., 0., 0., -1., 0., 0., -10.), get_cos_theta(0., 0., 0., 1., 0., 0., 0., 0., -10.)
+    (1.0, 0.0)
+    """
+    vx, vy, vz = lx - px, ly - py, lz - pz
+    return (vx*nx + vy*ny + vz*nz) / math.sqrt(vx*vx + vy*vy + vz*vz)
+
+def get_shadow_origin(px, py, pz, nx, ny, nz, epsilon):
+    """Returns the point p moved off its surface along the unit normal n by
+    epsilon times its largest coordinate, at least epsilon, as
+    vectormath.get_ray_epsilons
+
+    >>> get_shadow_origin(0., -2000., 0., 0., 1., 0., 1e-6)
+    (0.0, -1999.998, 0.0)
+    """
+    distance = epsilon * max(1.0, max(abs(px), abs(py), abs(pz)))
+    return px + nx * distance, py + ny * distance, pz + nz * distance
+
+def get_checker_color(px, py, pz, ox, oy, oz, a1x, a1y, a1z, a2x, a2y, a2z, length1, length2):
+    """Returns 0. or 1. for the square of a checkerboard with origin o and
+    axes a1 and a2 that p lies in, as Checkerboard.get_colors
+
+    >>> [float(get_checker_color(x, 0., .5, 0., 0., 0., 0., 0., 2., 2., 0., 0., 2., 2.)) for x in (.5, 1.5)]
+    [0.0, 1.0]
+    """
+    x, y, z = px - ox, py - oy, pz - oz
+    r1mod = ((x*a1x + y*a1y + z*a1z) / length1) % length1
+    r2mod = ((x*a2x + y*a2y + z*a2z) / length2) % length2
+    return (math.floor(r1mod) + math.floor(r2mod)) % 2
+
+KERNELS = ('get_sphere_t', 'get_plane_t', 'get_triangle_t', 'get_reflection', 'get_cos_theta',
+        'get_shadow_origin', 'get_checker_color')
+python_kernels = dict((name, globals()[name]) for name in KERNELS) # uncompiled, whatever the backend
+
+def get_backend():
+    """Returns the backend RAYCAST_KERNELS asks for, or the best available"""
+    backend = os.environ.get('RAYCAST_KERNELS')
+    if backend is None:
+        return 'numba' if numba is not None else 'python'
+    if backend not in BACKENDS:
+        raise ValueError('Unknown RAYCAST_KERNELS backend '+repr(backend)+', expected one of '+', '.join(BACKENDS))
+    if backend == 'numba' and numba is None:
+        raise ImportError('RAYCAST_KERNELS is numba but numba is not installed')
+    return backend
+
+backend = get_backend()
+if backend == 'numba':
+    for name in KERNELS:
+        globals()[name] = numba.njit(cache=True, nogil=True)(python_kernels[name])
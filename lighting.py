@@ -0,0 +1,148 @@
+"""Finding the lights that reach points on surfaces, and sampling among them
+
+Lights with a radius fade to nothing at that distance, so a point only
+needs shadow rays to the lights whose spheres of radius it lies in. A
+LightIndex keeps a BVH over those spheres' boxes and finds the lights near
+a batch of points by walking it with bvh.BVH.traverse_points. Lights
+without a radius reach everywhere and are always considered.
+
+Each (point, light) pair found is given an estimate: the light the point
+would get if nothing were in the way, which is exactly what an unblocked
+shadow ray adds. With RenderSettings(light_samples=k), points with more
+than k pairs trace shadow rays to only k of their lights, drawn at random
+in proportion to those estimates and each weighted so that the expected
+value is the full sum. Points with k or fewer keep every pair, so scenes
+with few lights render exactly as without sampling.
+
+    w.add_light(raycast.Light((10, 3, 20), brightness=.8, radius=15))
+    w.settings = raycast.RenderSettings(light_samples=4)
+"""
+import numpy
+import bvh
+
+LEAF_SIZE = 8 # lights per BVH leaf
+BATCH_PAIRS = 2**20 # (point, light) pairs of lights without a radius worked out at once
+
+def get_attenuations(squared_distances, radii):
+    """Returns the fraction of a light's brightness reaching points at
+    squared_distances from it, falling smoothly from 1 to 0 at radii
+
+    Lights with an infinite radius don't fade.
+
+    >>> get_attenuations(numpy.array([0., 25., 100., 400.]), 10.).tolist()
+    [1.0, 0.5625, 0.0, 0.0]
+    >>> get_attenuations(numpy.array([1e6]), numpy.inf).tolist()
+    [1.0]
+    """
+    return numpy.maximum(0., 1. - squared_distances / numpy.square(radii))**2
+
+class LightIndex(object):
+    """The positions, brightnesses and radii of a list of lights in arrays,
+    with a BVH over the boxes of the lights that have a radius
+
+    >>> class Light(object):
+    ...     def __init__(self, position, radius=None):
+    ...         self.position, self.brightness, self.radius = numpy.array(position), 1, radius
+    >>> index = LightIndex([Light((0, 5, 0)), Light((0, 1, 0), 2), Light((9, 1, 0), 2)])
+    >>> index.unbounded.tolist(), index.bounded.tolist()
+    ([0], [1, 2])
+    >>> points = numpy.array([[0., 0, 0], [5, 0, 0]])
+    >>> pair_points, pair_lights, estimates = index.get_pairs(points, numpy.array([[0., 1, 0]] * 2))
+    >>> pair_points.tolist(), pair_lights.tolist(), estimates.round(3).tolist()
+    ([0, 0, 1], [0, 1, 0], [1.0, 0.562, 0.707])
+    """
+    def __init__(self, lights, leaf_size=LEAF_SIZE):
+        self.num_lights = len(lights)
+        self.positions = numpy.array([light.position for light in lights], dtype=numpy.float_).reshape(-1, 3)
+        self.brightnesses = numpy.array([light.brightness for light in lights], dtype=numpy.float_)
+        self.radii = numpy.array([numpy.inf if light.radius is None else light.radius for light in lights],
+                dtype=numpy.float_)
+        self.unbounded = numpy.flatnonzero(numpy.isinf(self.radii))
+        self.bounded = numpy.flatnonzero(~numpy.isinf(self.radii))
+        reach = self.radii[self.bounded, numpy.newaxis]
+        self.bvh = bvh.BVH.from_bounds(self.positions[self.bounded] - reach, self.positions[self.bounded] + reach,
+                leaf_size)
+
+    def get_pairs(self, points, unit_normals):
+        """Returns arrays of the point index, light index and estimate of
+        every pair of one of an (N, 3) array of points on surfaces facing
+        unit_normals and a light that could light it, sorted by point and
+        then light
+
+        Lights behind a point's surface or out of its range are left out.
+        """
+        pair_points = []
+        pair_lights = []
+        all_points = numpy.arange(len(points))
+        for light in self.unbounded:
+            pair_points.append(all_points)
+            pair_lights.append(numpy.repeat(light, len(points)))
+
+        def add_leaf(indices, inside):
+            pair_points.append(numpy.repeat(inside, len(indices)))
+            pair_lights.append(numpy.tile(self.bounded[indices], len(inside)))
+        self.bvh.traverse_points(points, numpy.zeros(len(points)), add_leaf)
+
+        if not pair_points:
+            return numpy.zeros(0, dtype=int), numpy.zeros(0, dtype=int), numpy.zeros(0)
+        pair_points = numpy.concatenate(pair_points)
+        pair_lights = numpy.concatenate(pair_lights)
+        light_vecs = self.positions[pair_lights] - points[pair_points]
+        squared_distances = numpy.sum(light_vecs**2, axis=1)
+        cos_thetas = numpy.sum(light_vecs * unit_normals[pair_points], axis=1) / numpy.sqrt(squared_distances)
+        estimates = (self.brightnesses[pair_lights] * get_attenuations(squared_distances, self.radii[pair_lights]) *
+                cos_thetas)
+        order = numpy.lexsort((pair_lights, pair_points))
+        order = order[estimates[order] > 0]
+        return pair_points[order], pair_lights[order], estimates[order]
+
+    def get_samples(self, points, unit_normals, samples=None, random=None):
+        """Returns arrays of the point index, light index and weight of each
+        shadow ray to trace from an (N, 3) array of points on surfaces facing
+        unit_normals, the light of a point being the sum of the weights of
+        its unblocked rays
+
+        With samples set, points with more than that many lights get that
+        many rays, to lights drawn from random in proportion to their
+        estimates; otherwise every pair of get_pairs is traced.
+
+        >>> class Light(object):
+        ...     def __init__(self, x):
+        ...         self.position, self.brightness, self.radius = numpy.array([x, 1., 0]), 1, 3
+        >>> index = LightIndex([Light(x) for x in range(-20, 21)])
+        >>> points, unit_normals = numpy.array([[0., 0, 0], [18, 0, 0]]), numpy.array([[0., 1, 0]] * 2)
+        >>> pair_points, pair_lights, estimates = index.get_pairs(points, unit_normals)
+        >>> numpy.bincount(pair_points).tolist()
+        [5, 5]
+        >>> pair_points, pair_lights, weights = index.get_samples(points, unit_normals, 2, numpy.random.RandomState(0))
+        >>> pair_points.tolist(), numpy.allclose(weights.sum(), estimates.sum())
+        ([0, 0, 1, 1], True)
+        """
+        pair_points, pair_lights, estimates = self.get_pairs(points, unit_normals)
+        if samples is None:
+            return pair_points, pair_lights, estimates
+        counts = numpy.bincount(pair_points, minlength=len(points))
+        sampled = numpy.flatnonzero(counts > samples)
+        if not len(sampled):
+            return pair_points, pair_lights, estimates
+        totals = numpy.bincount(pair_points, estimates, minlength=len(points))
+        starts = numpy.cumsum(counts) - counts
+        cumulative = numpy.cumsum(estimates)
+        befores = cumulative[starts[sampled]] - estimates[starts[sampled]]
+
+        # draw from each point's stretch of the cumulative sums of estimates
+        drawn_points = numpy.repeat(sampled, samples)
+        targets = numpy.repeat(befores, samples) + random.random_sample(len(drawn_points)) * totals[drawn_points]
+        drawn = numpy.searchsorted(cumulative, targets, side='right')
+        drawn = numpy.clip(drawn, starts[drawn_points], starts[drawn_points] + counts[drawn_points] - 1)
+
+        kept = counts[pair_points] <= samples
+        order = numpy.argsort(numpy.concatenate([pair_points[kept], drawn_points]), kind='mergesort')
+        return (numpy.concatenate([pair_points[kept], drawn_points])[order],
+                numpy.concatenate([pair_lights[kept], pair_lights[drawn]])[order],
+                numpy.concatenate([estimates[kept], totals[drawn_points] / samples])[order])
+
+    def get_batch_points(self):
+        """Returns how many points to find pairs for at once, so lights
+        without a radius give at most about BATCH_PAIRS pairs"""
+        return max(1, BATCH_PAIRS // max(1, len(self.unbounded)))
@@ -0,0 +1,233 @@
+"""Triangle meshes, loaded from Wavefront OBJ files
+
+A Mesh is one object in a World however many triangles it has. Its vertices
+and the corners of its triangles are kept in numpy arrays, and rays are
+tested against them through a BVH of the mesh's own, every triangle of a
+leaf against its whole packet of rays at once with the Moller-Trumbore test
+in vectormath.
+
+    w.add_object(mesh.Mesh.from_obj('bunny.obj', reflectivity=.2))
+"""
+import array
+import numpy
+import bvh
+import kernels
+import raycast
+import vectormath
+
+LEAF_SIZE = 32 # triangles per BVH leaf, all tested at once; as in packed, bigger leaves
+               # mean fewer numpy calls per packet but bigger temporary arrays
+
+def read_obj(f):
+    """Returns a (V, 3) array of the vertices and an (F, 3) array of the
+    vertex indices of the triangles in an OBJ file, read a line at a time
+
+    Faces with more than three corners are split into fans of triangles.
+    Texture coordinates, normals, groups and materials are ignored.
+
+    >>> import StringIO
+    >>> vertices, faces = read_obj(StringIO.StringIO('''# a square
+    ... v 0 0 0
+    ... v 1 0 0
+    ... v 1 1 0
+    ... v 0 1 0
+    ... vn 0 0 1
+    ... f 1//1 2//1 3//1 4//1
+    ... f -4 -2 -1
+    ... '''))
+    >>> vertices.shape, faces.tolist()
+    ((4, 3), [[0, 1, 2], [0, 2, 3], [0, 2, 3]])
+    """
+    vertices = array.array('d')
+    faces = array.array('l')
+    num_vertices = 0
+    for line in f:
+        words = line.split()
+        if not words:
+            continue
+        if words[0] == 'v':
+            vertices.extend(float(word) for word in words[1:4])
+            num_vertices += 1
+        elif words[0] == 'f':
+            corners = [int(word.split('/')[0]) for word in words[1:]]
+            corners = [i - 1 if i > 0 else num_vertices + i for i in corners]
+            for i in xrange(1, len(corners) - 1):
+                faces.extend((corners[0], corners[i], corners[i + 1]))
+    return (numpy.frombuffer(vertices, dtype=numpy.float_).reshape(-1, 3),
+            numpy.frombuffer(faces, dtype=numpy.int_).reshape(-1, 3))
+
+class Mesh(raycast.Solid):
+    """A surface of triangles, given as a (V, 3) array of vertices and an
+    (F, 3) array of the indices of the vertices at each triangle's corners,
+    counter-clockwise seen from its front
+
+    >>> m = Mesh([(0,0,0), (1,0,0), (1,1,0), (0,1,0)], [(0,1,2), (0,2,3)])
+    >>> ts, triangles = m.get_ray_hits(numpy.array([[.8,.2,-1], [.2,.8,-1], [2,2,-1]]), numpy.array([[0.,0,1]]*3))
+    >>> ts.tolist(), triangles.tolist()
+    ([[1.0, 1.0, nan]], [[0, 1, -1]])
+
+    It's lit like any other solid, from the side the ray came from
+
+    >>> ray = ((.8, .2, -1), (.8, .2, 0))
+    >>> raycast.Light((.8, .2, -5)).get_light_contribution((.8, .2, 0), ray, raycast.World(), m)
+    1.0
+    >>> m.get_unit_normal(numpy.array([.2, .8, 0])).tolist()
+    [0.0, 0.0, 1.0]
+    """
+    def __init__(self, vertices, faces, reflectivity=.5, leaf_size=LEAF_SIZE):
+        self.vertices = numpy.array(vertices, dtype=numpy.float_).reshape(-1, 3)
+        self.faces = numpy.array(faces, dtype=numpy.int_).reshape(-1, 3)
+        self.reflectivity = reflectivity
+
+        # constants used for every ray
+        corners = self.vertices[self.faces]
+        self.corners = corners[:, 0]
+        self.edges1 = corners[:, 1] - corners[:, 0]
+        self.edges2 = corners[:, 2] - corners[:, 0]
+        normals = numpy.cross(self.edges1, self.edges2)
+        lengths = numpy.sqrt(vectormath.get_squared_lengths(normals))
+        lengths[lengths == 0] = 1 # degenerate triangles, which no ray hits
+        self.unit_normals = normals / lengths[:, numpy.newaxis]
+        self.bvh = bvh.BVH.from_bounds(corners.min(axis=1), corners.max(axis=1), leaf_size)
+
+    @classmethod
+    def from_obj(cls, path, reflectivity=.5):
+        """Returns the mesh of the triangles in the OBJ file at path"""
+        with open(path) as f:
+            vertices, faces = read_obj(f)
+        return cls(vertices, faces, reflectivity)
+
+    def __repr__(self):
+        return ' Mesh of '+str(len(self.faces))+' triangles'
+
+    def get_bounds(self):
+        if not len(self.faces):
+            return None
+        return self.bvh.node_mins[0], self.bvh.node_maxs[0]
+
+    def get_scene_values(self):
+        return ('Mesh', self.vertices, self.faces, self.reflectivity)
+
+    def get_nearest_triangles(self, origins, directions, stats=None):
+        """Returns the index of the nearest triangle each ray hits, -1 where
+        it hits none, and the parametric distance t to it, nan where it
+        hits none"""
+        lengths = numpy.sqrt(vectormath.get_squared_lengths(directions))
+        best_projs = numpy.repeat(numpy.inf, len(origins))
+        best_ts = numpy.repeat(numpy.nan, len(origins))
+        best_triangles = numpy.repeat(-1, len(origins))
+
+        def update_leaf(triangles, rays):
+            if stats is not None:
+                stats.count_tests('Triangle', len(triangles) * len(rays))
+            ts = vectormath.get_rays_ts_with_triangles(origins[rays], directions[rays],
+                    self.corners[triangles], self.edges1[triangles], self.edges2[triangles])
+            projs = ts * lengths[rays, numpy.newaxis]
+            projs[numpy.isnan(projs)] = numpy.inf
+            projs[projs < bvh.MIN_PROJECTION] = numpy.inf
+            nearest = numpy.argmin(projs, axis=1)
+            nearest_projs = projs[numpy.arange(len(rays)), nearest]
+            closer = numpy.flatnonzero(nearest_projs < best_projs[rays])
+            closer_rays = rays[closer]
+            best_projs[closer_rays] = nearest_projs[closer]
+            best_ts[closer_rays] = ts[closer, nearest[closer]]
+            best_triangles[closer_rays] = triangles[nearest[closer]]
+        self.bvh.traverse_nearest(origins, directions, best_projs, update_leaf, stats)
+        return best_triangles, best_ts
+
+    def get_triangles_at(self, points):
+        """Returns the index of the triangle each of an (N, 3) array of
+        points on the mesh lies on, for points whose ray isn't known
+
+        Points are matched to the triangle they're closest to the plane of,
+        less any distance outside its edges, among the triangles whose
+        boxes they're in. Where triangles meet either may be picked, so
+        renders use the triangle get_ray_hits found instead.
+
+        >>> m = Mesh([(0,0,0), (1,0,0), (1,1,0), (0,1,0)], [(0,1,2), (0,2,3)])
+        >>> m.get_triangles_at(numpy.array([[.8,.2,0], [.2,.8,0]])).tolist()
+        [0, 1]
+        """
+        best_scores = numpy.repeat(numpy.inf, len(points))
+        best_triangles = numpy.zeros(len(points), dtype=numpy.int_)
+
+        def update_leaf(triangles, inside):
+            offsets = points[inside, numpy.newaxis] - self.corners[triangles]
+            edges1 = self.edges1[triangles]
+            edges2 = self.edges2[triangles]
+            squares1 = numpy.sum(edges1 * edges1, axis=-1)
+            squares2 = numpy.sum(edges2 * edges2, axis=-1)
+            dots = numpy.sum(edges1 * edges2, axis=-1)
+            offset_dots1 = numpy.sum(offsets * edges1, axis=-1)
+            offset_dots2 = numpy.sum(offsets * edges2, axis=-1)
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                inverse_denominators = 1 / (squares1 * squares2 - dots**2)
+                us = (squares2 * offset_dots1 - dots * offset_dots2) * inverse_denominators
+                vs = (squares1 * offset_dots2 - dots * offset_dots1) * inverse_denominators
+                outside = numpy.maximum(numpy.maximum(-us, -vs), us + vs - 1).clip(0)
+            scores = (numpy.abs(numpy.sum(offsets * self.unit_normals[triangles], axis=-1)) +
+                    outside * numpy.sqrt(numpy.maximum(squares1, squares2)))
+            scores[numpy.isnan(scores)] = numpy.inf
+            nearest = numpy.argmin(scores, axis=1)
+            nearest_scores = scores[numpy.arange(len(inside)), nearest]
+            closer = numpy.flatnonzero(nearest_scores < best_scores[inside])
+            best_scores[inside[closer]] = nearest_scores[closer]
+            best_triangles[inside[closer]] = triangles[nearest[closer]]
+        self.bvh.traverse_points(points, vectormath.get_ray_epsilons(points), update_leaf)
+        return best_triangles
+
+    def get_intersections(self, ray):
+        origin = numpy.array([ray[0]], dtype=numpy.float_)
+        direction = numpy.array([ray[1]], dtype=numpy.float_) - origin
+        t = self.get_nearest_triangles(origin, direction)[1][0]
+        if numpy.isnan(t):
+            return []
+        return [origin[0] + direction[0]*t]
+
+    def get_ray_ts(self, origins, directions, out=None):
+        ts = self.get_nearest_triangles(origins, directions)[1][numpy.newaxis]
+        if out is not None:
+            out[:] = ts
+            return out
+        return ts
+
+    def get_ray_hits(self, origins, directions, stats=None):
+        triangles, ts = self.get_nearest_triangles(origins, directions, stats)
+        return ts[numpy.newaxis], triangles[numpy.newaxis]
+
+    def get_unit_normal(self, point):
+        return self.get_unit_normals(numpy.array([point], dtype=numpy.float_))[0]
+
+    def get_normal_ray(self, point):
+        return (point, point + self.get_unit_normal(point))
+
+    def get_unit_normals(self, points, parts=None):
+        if parts is None:
+            parts = self.get_triangles_at(points)
+        return self.unit_normals[parts]
+
+    def get_normal_rays(self, points):
+        return points, points + self.get_unit_normals(points)
+
+    def render_intersection(self, intersection, ray, world, bouncenum, weight=1.0):
+        """Returns the value to render, possibly by recusively rendering reflections
+
+        weight is the fraction of the pixel's value this intersection makes up
+
+        A point doesn't say which triangle it's on, so the one ray hit is
+        found by tracing it against the mesh again.
+        """
+        (x, y, z), (dx, dy, dz), length = bvh.get_line(ray)
+        triangle = self.get_nearest_triangles(numpy.array([[x, y, z]]), numpy.array([[dx, dy, dz]]),
+                world.stats)[0][0]
+        nx, ny, nz = self.unit_normals[triangle].tolist()
+        intersection = numpy.array(intersection, dtype=numpy.float_)
+        bounce_ray = (intersection, intersection + kernels.get_reflection(dx, dy, dz, nx, ny, nz))
+        unit_normal = vectormath.get_facing_normals(numpy.array([[nx, ny, nz]]), numpy.array([[dx, dy, dz]]))
+        light = world.render_light_values(intersection[numpy.newaxis], unit_normal)[0]
+        return (self.reflectivity * world.render_reflection(bounce_ray, bouncenum+1, weight * self.reflectivity) +
+                (1 - self.reflectivity) * light)
+
+    def render_intersections(self, points, origins, directions, world, bouncenum, lights):
+        values = (1 - self.reflectivity) * lights
+        return values, numpy.repeat(float(self.reflectivity), len(points))
@@ -0,0 +1,366 @@
+"""Worlds whose spheres and checkerboards are stored as flat numpy arrays
+
+A PackedWorld renders like a World of Spheres and Checkerboards, but keeps
+one array per attribute rather than one Python object per solid: sphere
+centers are an (N, 3) array, radii, colors and reflectivities (N,) arrays,
+and checkerboards are stored with their unit normals, plane offsets and
+square sizes already worked out. With the squared center lengths and
+radii kept for intersection tests, each sphere is 8 float64s, so a million
+spheres take 64MB; their BVH adds a box (48 bytes) and an index (8 bytes)
+for each, another 56MB. Each BVH leaf of spheres is tested against its
+packet of rays in a single numpy operation.
+
+Only batched rendering does any real work; render_ray traces its one ray
+through render_rays.
+"""
+import json
+import time
+import numpy
+import bvh
+import raycast
+import vectormath
+
+LEAF_SIZE = 32 # spheres per BVH leaf, all tested at once; bigger leaves mean fewer
+               # numpy calls per packet but bigger temporary arrays
+
+SPHERE_ARRAYS = ('sphere_centers', 'sphere_radii', 'sphere_colors', 'sphere_reflectivities')
+PLANE_ARRAYS = ('plane_origins', 'plane_axes1', 'plane_axes2', 'plane_reflectivities')
+LIGHT_ARRAYS = ('light_positions', 'light_brightnesses', 'light_radii')
+VIEW_ARRAYS = ('view_width_rays', 'view_height_rays', 'view_distances')
+
+def get_sphere_ts(centers, center_squares, radius_squares, origins, directions):
+    """Returns the parametric distances t along each of N rays to its
+    crossings of each of M spheres as an (N, 2M) array, nan for misses
+
+    Column j belongs to sphere j % M
+
+    >>> centers = numpy.array([[0.,0,0], [0,0,-5]])
+    >>> ts = get_sphere_ts(centers, vectormath.get_squared_lengths(centers), numpy.array([1., 4]),
+    ...         numpy.array([[0.,0,3], [5,0,3]]), numpy.array([[0.,0,-1], [0,0,-1]]))
+    >>> ts[0].tolist(), numpy.isnan(ts[1]).all()
+    ([4.0, 10.0, 2.0, 6.0], True)
+    """
+    ts = vectormath.get_rays_ts_with_sphere(origins[:, numpy.newaxis], directions[:, numpy.newaxis],
+            centers, center_squares, radius_squares)
+    return ts.transpose(1, 0, 2).reshape(len(origins), -1)
+
+class PackedWorld(raycast.World):
+    """A World of spheres and checkerboards held in arrays
+
+    Checkerboards are given by an origin and the two axis vectors a
+    Checkerboard's rays point along.
+
+    >>> w = raycast.World()
+    >>> w.add_object(raycast.Sphere((0,0,0), 1, color=.5))
+    >>> w.add_object(raycast.Sphere((2,1,0), 1, .2, color=.5))
+    >>> w.add_object(raycast.Checkerboard(((0,-2,0), (0,-2,1)), ((0,-2,0), (1,-2,0))))
+    >>> w.add_light(raycast.Light((10, 10, -10)))
+    >>> p = PackedWorld.from_world(w)
+    >>> p.sphere_centers.shape, p.plane_normals.tolist(), p.plane_offsets.tolist()
+    ((2, 3), [[0.0, 1.0, 0.0]], [-2.0])
+    >>> v = raycast.View(((0,0,-5), (1,0,-5)), ((0,0,-5), (0,1,-5)), -4)
+    >>> a = w.render_view_values(v, 20, 20, 6, 6)
+    >>> b = p.render_view_values(v, 20, 20, 6, 6)
+    >>> abs(a - b).max() < 1e-9
+    True
+
+    Rays bouncing many times between mirrors follow the same paths too:
+
+    >>> w = raycast.World()
+    >>> for center in [(-2,0,4), (2,0,4), (0,-2.5,2)]:
+    ...     w.add_object(raycast.Sphere(center, 1.5, .95, color=.5))
+    >>> for origin, axis1, axis2 in [((-6,0,0), (0,0,3), (0,3,0)), ((6,0,0), (0,3,0), (0,0,3)),
+    ...         ((0,-6,0), (3,0,0), (0,0,3)), ((0,6,0), (0,0,3), (3,0,0))]:
+    ...     w.add_object(raycast.Checkerboard((origin, numpy.add(origin, axis1)),
+    ...             (origin, numpy.add(origin, axis2)), 1.8))
+    >>> w.add_light(raycast.Light((0, 0, -10)))
+    >>> v = raycast.View(((0,0,-3), (2,0,-3)), ((0,0,-3), (0,2,-3)), -4)
+    >>> stats = raycast.RenderStats()
+    >>> a = w.render_view_values(v, 16, 12, 7, 7, stats=stats)
+    >>> b = PackedWorld.from_world(w).render_view_values(v, 16, 12, 7, 7)
+    >>> max(stats.rays), (a == b).all()
+    (15, True)
+    """
+    def __init__(self, sphere_centers=(), sphere_radii=(), sphere_colors=(), sphere_reflectivities=(),
+            plane_origins=(), plane_axes1=(), plane_axes2=(), plane_reflectivities=()):
+        raycast.World.__init__(self)
+        self.sphere_centers = numpy.array(sphere_centers, dtype=numpy.float_).reshape(-1, 3)
+        self.sphere_radii = numpy.array(sphere_radii, dtype=numpy.float_)
+        self.sphere_colors = numpy.array(sphere_colors, dtype=numpy.float_)
+        self.sphere_reflectivities = numpy.array(sphere_reflectivities, dtype=numpy.float_)
+        self.plane_origins = numpy.array(plane_origins, dtype=numpy.float_).reshape(-1, 3)
+        self.plane_axes1 = numpy.array(plane_axes1, dtype=numpy.float_).reshape(-1, 3)
+        self.plane_axes2 = numpy.array(plane_axes2, dtype=numpy.float_).reshape(-1, 3)
+        self.plane_reflectivities = numpy.array(plane_reflectivities, dtype=numpy.float_)
+
+        # constants used for every ray, worked out as Sphere and Checkerboard do
+        self.sphere_center_squares = vectormath.get_squared_lengths(self.sphere_centers)
+        self.sphere_radius_squares = self.sphere_radii**2
+        self.plane_normals = numpy.array([normal / numpy.linalg.norm(normal)
+                for normal in numpy.cross(self.plane_axes1, self.plane_axes2)]).reshape(-1, 3)
+        self.plane_offsets = numpy.array([numpy.dot(normal, origin)
+                for normal, origin in zip(self.plane_normals, self.plane_origins)])
+        self.plane_axis_lengths1 = numpy.sqrt(numpy.sum(self.plane_axes1**2, axis=1))
+        self.plane_axis_lengths2 = numpy.sqrt(numpy.sum(self.plane_axes2**2, axis=1))
+
+    @classmethod
+    def from_world(cls, world):
+        """Returns a PackedWorld with the objects, lights and views of world,
+        which may only contain Spheres and Checkerboards"""
+        arrays = dict((name, []) for name in SPHERE_ARRAYS + PLANE_ARRAYS)
+        for obj in world.objects:
+            if isinstance(obj, raycast.Sphere):
+                values = (obj.center, obj.radius, obj.color, obj.reflectivity)
+                names = SPHERE_ARRAYS
+            elif isinstance(obj, raycast.Checkerboard):
+                values = (obj.ray1[0], obj.ray1[1] - obj.ray1[0], obj.ray2[1] - obj.ray2[0], obj.reflectivity)
+                names = PLANE_ARRAYS
+            else:
+                raise TypeError("Can't pack"+repr(obj))
+            for name, value in zip(names, values):
+                arrays[name].append(value)
+        packed = cls(**arrays)
+        for light in world.lights:
+            packed.add_light(light)
+        for view in world.views:
+            packed.add_view(view)
+        packed.settings = world.settings
+        return packed
+
+    def get_arrays(self):
+        """Returns a dict of arrays holding the spheres, checkerboards,
+        lights, views and settings, as read by from_arrays
+
+        Lights without a radius have a radius of inf, views are kept as their
+        two screen rays and camera distance, and settings as a JSON string of
+        RenderSettings arguments.
+        """
+        arrays = dict((name, getattr(self, name)) for name in SPHERE_ARRAYS + PLANE_ARRAYS)
+        index = self.get_light_index()
+        arrays['light_positions'] = index.positions
+        arrays['light_brightnesses'] = index.brightnesses
+        arrays['light_radii'] = index.radii
+        arrays['view_width_rays'] = numpy.array([view.screen_width_ray for view in self.views]).reshape(-1, 2, 3)
+        arrays['view_height_rays'] = numpy.array([view.screen_height_ray for view in self.views]).reshape(-1, 2, 3)
+        arrays['view_distances'] = numpy.array([view.camera_distance for view in self.views])
+        arrays['settings'] = numpy.array(json.dumps(vars(self.settings), sort_keys=True))
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Returns a PackedWorld made from a dict of arrays like those of
+        get_arrays, in which only the sphere and checkerboard arrays are
+        needed
+
+        >>> p = PackedWorld.from_arrays({'sphere_centers': numpy.zeros((1, 3)), 'sphere_radii': [1.],
+        ...         'sphere_colors': [.5], 'sphere_reflectivities': [0.], 'plane_origins': [],
+        ...         'plane_axes1': [], 'plane_axes2': [], 'plane_reflectivities': []})
+        >>> p, p.lights, p.views
+        ( PackedWorld of 1 spheres and 0 checkerboards, [], [])
+        """
+        packed = cls(**dict((name, arrays[name]) for name in SPHERE_ARRAYS + PLANE_ARRAYS))
+        if 'light_positions' in arrays:
+            positions = arrays['light_positions']
+            brightnesses = arrays['light_brightnesses'] if 'light_brightnesses' in arrays else numpy.ones(len(positions))
+            radii = arrays['light_radii'] if 'light_radii' in arrays else numpy.repeat(numpy.inf, len(positions))
+            for position, brightness, radius in zip(positions, brightnesses, radii):
+                packed.add_light(raycast.Light(position, float(brightness),
+                        None if numpy.isinf(radius) else float(radius)))
+        if 'view_distances' in arrays:
+            for width_ray, height_ray, distance in zip(*[arrays[name] for name in VIEW_ARRAYS]):
+                packed.add_view(raycast.View(tuple(map(tuple, width_ray)), tuple(map(tuple, height_ray)), distance))
+        if 'settings' in arrays:
+            packed.settings = raycast.RenderSettings(**json.loads(str(arrays['settings'])))
+        return packed
+
+    def save(self, path):
+        """Saves the spheres, checkerboards, lights, views and settings to an .npz file"""
+        numpy.savez(path, **self.get_arrays())
+
+    @classmethod
+    def load(cls, path):
+        """Returns a PackedWorld read from an .npz file written by save
+
+        >>> import os, tempfile
+        >>> w = raycast.World()
+        >>> w.add_object(raycast.Sphere((0,0,0), 1, color=.5))
+        >>> w.add_light(raycast.Light((10, 10, -10)))
+        >>> w.add_view(raycast.View(((0,0,-5), (1,0,-5)), ((0,0,-5), (0,1,-5)), -4))
+        >>> w.settings = raycast.RenderSettings(samples=2)
+        >>> path = os.path.join(tempfile.mkdtemp(), 'scene.npz')
+        >>> PackedWorld.from_world(w).save(path)
+        >>> p = PackedWorld.load(path)
+        >>> p.sphere_centers.tolist(), p.lights, p.views[0].camera_position.tolist(), p.settings.samples
+        ([[0.0, 0.0, 0.0]], [ Light at [ 10.  10. -10.]], [0.0, 0.0, -9.0], 2)
+        """
+        arrays = numpy.load(path)
+        try:
+            return cls.from_arrays(arrays)
+        finally:
+            arrays.close()
+
+    def __repr__(self):
+        return (' PackedWorld of '+str(len(self.sphere_radii))+' spheres and '+
+                str(len(self.plane_reflectivities))+' checkerboards')
+
+    def add_object(self, obj):
+        raise TypeError('Objects of a PackedWorld are given as arrays, see PackedWorld.from_world')
+
+    def get_scene(self):
+        """Returns the arrays of the spheres and checkerboards, less the
+        sphere colors that don't change how they render, and the lights"""
+        return (tuple(getattr(self, name) for name in SPHERE_ARRAYS + PLANE_ARRAYS if name != 'sphere_colors') +
+                (tuple(light.get_scene_values() for light in self.lights),))
+
+    def get_bvh(self):
+        """Returns the bounding volume hierarchy over the spheres"""
+        if self.bvh is None or self.bvh.num_objects != len(self.sphere_radii):
+            radii = self.sphere_radii[:, numpy.newaxis]
+            self.bvh = bvh.BVH.from_bounds(self.sphere_centers - radii, self.sphere_centers + radii, LEAF_SIZE)
+        return self.bvh
+
+    def get_sphere_ts(self, spheres, origins, directions):
+        return get_sphere_ts(self.sphere_centers[spheres], self.sphere_center_squares[spheres],
+                self.sphere_radius_squares[spheres], origins, directions)
+
+    def get_plane_ts(self, origins, directions):
+        """Returns an (M, N) array of the parametric distances t along N rays
+        to the M checkerboards, nan where a ray is parallel"""
+        ts = numpy.empty((len(self.plane_normals), len(origins)))
+        for normal, offset, plane_ts in zip(self.plane_normals, self.plane_offsets, ts):
+            vectormath.get_rays_ts_with_plane(origins, directions, normal, offset, plane_ts)
+        return ts
+
+    def get_first_ray_intersections(self, origins, directions):
+        """Returns an array of hit indices - spheres first, then checkerboards
+        numbered on from the last sphere, -1 where nothing was hit - an
+        (N, 3) array of the intersection points and, as spheres and
+        checkerboards are all of a piece, an array of zero parts"""
+        stats = self.stats
+        if stats is not None:
+            start = time.time()
+        lengths = numpy.sqrt(numpy.sum(directions**2, axis=1))
+        best_projs = numpy.repeat(numpy.inf, len(origins))
+        best_ts = numpy.zeros(len(origins))
+        best_indices = numpy.repeat(-1, len(origins))
+        num_spheres = len(self.sphere_radii)
+
+        if len(self.plane_normals):
+            ts = self.get_plane_ts(origins, directions)
+            projs = ts * lengths
+            projs[numpy.isnan(projs)] = numpy.inf
+            projs[projs < bvh.MIN_PROJECTION] = numpy.inf
+            planes = numpy.argmin(projs, axis=0)
+            rays = numpy.arange(len(origins))
+            best_projs = projs[planes, rays]
+            hit = numpy.flatnonzero(best_projs < numpy.inf)
+            best_indices[hit] = num_spheres + planes[hit]
+            best_ts[hit] = ts[planes[hit], hit]
+            if stats is not None:
+                stats.count_tests('Checkerboard', ts.size)
+
+        def update_leaf(spheres, rays):
+            if stats is not None:
+                stats.count_tests('Sphere', len(spheres) * len(rays))
+            ts = self.get_sphere_ts(spheres, origins[rays], directions[rays])
+            projs = ts * lengths[rays, numpy.newaxis]
+            projs[numpy.isnan(projs)] = numpy.inf
+            projs[projs < bvh.MIN_PROJECTION] = numpy.inf
+            nearest = numpy.argmin(projs, axis=1)
+            nearest_projs = projs[numpy.arange(len(rays)), nearest]
+            closer = numpy.flatnonzero(nearest_projs < best_projs[rays])
+            closer_rays = rays[closer]
+            best_projs[closer_rays] = nearest_projs[closer]
+            best_ts[closer_rays] = ts[closer, nearest[closer]]
+            best_indices[closer_rays] = spheres[nearest[closer] % len(spheres)]
+        self.get_bvh().traverse_nearest(origins, directions, best_projs, update_leaf, stats,
+                self.get_packets(origins, directions))
+        if stats is not None:
+            stats.add_time('intersection', time.time() - start)
+        return (best_indices, origins + best_ts[:, numpy.newaxis] * directions,
+                numpy.zeros(len(origins), dtype=numpy.int_))
+
+    def get_blocked_rays(self, origins, directions):
+        """Returns whether anything lies between origins and origins + directions"""
+        stats = self.stats
+        if stats is not None:
+            start = time.time()
+        max_projs = numpy.sqrt(numpy.sum(directions**2, axis=1))
+        blocked = numpy.zeros(len(origins), dtype=bool)
+        if len(self.plane_normals):
+            projs = self.get_plane_ts(origins, directions) * max_projs
+            projs[numpy.isnan(projs)] = -numpy.inf
+            blocked = ((projs > 0) & (projs < max_projs)).any(axis=0)
+            if stats is not None:
+                stats.count_tests('Checkerboard', projs.size)
+
+        def update_leaf(spheres, rays):
+            if stats is not None:
+                stats.count_tests('Sphere', len(spheres) * len(rays))
+            projs = self.get_sphere_ts(spheres, origins[rays], directions[rays]) * max_projs[rays, numpy.newaxis]
+            projs[numpy.isnan(projs)] = -numpy.inf
+            blocked[rays] = ((projs > 0) & (projs < max_projs[rays, numpy.newaxis])).any(axis=1)
+        self.get_bvh().traverse_blocked(origins, directions, max_projs, blocked, update_leaf, stats,
+                self.get_packets(origins, directions))
+        if stats is not None:
+            stats.count_shadow_rays(len(origins), int(blocked.sum()))
+            stats.add_time('shadow', time.time() - start)
+        return blocked
+
+    def get_plane_colors(self, planes, points):
+        """Returns 0 or 1 for points on the checkerboards numbered planes"""
+        colors = numpy.empty(len(points))
+        for plane in numpy.unique(planes):
+            on_plane = planes == plane
+            offsets = points[on_plane] - self.plane_origins[plane]
+            length1 = self.plane_axis_lengths1[plane]
+            length2 = self.plane_axis_lengths2[plane]
+            r1mod = (numpy.dot(offsets, self.plane_axes1[plane]) / length1) % length1
+            r2mod = (numpy.dot(offsets, self.plane_axes2[plane]) / length2) % length2
+            colors[on_plane] = (numpy.floor(r1mod) + numpy.floor(r2mod)) % 2
+        return colors
+
+    def render_rays(self, origins, directions, bouncenum, weights=None):
+        """Renders (N, 3) arrays of rays, shading every sphere and every
+        checkerboard hit together rather than object by object"""
+        if weights is None:
+            weights = numpy.ones(len(origins))
+        values = numpy.repeat(float(self.render_no_intersection_value(None)), len(origins))
+        if not len(origins):
+            return values
+        hits, points = self.get_first_ray_intersections(origins, directions)[:2]
+        if self.stats is not None:
+            self.stats.count_rays(bouncenum, len(origins), int(numpy.count_nonzero(hits != -1)))
+        num_spheres = len(self.sphere_radii)
+        on_spheres = numpy.flatnonzero((hits >= 0) & (hits < num_spheres))
+        on_planes = numpy.flatnonzero(hits >= num_spheres)
+        spheres = hits[on_spheres]
+        planes = hits[on_planes] - num_spheres
+
+        unit_normals = numpy.zeros((len(origins), 3))
+        unit_normals[on_spheres] = ((points[on_spheres] - self.sphere_centers[spheres]) /
+                self.sphere_radii[spheres, numpy.newaxis])
+        unit_normals[on_planes] = self.plane_normals[planes]
+        hit = numpy.flatnonzero(hits != -1)
+        lights = numpy.zeros(len(origins))
+        lights[hit] = self.render_light_values(points[hit],
+                vectormath.get_facing_normals(unit_normals[hit], directions[hit]))
+
+        reflectivities = numpy.zeros(len(origins))
+        reflectivities[on_spheres] = self.sphere_reflectivities[spheres]
+        values[on_spheres] = (1 - reflectivities[on_spheres]) * lights[on_spheres]
+        reflectivities[on_planes] = self.plane_reflectivities[planes] / 2
+        colors = self.get_plane_colors(planes, points[on_planes])
+        values[on_planes] = colors * .5 + colors * (1 - reflectivities[on_planes]) * lights[on_planes]
+
+        bouncing = numpy.flatnonzero(reflectivities)
+        bounce_origins, bounce_directions = vectormath.get_bounced_rays(points[bouncing], directions[bouncing],
+                unit_normals[bouncing])
+        values[bouncing] += reflectivities[bouncing] * self.render_reflections(
+                bounce_origins, bounce_directions, bouncenum+1, weights[bouncing] * reflectivities[bouncing])
+        return values
+
+    def render_ray(self, ray, bouncenum, weight=1.0):
+        origins = numpy.array([ray[0]], dtype=numpy.float_)
+        directions = numpy.array([ray[1]], dtype=numpy.float_) - origins
+        return self.render_rays(origins, directions, bouncenum, numpy.array([weight]))[0]
@@ -0,0 +1,89 @@
+"""Splitting batches of rays into coherent packets for BVH traversal
+
+A packet travels down the BVH together, every box test at a node done for
+all its rays at once, and each node only passes on the rays that enter its
+box. The more alike a packet's rays, the fewer nodes it visits that only a
+few of its rays enter. So rays are sorted before tracing: first by the
+octant of their direction, so every ray of a packet visits children in the
+same front to back order, then along a Morton (Z-order) curve through
+their origins and directions together, and cut into packets of
+PACKET_RAYS.
+
+Primary rays from one camera differ only in direction, so their packets
+are Morton-ordered tiles of the screen; shadow rays towards one light are
+ordered by where they start, and reflections by both. Each bounce of a
+batched render is traced breadth-first as one batch, so all the rays of a
+bounce are sorted together.
+
+Packets are only used with RenderSettings(packet_rays=...). Every node's
+box tests already cover a whole bounce at once, and splitting a batch
+into packets mostly adds numpy calls, so by default each batch is traced
+as a single packet.
+"""
+import numpy
+
+PACKET_RAYS = 2048 # rays traced through the BVH together
+MORTON_BITS = 8 # of each coordinate of origins and directions in sort keys
+
+def get_spread_bits(dimensions, bits=MORTON_BITS):
+    """Returns a table of every integer below 2**bits with its bits spread
+    out, bit n moved to bit n * dimensions
+
+    >>> [bin(x) for x in get_spread_bits(3, 2)]
+    ['0b0', '0b1', '0b1000', '0b1001']
+    """
+    values = numpy.arange(2**bits, dtype=numpy.int64)
+    spread = numpy.zeros(2**bits, dtype=numpy.int64)
+    for bit in xrange(bits):
+        spread |= ((values >> bit) & 1) << (bit * dimensions)
+    return spread
+
+def get_morton_codes(coordinates, bits=MORTON_BITS):
+    """Returns the Morton codes of an (N, D) array of integer coordinates
+    from 0 to 2**bits - 1, their bits interleaved highest first
+
+    >>> get_morton_codes(numpy.array([[0, 0], [1, 0], [0, 1], [1, 1], [2, 0]]), 2).tolist()
+    [0, 2, 1, 3, 8]
+    """
+    coordinates = numpy.asarray(coordinates, dtype=numpy.int64)
+    dimensions = coordinates.shape[1]
+    spread = get_spread_bits(dimensions, bits)
+    codes = numpy.zeros(len(coordinates), dtype=numpy.int64)
+    for axis in xrange(dimensions):
+        codes |= spread[coordinates[:, axis]] << (dimensions - 1 - axis)
+    return codes
+
+def get_quantized(values, low, high, bits=MORTON_BITS):
+    """Returns an (N, D) array of values from low to high scaled to
+    integers from 0 to 2**bits - 1"""
+    spans = numpy.where(high > low, high - low, 1.)
+    return ((values - low) / spans * (2**bits - 1) + .5).astype(numpy.int64)
+
+def get_ray_keys(origins, directions, bits=MORTON_BITS):
+    """Returns sort keys putting rays with the same direction octant
+    together, and then rays starting and heading near each other
+
+    >>> origins = numpy.zeros((4, 3))
+    >>> directions = numpy.array([[1., 1, 1], [-1, 1, 1], [1., .9, 1], [1, -1, 1]])
+    >>> numpy.argsort(get_ray_keys(origins, directions), kind='mergesort').tolist()
+    [2, 0, 3, 1]
+    """
+    octants = (directions < 0).dot([4, 2, 1])
+    lengths = numpy.sqrt(numpy.sum(directions**2, axis=1))
+    unit_directions = directions / numpy.where(lengths > 0, lengths, 1)[:, numpy.newaxis]
+    coordinates = numpy.hstack([get_quantized(origins, origins.min(axis=0), origins.max(axis=0), bits),
+            get_quantized(unit_directions, -1., 1., bits)])
+    return (octants.astype(numpy.int64) << (6 * bits)) | get_morton_codes(coordinates, bits)
+
+def get_packets(origins, directions, packet_rays=PACKET_RAYS):
+    """Returns a list of arrays of the indices of the rays in each packet,
+    each in increasing order so its rays are gathered from memory in order
+
+    >>> origins, directions = numpy.zeros((5, 3)), numpy.array([[1., 0, 0], [-1, 0, 0]] * 2 + [[1, 0, 0]])
+    >>> [packet.tolist() for packet in get_packets(origins, directions, 2)]
+    [[0, 2], [1, 4], [3]]
+    """
+    if len(origins) <= packet_rays:
+        return [numpy.arange(len(origins))]
+    order = numpy.argsort(get_ray_keys(origins, directions), kind='mergesort')
+    return [numpy.sort(order[start:start + packet_rays]) for start in xrange(0, len(order), packet_rays)]
@@ -0,0 +1,107 @@
+"""Renders views in bands of rows across a pool of worker processes
+
+Each worker is handed the World once, when the pool starts, and after that
+only receives the view and row numbers of each band it renders.
+"""
+import collections
+import itertools
+import multiprocessing
+import sys
+import numpy
+
+world = None # the World being rendered, in a worker process
+
+def init_worker(worker_world):
+    global world
+    world = worker_world
+
+def render_band(args):
+    (view, w_samples, h_samples, viewscreen_width, viewscreen_height, start_row, end_row, batch, settings,
+            stats) = args
+    values = world.render_rows(view, w_samples, h_samples, viewscreen_width, viewscreen_height,
+            start_row, end_row, batch, settings, stats)
+    return start_row, values, stats
+
+def get_bands(num_rows, band_rows):
+    """Returns (start_row, end_row) pairs covering num_rows rows
+
+    >>> get_bands(10, 4)
+    [(0, 4), (4, 8), (8, 10)]
+    """
+    return [(start, min(start + band_rows, num_rows)) for start in xrange(0, num_rows, band_rows)]
+
+def render_bands(world, view, w_samples, h_samples, viewscreen_width, viewscreen_height, bands,
+        batch=True, processes=None, settings=None, stats=None, ordered=False):
+    """Renders (start_row, end_row) bands in a pool of processes workers,
+    yielding (start_row, values) for each band as it finishes
+
+    Each band is counted on a fresh RenderStats in its worker, which is
+    added to stats when the band comes back.
+
+    With ordered set, bands are yielded in the order they're given, and
+    at most two per worker are handed out ahead of the one being waited
+    for, so only that many bands are ever held at once.
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    world.get_bvh() # build once here rather than in every worker
+
+    tasks = [(view, w_samples, h_samples, viewscreen_width, viewscreen_height, start_row, end_row, batch, settings,
+                type(stats)() if stats is not None else None)
+            for start_row, end_row in bands]
+    pool = multiprocessing.Pool(processes, init_worker, (world,))
+    try:
+        if ordered:
+            results = get_ordered_results(pool, render_band, tasks, processes * 2)
+        else:
+            results = pool.imap_unordered(render_band, tasks)
+        for start_row, values, band_stats in results:
+            if stats is not None:
+                stats.add(band_stats)
+            yield start_row, values
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def get_ordered_results(pool, function, tasks, ahead):
+    """Yields function(task) for each of tasks in order, run in pool with
+    no more than ahead tasks handed out at once
+
+    >>> pool = multiprocessing.Pool(2)
+    >>> list(get_ordered_results(pool, abs, range(0, -10, -1), 3))
+    [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]
+    >>> pool.terminate()
+    """
+    tasks = iter(tasks)
+    pending = collections.deque(pool.apply_async(function, (task,)) for task in itertools.islice(tasks, ahead))
+    while pending:
+        result = pending.popleft().get()
+        for task in itertools.islice(tasks, 1):
+            pending.append(pool.apply_async(function, (task,)))
+        yield result
+
+def get_band_rows(h_samples, processes=None):
+    """Returns a number of rows per band giving each worker several bands,
+    so that slow bands even out"""
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    return max(1, h_samples // (processes * 4))
+
+def render_rows(world, view, w_samples, h_samples, viewscreen_width, viewscreen_height,
+        batch=True, processes=None, band_rows=None, settings=None, stats=None):
+    """Returns the same values as world.render_rows for all rows of the view,
+    rendering bands of band_rows rows in a pool of processes workers
+
+    processes defaults to the number of cores
+    """
+    if band_rows is None:
+        band_rows = get_band_rows(h_samples, processes)
+    values = numpy.empty((h_samples, w_samples), dtype=numpy.float32)
+    rows_done = 0
+    for start_row, band in render_bands(world, view, w_samples, h_samples, viewscreen_width, viewscreen_height,
+            get_bands(h_samples, band_rows), batch, processes, settings, stats):
+        values[start_row:start_row+len(band)] = band
+        rows_done += len(band)
+        sys.stderr.write(str(rows_done)+'/'+str(h_samples)+'\n')
+    return values
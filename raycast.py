@@ -1,30 +1,338 @@
 """Renders 3d scences by raytracing"""
 import vectormath
+import kernels
+import lighting
+import bvh
+import packets
+import parallel
+import checkpoint
 import sys
+import os
+import tempfile
+import time
+import contextlib
+import collections
+import logging
 import numpy
 from PIL import Image
 import random
 
-# EVIL global variables for debugging
-bounces = []
-BOUNCELIMIT = 15
+log = logging.getLogger('raycast')
+
+SUPERSAMPLE_BATCH_RAYS = 65536 # most rays traced at once when supersampling
+FRAMEBUFFER_DTYPE = numpy.float32 # of the arrays of values whole views are rendered to
+
+class RenderSettings(object):
+    """Controls how deep reflections are traced and how many rays are
+    traced per pixel during a render
+
+    max_depth is the most reflections followed from any pixel. A reflection
+    whose weight - the fraction of the pixel's value it can make up - is below
+    min_weight isn't traced, and counts as a ray that hit nothing.
+
+    With roulette_weight set, reflections weighing less than it are instead
+    traced at random with probability weight / roulette_weight, and scaled
+    up when they are, so on average the image is unchanged. seed makes
+    this repeatable.
+
+    samples > 1 antialiases the image: each pixel is the mean of a grid of
+    samples by samples rays spread over it, each through the center of its
+    cell of the grid or, with jitter, through a random point in it. With
+    adaptive_threshold set, rows are first rendered with one ray per pixel,
+    and only pixels differing from a neighbour by more than the threshold
+    get the grid of rays. render_progressive renders the full grid for
+    every pixel.
+
+    With light_samples set, each point is lit by at most that many of the
+    lights that reach it, chosen at random by how much light they'd give it
+    (see lighting.py), so the shadow rays traced per point don't grow with
+    the number of lights.
+
+    Each bounce's rays go through the BVH together as one batch. With
+    packet_rays set, a batch is instead sorted by direction and origin and
+    traced in packets of that many rays (see packets.py).
+
+    >>> RenderSettings().max_depth
+    15
+    >>> w = World()
+    >>> w.add_object(Checkerboard(((0,0,-1), (1,0,-1)), ((0,0,-1), (0,1,-1)), 0))
+    >>> w.add_light(Light((0, 0, 10)))
+    >>> full_stats, adaptive_stats = RenderStats(), RenderStats()
+    >>> full = w.render_view_values(getTestView(), 16, 16, 6, 6, settings=RenderSettings(samples=3),
+    ...         stats=full_stats)
+    >>> adaptive = w.render_view_values(getTestView(), 16, 16, 6, 6,
+    ...         settings=RenderSettings(samples=3, adaptive_threshold=.1), stats=adaptive_stats)
+    >>> full_stats.primary_rays, adaptive_stats.primary_rays < full_stats.primary_rays / 2
+    (2304, True)
+    >>> numpy.abs(full - adaptive).max() < .1
+    True
+    """
+    def __init__(self, max_depth=15, min_weight=1./256, roulette_weight=None, seed=None,
+            samples=1, jitter=False, adaptive_threshold=None, light_samples=None, packet_rays=None):
+        self.max_depth = max_depth
+        self.min_weight = min_weight
+        self.roulette_weight = roulette_weight
+        self.seed = seed
+        self.samples = samples
+        self.jitter = jitter
+        self.adaptive_threshold = adaptive_threshold
+        self.light_samples = light_samples
+        self.packet_rays = packet_rays
+
+    def get_random(self, start_row=0):
+        """Returns the random number generator for a band of rows starting at start_row"""
+        if self.seed is None:
+            return numpy.random.RandomState()
+        return numpy.random.RandomState([self.seed, start_row])
+
+    def __repr__(self):
+        return (' RenderSettings with max depth '+str(self.max_depth)+', min weight '+str(self.min_weight)+
+                ', roulette weight '+str(self.roulette_weight)+', '+str(self.samples)+'x'+str(self.samples)+
+                (' jittered' if self.jitter else '')+' samples per pixel'+
+                (', adaptive threshold '+str(self.adaptive_threshold) if self.adaptive_threshold is not None else '')+
+                (', '+str(self.light_samples)+' light samples' if self.light_samples is not None else '')+
+                (', packets of '+str(self.packet_rays)+' rays' if self.packet_rays is not None else ''))
+
+class RenderStats(object):
+    """Counts and times of the work done by the renders it's passed to
+
+    rays and hits count the rays traced at each depth - 0 for primary rays,
+    1 for their reflections and so on - and how many of them hit something.
+    intersection_tests counts tests of rays against each type of object,
+    'box' being BVH node boxes. seconds holds the time spent finding first
+    hits ('intersection'), working out light at hit points ('lighting',
+    which includes 'shadow', testing shadow rays) and rendering in all
+    ('total'); with several processes these add up the time of each.
+
+    >>> w = World()
+    >>> w.add_object(Sphere((0,0,-3), 1, .5))
+    >>> w.add_object(Sphere((0,0,3), 1, .5))
+    >>> w.add_light(Light((0, 10, 0)))
+    >>> scalar_stats, batch_stats = RenderStats(), RenderStats()
+    >>> values = w.render_view_values(getTestView(), 8, 8, 4, 4, stats=scalar_stats, batch=False)
+    >>> values = w.render_view_values(getTestView(), 8, 8, 4, 4, stats=batch_stats)
+    >>> batch_stats.primary_rays, batch_stats.rays == scalar_stats.rays, batch_stats.hits == scalar_stats.hits
+    (64, True, True)
+    >>> batch_stats.shadow_rays == scalar_stats.shadow_rays > 0
+    True
+    """
+    def __init__(self):
+        self.rays = collections.Counter()
+        self.hits = collections.Counter()
+        self.shadow_rays = 0
+        self.blocked_shadow_rays = 0
+        self.intersection_tests = collections.Counter()
+        self.seconds = collections.Counter()
+
+    @property
+    def primary_rays(self):
+        return self.rays[0]
+
+    @property
+    def reflection_rays(self):
+        return sum(self.rays.values()) - self.rays[0]
+
+    def count_rays(self, bouncenum, num_rays, num_hits):
+        self.rays[bouncenum - 1] += num_rays
+        self.hits[bouncenum - 1] += num_hits
+
+    def count_shadow_rays(self, num_rays, num_blocked):
+        self.shadow_rays += num_rays
+        self.blocked_shadow_rays += num_blocked
+
+    def count_tests(self, kind, num_tests):
+        self.intersection_tests[kind] += num_tests
+
+    def add_time(self, stage, seconds):
+        self.seconds[stage] += seconds
+
+    def add(self, other):
+        """Adds the counts and times of other to these"""
+        self.rays.update(other.rays)
+        self.hits.update(other.hits)
+        self.shadow_rays += other.shadow_rays
+        self.blocked_shadow_rays += other.blocked_shadow_rays
+        self.intersection_tests.update(other.intersection_tests)
+        self.seconds.update(other.seconds)
+
+    def get_dict(self):
+        """Returns the stats as a dict which can be saved as JSON"""
+        return {
+                'primary_rays': self.primary_rays,
+                'reflection_rays': self.reflection_rays,
+                'shadow_rays': self.shadow_rays,
+                'blocked_shadow_rays': self.blocked_shadow_rays,
+                'rays_by_depth': dict((str(depth), n) for depth, n in self.rays.items()),
+                'hits_by_depth': dict((str(depth), n) for depth, n in self.hits.items()),
+                'intersection_tests': dict(self.intersection_tests),
+                'seconds': dict(self.seconds),
+                }
+
+    def __repr__(self):
+        s = (' RenderStats of '+str(self.primary_rays)+' primary, '+str(self.reflection_rays)+' reflection and '+
+                str(self.shadow_rays)+' shadow rays ('+str(self.blocked_shadow_rays)+' blocked)')
+        for depth in sorted(self.rays):
+            s += '\n  depth '+str(depth)+': '+str(self.rays[depth])+' rays, '+str(self.hits[depth])+' hits'
+        for kind in sorted(self.intersection_tests):
+            s += '\n  '+kind+' tests: '+str(self.intersection_tests[kind])
+        for stage in sorted(self.seconds):
+            s += '\n  '+stage+': %.3fs' % self.seconds[stage]
+        return s
 
 class Solid(object):
     """Represents an object in a 3d world which can interact with light"""
+    def get_bounds(self):
+        """Returns (min corner, max corner) of a box containing the solid,
+        or None if it is unbounded"""
+        return None
+    def get_scene_values(self):
+        """Returns a tuple of the kind of solid and the numbers and arrays
+        that affect how it renders, for telling scenes apart"""
+        raise NotImplementedError()
     def get_intersections(self, ray):
         raise NotImplementedError()
+    def render_intersection(self, intersection, ray, world, bouncenum):
+        raise NotImplementedError()
+
+    def get_unit_normal(self, point):
+        normal_ray = self.get_normal_ray(point)
+        n_vec = normal_ray[1] - normal_ray[0]
+        return n_vec / numpy.linalg.norm(n_vec)
+
+    def get_ray_t(self, origin, direction, min_t=0.):
+        """Returns the parametric distance t to the nearest intersection at
+        origin + t*direction beyond min_t, or nan, for a ray given as
+        tuples of floats
+
+        This one goes through get_ray_ts; solids that are tested often
+        work it out with a kernel.
+        """
+        ts = self.get_ray_ts(numpy.array([origin]), numpy.array([direction]))[:, 0]
+        ts = ts[~numpy.isnan(ts)]
+        ts = ts[ts > min_t]
+        if not len(ts):
+            return kernels.NAN
+        return float(ts.min())
+
     def get_bounced_ray(self, ray, intersection):
+        """Returns a ray refleced across the normal at a point
+
+        >>> s = Sphere((0,0,0), 1)
+        >>> s.get_bounced_ray(((0, 0, 4), (0, 0, 3)), (0, 0, 1))
+        (array([ 0.,  0.,  1.]), array([ 0.,  0.,  2.]))
+        >>> s.get_bounced_ray(((0, 3, 4), (0, 2, 3)), (0, 0, 1))
+        (array([ 0.,  0.,  1.]), array([ 0... -0.7...1.7...]))
+
+        """
+        intersection = numpy.array(intersection, dtype=numpy.float_)
+        dx, dy, dz = numpy.subtract(ray[1], ray[0], dtype=numpy.float_).tolist()
+        nx, ny, nz = self.get_unit_normal(intersection).tolist()
+        return (intersection, intersection + kernels.get_reflection(dx, dy, dz, nx, ny, nz))
+
+    # Batched versions of the above, operating on (N, 3) arrays of ray
+    # origins, directions and intersection points
+    def get_ray_ts(self, origins, directions, out=None):
+        """Returns a (k, N) array of parametric distances t to candidate
+        intersections at origins + t*directions, nan for misses, written
+        into out if it's given"""
         raise NotImplementedError()
-    def render_intersection(self, intersection, ray, world, bouncenum):
+    def get_ray_hits(self, origins, directions, stats=None):
+        """Returns the ts of get_ray_ts and a (k, N) array of the part of the
+        solid each candidate intersection is on, for solids made of many
+        parts with normals of their own; the parts are None for solids all
+        of a piece. Solids with tests of their own count them in stats"""
+        return self.get_ray_ts(origins, directions), None
+    def get_normal_rays(self, points):
+        """Returns (starts, ends) arrays of normal rays at points"""
+        raise NotImplementedError()
+    def get_unit_normals(self, points, parts=None):
+        """Returns the unit normals at points on the parts of the solid
+        get_ray_hits found them on"""
+        starts, ends = self.get_normal_rays(points)
+        return vectormath.get_unit_vectors(ends - starts)
+    def render_intersections(self, points, origins, directions, world, bouncenum, lights):
+        """Returns the values to render at points, not counting reflections,
+        and the weight each point's reflected ray should be added with
+
+        lights is the light reaching each point, which World.render_rays
+        works out for every point hit in a bounce at once
+        """
         raise NotImplementedError()
+
+    def get_bounced_rays(self, points, directions, parts=None):
+        """Returns origins and directions of rays reflected across the normals at points"""
+        return vectormath.get_bounced_rays(points, directions, self.get_unit_normals(points, parts))
+
 class Triangle(Solid):
-    """A depth-less plane"""
-    def __init__(self, points):
+    """A depth-less triangle, its front the side its points go round
+    counter-clockwise
+
+    >>> t = Triangle(((0,0,0), (1,0,0), (0,1,0)))
+    >>> t.get_ray_ts(numpy.array([[.2,.2,-1], [2,2,-1]]), numpy.array([[0.,0,1], [0,0,1]])).tolist()
+    [[1.0, nan]]
+    >>> t.get_unit_normal(numpy.array([.2,.2,0])).tolist()
+    [0.0, 0.0, 1.0]
+    """
+    def __init__(self, points, reflectivity=.5):
         self.points = numpy.array(points, dtype=numpy.float_)
+        self.reflectivity = reflectivity
+
+        # constants used for every ray
+        self.edge1 = self.points[1] - self.points[0]
+        self.edge2 = self.points[2] - self.points[0]
+        self.normal = numpy.cross(self.edge1, self.edge2)
+        self.unit_normal = self.normal / numpy.linalg.norm(self.normal)
+        self.floats = tuple(self.points[0].tolist() + self.edge1.tolist() + self.edge2.tolist())
+
+    def get_bounds(self):
+        return self.points.min(axis=0), self.points.max(axis=0)
+
+    def get_scene_values(self):
+        return ('Triangle', self.points, self.reflectivity)
+
     def get_intersections(self, ray):
-        return vectormath.get_line_intersection_with_plane(ray, self.points)
-    def get_bounced_ray(self, ray, intersection):
-        pass
+        return vectormath.get_line_intersection_with_triangle(ray, self.points)
+
+    def get_ray_t(self, origin, direction, min_t=0.):
+        px, py, pz, e1x, e1y, e1z, e2x, e2y, e2z = self.floats
+        return kernels.get_triangle_t(origin[0], origin[1], origin[2], direction[0], direction[1], direction[2],
+                px, py, pz, e1x, e1y, e1z, e2x, e2y, e2z, min_t)
+
+    def get_ray_ts(self, origins, directions, out=None):
+        ts = vectormath.get_rays_ts_with_triangles(origins, directions, self.points[:1],
+                self.edge1[numpy.newaxis], self.edge2[numpy.newaxis]).T
+        if out is not None:
+            out[:] = ts
+            return out
+        return ts
+
+    def get_normal_ray(self, point):
+        return (point, point+self.normal)
+
+    def get_unit_normal(self, point):
+        return self.unit_normal
+
+    def get_normal_rays(self, points):
+        return points, points + self.normal
+
+    def get_unit_normals(self, points, parts=None):
+        return numpy.broadcast_to(self.unit_normal, points.shape)
+
+    def __repr__(self):
+        return ' Triangle with corners '+str(tuple(map(tuple, self.points)))
+
+    def render_intersection(self, intersection, ray, world, bouncenum, weight=1.0):
+        """Returns the value to render, possibly by recusively rendering reflections
+
+        weight is the fraction of the pixel's value this intersection makes up
+        """
+        bounce_ray = self.get_bounced_ray(ray, intersection)
+        return (self.reflectivity * world.render_reflection(bounce_ray, bouncenum+1, weight * self.reflectivity) +
+                (1 - self.reflectivity) * world.render_light(intersection, ray, self))
+
+    def render_intersections(self, points, origins, directions, world, bouncenum, lights):
+        values = (1 - self.reflectivity) * lights
+        return values, numpy.repeat(float(self.reflectivity), len(points))
 
 class Checkerboard(Solid):
     """A depth-less plane"""
@@ -36,68 +344,86 @@ class Checkerboard(Solid):
         self.normal = numpy.cross(self.ray1[1] - self.ray1[0], self.ray2[1] - self.ray1[0])
         self.reflectivity = reflectivity
 
+        # constants used for every ray
+        self.unit_normal = self.normal / numpy.linalg.norm(self.normal)
+        self.offset = float(numpy.dot(self.unit_normal, self.ray1[0]))
+        self.unit_normal_floats = tuple(self.unit_normal.tolist())
+        self.axis1 = self.ray1[1] - self.ray1[0]
+        self.axis2 = self.ray2[1] - self.ray2[0]
+        self.axis_length1 = vectormath.get_distance(*self.ray1)
+        self.axis_length2 = vectormath.get_distance(*self.ray2)
+        self.color_floats = tuple(self.ray1[0].tolist() + self.axis1.tolist() + self.axis2.tolist() +
+                [float(self.axis_length1), float(self.axis_length2)])
+
+    def get_scene_values(self):
+        return ('Checkerboard', self.ray1, self.ray2, self.reflectivity)
+
     def get_normal_ray(self, point):
         return (point, point+self.normal)
 
+    def get_unit_normal(self, point):
+        return self.unit_normal
+
     def get_intersections(self, ray):
-        r = vectormath.get_line_intersections_with_plane(ray, (self.ray1[0], self.ray1[1], self.ray2[1]))
-        return r
+        origin = numpy.array([ray[0]], dtype=numpy.float_)
+        direction = numpy.array([ray[1]], dtype=numpy.float_) - origin
+        t = vectormath.get_rays_ts_with_plane(origin, direction, self.unit_normal, self.offset)
+        return [origin[0] + direction[0]*t[0]]
 
-    def get_bounced_ray(self, ray, intersection):
-        """Returns a ray refleced across the normal at a point
-        """
-        intersection = numpy.array(intersection, dtype=numpy.float_)
-        ray = numpy.array(ray)
-        normal_ray = self.get_normal_ray(intersection)
-        n_vec = normal_ray[1] - normal_ray[0]
-        unit_n_vec = n_vec / numpy.linalg.norm(n_vec)
-        ray_vec = ray[1] - ray[0]
-        unit_ray_vec = ray_vec / numpy.linalg.norm(ray_vec)
-        bounce_vec = unit_ray_vec - 2 * unit_n_vec * (numpy.dot(unit_ray_vec, unit_n_vec))
-        result = (intersection, intersection + bounce_vec)
-        return result
+    def get_ray_t(self, origin, direction, min_t=0.):
+        nx, ny, nz = self.unit_normal_floats
+        return kernels.get_plane_t(origin[0], origin[1], origin[2], direction[0], direction[1], direction[2],
+                nx, ny, nz, self.offset, min_t)
+
+    def get_ray_ts(self, origins, directions, out=None):
+        if out is not None:
+            out = out[0]
+        return vectormath.get_rays_ts_with_plane(origins, directions, self.unit_normal, self.offset, out)[numpy.newaxis]
+
+    def get_normal_rays(self, points):
+        return points, points + self.normal
+
+    def get_unit_normals(self, points, parts=None):
+        return numpy.broadcast_to(self.unit_normal, points.shape)
 
     def __repr__(self):
         return ' Checkerboard of rays '+str(tuple(self.ray1))+' and '+str(tuple(self.ray2))
 
-    def render_intersection(self, intersection, ray, world, bouncenum):
-        """Returns the value to render, possibly by recusively rendering reflections"""
-        global bounces
-        bounces.append(self)
-
-        # getting color
-        r1mod = (vectormath.get_projection_of_ray_onto_ray(
-                [self.ray1[0], intersection],
-                self.ray1
-                ) % vectormath.get_distance(*self.ray1))
-        r2mod = (vectormath.get_projection_of_ray_onto_ray(
-                [self.ray2[0], intersection],
-                self.ray2
-                ) % vectormath.get_distance(*self.ray2))
-        if (numpy.floor(r1mod) + numpy.floor(r2mod)) % 2 == 0:
-            color = 0
-        else:
-            color = 1
-        if bouncenum > BOUNCELIMIT:
-            print 'bouncelimit acheived, ignoring further reflections for this ray'
-            print bounces
-            bounces = []
-            return self.color * .5 + self.color * .5 * world.render_light(intersection, ray)
-        else:
-            bounce_ray = self.get_bounced_ray(ray, intersection)
+    def render_intersection(self, intersection, ray, world, bouncenum, weight=1.0):
+        """Returns the value to render, possibly by recusively rendering reflections
+
+        weight is the fraction of the pixel's value this intersection makes up
+        """
+        px, py, pz = numpy.asarray(intersection, dtype=numpy.float_).tolist()
+        color = kernels.get_checker_color(px, py, pz, *self.color_floats)
+        bounce_ray = self.get_bounced_ray(ray, intersection)
 
         v = (
                 color * .5 +
-                self.reflectivity/2 * world.render_ray(bounce_ray, bouncenum+1) +
-                color * (1 - self.reflectivity/2) * world.render_light(intersection, ray)
+                self.reflectivity/2 * world.render_reflection(bounce_ray, bouncenum+1, weight * self.reflectivity/2) +
+                color * (1 - self.reflectivity/2) * world.render_light(intersection, ray, self)
                 )
         return v
 
+    def get_colors(self, points):
+        """Returns 0 or 1 for each of an (N, 3) array of points on the checkerboard"""
+        offsets = points - self.ray1[0]
+        r1mod = (numpy.dot(offsets, self.axis1) / self.axis_length1) % self.axis_length1
+        r2mod = (numpy.dot(offsets, self.axis2) / self.axis_length2) % self.axis_length2
+        return (numpy.floor(r1mod) + numpy.floor(r2mod)) % 2
+
+    def render_intersections(self, points, origins, directions, world, bouncenum, lights):
+        colors = self.get_colors(points)
+        values = colors * .5 + colors * (1 - self.reflectivity/2) * lights
+        return values, numpy.repeat(self.reflectivity/2, len(points))
+
 class Sphere(Solid):
     """Represents a sphere object in a 3d world
 
     >>> Sphere((0,0,0), 1).get_first_intersection(((4,0,0), (3,0,0)))
     (1.0, 0.0, 0.0)
+    >>> Sphere((0,0,0), 1).get_ray_t((0., 0, 0), (0., 0, 2))
+    0.5
     """
     def __init__(self, center, radius, reflectivity=.5, color=None):
         self.center = numpy.array(center, dtype=numpy.float_)
@@ -108,15 +434,35 @@ class Sphere(Solid):
             self.color = min(1, random.random() + .1)
         self.reflectivity = reflectivity
 
+        # constants used for every ray
+        self.center_square = float(vectormath.get_squared_lengths(self.center))
+        self.radius_square = self.radius**2
+        self.center_floats = tuple(self.center.tolist())
+
+    def get_bounds(self):
+        """
+        >>> Sphere((1,0,0), 2).get_bounds()[0].tolist()
+        [-1.0, -2.0, -2.0]
+        """
+        return self.center - self.radius, self.center + self.radius
+
+    def get_scene_values(self):
+        """color is left out, as it doesn't change how a sphere renders"""
+        return ('Sphere', self.center, self.radius, self.reflectivity)
+
     def get_first_intersection(self, ray):
-        line_intersections = self.get_intersections(ray)
-        if len(line_intersections) == 1:
-            return line_intersections[0]
-        elif len(line_intersections) == 0:
+        """Returns the nearest point where ray enters or leaves the sphere
+        ahead of its origin, or None"""
+        (x, y, z), (dx, dy, dz), length = bvh.get_line(ray)
+        t = self.get_ray_t((x, y, z), (dx, dy, dz))
+        if numpy.isnan(t):
             return None
-        else:
-            line_intersections.sort(key=lambda x: vectormath.get_distance(ray[0], x))
-            return line_intersections[0]
+        return (x + t*dx, y + t*dy, z + t*dz)
+
+    def get_ray_t(self, origin, direction, min_t=0.):
+        cx, cy, cz = self.center_floats
+        return kernels.get_sphere_t(origin[0], origin[1], origin[2], direction[0], direction[1], direction[2],
+                cx, cy, cz, self.center_square, self.radius_square, min_t)
 
     def get_intersections(self, ray):
         line_intersections = vectormath.get_line_intersections_with_sphere(ray, self.center, self.radius)
@@ -125,98 +471,122 @@ class Sphere(Solid):
     def get_normal_ray(self, point):
         return (self.center, point)
 
-    def get_bounced_ray(self, ray, intersection):
-        """Returns a ray refleced across the normal at a point
+    def get_unit_normal(self, point):
+        return (point - self.center) / self.radius
 
-        >>> s = Sphere((0,0,0), 1)
-        >>> s.get_bounced_ray(((0, 0, 4), (0, 0, 3)), (0, 0, 1))
-        (array([ 0.,  0.,  1.]), array([ 0.,  0.,  2.]))
-        >>> s.get_bounced_ray(((0, 3, 4), (0, 2, 3)), (0, 0, 1))
-        (array([ 0.,  0.,  1.]), array([ 0... -0.7...1.7...]))
+    def get_ray_ts(self, origins, directions, out=None):
+        return vectormath.get_rays_ts_with_sphere(origins, directions, self.center,
+                self.center_square, self.radius_square, out)
 
-        """
-        intersection = numpy.array(intersection, dtype=numpy.float_)
-        ray = numpy.array(ray)
-        normal_ray = self.get_normal_ray(intersection)
-        n_vec = normal_ray[1] - normal_ray[0]
-        unit_n_vec = n_vec / numpy.linalg.norm(n_vec)
-        ray_vec = ray[1] - ray[0]
-        unit_ray_vec = ray_vec / numpy.linalg.norm(ray_vec)
-        bounce_vec = unit_ray_vec - 2 * unit_n_vec * (numpy.dot(unit_ray_vec, unit_n_vec))
-        result = (intersection, intersection + bounce_vec)
-        return result
+    def get_normal_rays(self, points):
+        return numpy.broadcast_to(self.center, points.shape), points
+
+    def get_unit_normals(self, points, parts=None):
+        return (points - self.center) / self.radius
 
     def __repr__(self):
         return ' Sphere of radius '+str(self.radius)+' at '+str(self.center)
 
-    def render_intersection(self, intersection, ray, world, bouncenum):
-        """Returns the value to render, possibly by recusively rendering reflections"""
-        global bounces
-        bounces.append(self)
+    def render_intersection(self, intersection, ray, world, bouncenum, weight=1.0):
+        """Returns the value to render, possibly by recusively rendering reflections
+
+        weight is the fraction of the pixel's value this intersection makes up
+        """
         bounce_ray = self.get_bounced_ray(ray, intersection)
-        if bouncenum > BOUNCELIMIT:
-            print 'bouncelimit acheived, ignoring further reflections for this ray'
-            print bounces
-            bounces = []
-            return self.color
+        reflection = world.render_reflection(bounce_ray, bouncenum+1, weight * self.reflectivity)
+        light = world.render_light(intersection, ray, self)
         v = (
                 (0.0) * self.color +
-                self.reflectivity * world.render_ray(bounce_ray, bouncenum+1) +
-                (1 - self.reflectivity) * world.render_light(intersection, ray)
+                self.reflectivity * reflection +
+                (1 - self.reflectivity) * light
                 )
         if v < 0:
-            print 'from self:', (0.0) * self.color
-            print 'from reflection:', self.reflectivity * world.render_ray(bounce_ray, bouncenum+1)
-            print 'from light source:', (1 - self.reflectivity) * world.render_light(intersection, ray)
-            print 'reflectivity of ', self.reflectivity
-            raw_input()
+            log.debug('negative value %s at %s on%s: %s from self, %s from reflection, %s from light source',
+                    v, intersection, self, (0.0) * self.color, self.reflectivity * reflection,
+                    (1 - self.reflectivity) * light)
         return v
 
+    def render_intersections(self, points, origins, directions, world, bouncenum, lights):
+        values = (1 - self.reflectivity) * lights
+        return values, numpy.repeat(float(self.reflectivity), len(points))
+
 class Light(object):
     """Point light source for evaluating light on surfaces.
     This light never bounces.
 
+    A point facing it gets brightness times the cosine of the angle the
+    light comes in at. With radius set the light fades smoothly to nothing
+    at that distance, and farther points aren't tested against it at all.
+
     >>> l = Light((0,0,-10))
     >>> l
      Light at [  0.   0. -10.]
-    >>> l.get_light_theta(((0,0,0),(0,0,-1)))
-    3.1415...
-    >>> l.get_light_theta(((0,0,0),(1,0,0)))
-    1.5707...
+    >>> Light((0,0,-10), .5, radius=20)
+     Light at [  0.   0. -10.] with brightness 0.5 and radius 20
     """
-    def __init__(self, position):
+    def __init__(self, position, brightness=1, radius=None):
         self.position = numpy.array(position, dtype=numpy.float_)
-        self.brightness = 1
+        self.brightness = brightness
+        self.radius = radius
+        self.position_floats = tuple(self.position.tolist())
 
     def __repr__(self):
-        return ' Light at '+str(self.position)
-
-    def get_light_theta(self, normal_ray):
-        """Returns the light level contributed by this light"""
-        normal_ray = numpy.array(normal_ray, dtype=numpy.float_)
-        intersection = normal_ray[0]
-        light_vec = intersection - self.position
-        unit_light_vec = light_vec / numpy.linalg.norm(light_vec)
-        n_vec = normal_ray[1] - normal_ray[0]
-        unit_n_vec = n_vec / numpy.linalg.norm(n_vec)
-        r = numpy.arccos(numpy.dot(unit_light_vec, unit_n_vec))
-        return r
+        s = ' Light at '+str(self.position)
+        if self.brightness != 1 or self.radius is not None:
+            s += ' with brightness '+str(self.brightness)
+        if self.radius is not None:
+            s += ' and radius '+str(self.radius)
+        return s
 
-    def get_light_contribution(self, requested_intersection, ray, world):
-        result = world.get_first_ray_intersection(ray)
-        if result:
-            obj, intersection = result
-        else:
-            return 0
-            print 'got no intersection result'
-        SAME_INTERSECTION_TOLERANCE = .00001
-        if vectormath.get_distance(intersection, requested_intersection) < SAME_INTERSECTION_TOLERANCE:
-            normal_ray = obj.get_normal_ray(intersection)
-            theta = self.get_light_theta(normal_ray)
-            return max(0.0, numpy.cos(theta))
-        else:
-            print 'different intersection found - this point is in shadow!'
-            return 0
+    def get_scene_values(self):
+        return (self.position, self.brightness, self.radius)
+
+    def get_attenuation(self, squared_distance):
+        """Returns the fraction of the light's brightness reaching a point
+        at squared_distance from it"""
+        if self.radius is None:
+            return 1.
+        return lighting.get_attenuations(squared_distance, self.radius)
+
+    def get_light_contribution(self, requested_intersection, ray, world, obj=None):
+        """Returns the light level contributed by this light at a point on obj,
+        zero if the point faces away from the light or is in shadow
+
+        The side of the surface lit is the one ray came from. If obj isn't
+        given it's found by tracing ray again
+
+        >>> floor = Checkerboard(((0,0,0), (1,0,0)), ((0,0,0), (0,0,1)))
+        >>> flipped = Checkerboard(((0,0,0), (0,0,1)), ((0,0,0), (1,0,0)))
+        >>> ray = ((0, 5, -5), (0, 0, 0))
+        >>> [Light((0, 5, 0)).get_light_contribution((0, 0, 0), ray, World(), board) for board in (floor, flipped)]
+        [1.0, 1.0]
+        """
+        if obj is None:
+            result = world.get_first_ray_intersection(ray)
+            if not result:
+                return 0
+            obj = result[0]
+        intersection = numpy.array(requested_intersection, dtype=numpy.float_)
+        px, py, pz = intersection.tolist()
+        nx, ny, nz = obj.get_unit_normal(intersection).tolist()
+        dx, dy, dz = numpy.subtract(ray[1], ray[0], dtype=numpy.float_).tolist()
+        if nx*dx + ny*dy + nz*dz > 0:
+            nx, ny, nz = -nx, -ny, -nz
+        lx, ly, lz = self.position_floats
+        cos_theta = kernels.get_cos_theta(px, py, pz, nx, ny, nz, lx, ly, lz)
+        if cos_theta <= 0:
+            return 0.0
+        value = self.brightness * cos_theta
+        if self.radius is not None:
+            value *= self.get_attenuation((lx - px)**2 + (ly - py)**2 + (lz - pz)**2)
+            if value <= 0:
+                return 0.0
+
+        # start the shadow ray just off the surface so it can't hit it
+        shadow_origin = kernels.get_shadow_origin(px, py, pz, nx, ny, nz, vectormath.RAY_EPSILON)
+        if world.is_ray_blocked((shadow_origin, self.position_floats)):
+            return 0.0
+        return value
 
 class View(object):
     """Represents a camera, and a rectangle on a plane, between which rays can be traced
@@ -249,20 +619,79 @@ class View(object):
         self.unit_w_vec = self.w_vec / numpy.linalg.norm(self.w_vec)
         self.unit_h_vec = self.h_vec / numpy.linalg.norm(self.h_vec)
 
-    def get_ray_generator(self, num_x_samples, num_y_samples, width, height):
-        """Returns evenly spaced rays for rendering"""
+    @classmethod
+    def from_camera(cls, camera_position, target, distance=4, up=(0,1,0)):
+        """Returns a view from camera_position looking at target, with its
+        view plane distance in front of the camera and its up vector as
+        close to up as the direction it's looking allows
+
+        >>> v = View.from_camera((0,0,-5), (0,0,0), 4)
+        >>> v.camera_position.tolist(), v.screen_width_ray[0].tolist(), v.unit_w_vec.tolist()
+        ([0.0, 0.0, -5.0], [0.0, 0.0, -1.0], [1.0, 0.0, 0.0])
+        """
+        camera_position = numpy.array(camera_position, dtype=numpy.float_)
+        forward = numpy.subtract(target, camera_position)
+        forward /= numpy.linalg.norm(forward)
+        w_vec = numpy.cross(up, forward)
+        w_vec /= numpy.linalg.norm(w_vec)
+        h_vec = numpy.cross(forward, w_vec)
+        center = tuple(camera_position + forward * distance)
+        return cls((center, tuple(center + w_vec)), (center, tuple(center + h_vec)), -distance)
+
+    def get_ray_generator(self, num_x_samples, num_y_samples, width, height, start_row=0, end_row=None):
+        """Returns evenly spaced rays for rendering
+
+        start_row and end_row limit the rays to a band of rows, counted
+        from the bottom of the image
+        """
 
         view_start = (self.screen_width_ray[0] -
                 (width * self.unit_w_vec/2) -
                 (height * self.unit_h_vec/2))
 
-        for row in xrange(num_y_samples):
+        if end_row is None:
+            end_row = num_y_samples
+        for row in xrange(start_row, end_row):
             for col in xrange(num_x_samples):
                 point = (view_start +
                         self.unit_w_vec * (float(width) * col / (num_x_samples - 1)) +
                         self.unit_h_vec * (float(height) * row / (num_y_samples - 1)))
                 yield (self.camera_position, point)
 
+    def get_ray_arrays(self, num_x_samples, num_y_samples, width, height, start_row=0, end_row=None):
+        """Returns (N, 3) arrays of origins and directions of the rays
+        get_ray_generator would yield, in the same order
+
+        >>> v = View(((0,0,3), (1,0,3)), ((0,0,3), (0,1,3)), 2)
+        >>> origins, directions = v.get_ray_arrays(10, 10, 20, 20)
+        >>> origins.shape, directions[0].tolist()
+        ((100, 3), [-10.0, -10.0, -2.0])
+        >>> v.get_ray_arrays(10, 10, 20, 20, 9)[1][0].tolist()
+        [-10.0, 10.0, -2.0]
+        """
+        if end_row is None:
+            end_row = num_y_samples
+        rows, cols = numpy.mgrid[start_row:end_row, 0:num_x_samples]
+        points = self.get_pixel_points(num_x_samples, num_y_samples, width, height,
+                cols.flatten(), rows.flatten())
+        origins = numpy.repeat(self.camera_position[numpy.newaxis], len(points), axis=0)
+        return origins, points - origins
+
+    def get_pixel_points(self, num_x_samples, num_y_samples, width, height, cols, rows):
+        """Returns an (N, 3) array of the points on the view plane that rays
+        for the pixels at cols and rows (counted from the bottom) go through
+
+        >>> v = View(((0,0,3), (1,0,3)), ((0,0,3), (0,1,3)), 2)
+        >>> v.get_pixel_points(10, 10, 20, 20, numpy.array([0, 9]), numpy.array([9, 0])).tolist()
+        [[-10.0, 10.0, 3.0], [10.0, -10.0, 3.0]]
+        """
+        view_start = (self.screen_width_ray[0] -
+                (width * self.unit_w_vec/2) -
+                (height * self.unit_h_vec/2))
+        col_offsets = self.unit_w_vec * (float(width) * cols / (num_x_samples - 1))[:, numpy.newaxis]
+        row_offsets = self.unit_h_vec * (float(height) * rows / (num_y_samples - 1))[:, numpy.newaxis]
+        return (view_start + col_offsets) + row_offsets
+
     def __repr__(self):
         return (' View at '+str(self.camera_position)+' pointed at '+
                 str(self.screen_height_ray[0]) +
@@ -274,140 +703,555 @@ class World(object):
         self.objects = []
         self.views = []
         self.lights = []
+        self.bvh = None
+        self.light_index = None
+        self.settings = RenderSettings()
+        self.random = self.settings.get_random()
+        self.stats = None # a RenderStats to count work on during a render
 
     def add_view(self, view):
         self.views.append(view)
 
     def add_object(self, obj):
         self.objects.append(obj)
+        self.bvh = None
 
     def add_light(self, light):
         self.lights.append(light)
+        self.light_index = None
 
-    def get_first_ray_intersection(self, ray):
-        intersections = []
-        for obj in self.objects:
-            intersections.extend([obj, intersect] for intersect in obj.get_intersections(ray))
+    def get_scene(self):
+        """Returns everything in the world that affects how it renders, as
+        nested tuples of names, numbers and arrays"""
+        return (tuple(obj.get_scene_values() for obj in self.objects),
+                tuple(light.get_scene_values() for light in self.lights))
 
-        def object_intersection_sort_method(x):
-            obj, intersection = x
-            proj = vectormath.get_projection_of_ray_onto_ray((ray[0], intersection), ray)
-            if proj < .0001: # behind object - return inf so goes to back of list
-                return float('inf')
-            else:
-                return proj
-        intersections.sort(key=object_intersection_sort_method)
-        if intersections and object_intersection_sort_method(intersections[0]) < float('inf'):
-            return intersections[0] # this is an (object, intersection) pair
-        else:
+    def get_bvh(self):
+        """Returns the bounding volume hierarchy over self.objects, building
+        it if objects have been added since it was last built"""
+        if self.bvh is None or self.bvh.num_objects != len(self.objects):
+            self.bvh = bvh.BVH(self.objects)
+        return self.bvh
+
+    def get_light_index(self):
+        """Returns the lighting.LightIndex of self.lights, building it if
+        lights have been added since it was last built"""
+        if self.light_index is None or self.light_index.num_lights != len(self.lights):
+            self.light_index = lighting.LightIndex(self.lights)
+        return self.light_index
+
+    def is_lighting_culled(self):
+        """Returns whether lights are found through the light index, rather
+        than every light being tried at every point"""
+        return self.settings.light_samples is not None or len(self.get_light_index().bounded) > 0
+
+    def get_first_ray_intersection(self, ray):
+        stats = self.stats
+        if stats is not None:
+            start = time.time()
+        tree = self.get_bvh()
+        line = bvh.get_line(ray)
+        best = None
+        for i in tree.unbounded:
+            best = bvh.get_nearest_hit(line, i, self.objects[i], best, stats)
+        best = tree.get_first_ray_intersection(line, self.objects, best, stats)
+        if stats is not None:
+            stats.add_time('intersection', time.time() - start)
+        if best is None:
             return None
+        proj, i, t = best
+        (x, y, z), (dx, dy, dz), length = line
+        return self.objects[i], numpy.array([x + t*dx, y + t*dy, z + t*dz])
 
-    def render_ray(self, ray, bouncenum):
+    def render_ray(self, ray, bouncenum, weight=1.0):
         result = self.get_first_ray_intersection(ray)
+        if self.stats is not None:
+            self.stats.count_rays(bouncenum, 1, 1 if result else 0)
 
         if result:
             obj, intersection = result
-            return obj.render_intersection(intersection, ray, self, bouncenum)
+            return obj.render_intersection(intersection, ray, self, bouncenum, weight)
         else:
             return self.render_no_intersection_value(ray)
 
+    def render_reflection(self, ray, bouncenum, weight):
+        """Renders a reflected ray which makes up weight of a pixel's value,
+        unless self.settings say it's too deep or too faint to trace"""
+        settings = self.settings
+        estimate = self.render_no_intersection_value(ray)
+        if bouncenum - 1 > settings.max_depth:
+            return estimate
+        if settings.roulette_weight is not None and weight < settings.roulette_weight:
+            probability = weight / settings.roulette_weight
+            if self.random.random_sample() >= probability:
+                return estimate
+            value = self.render_ray(ray, bouncenum, settings.roulette_weight)
+            return estimate + (value - estimate) / probability
+        if settings.roulette_weight is None and weight < settings.min_weight:
+            return estimate
+        return self.render_ray(ray, bouncenum, weight)
+
     def render_no_intersection_value(self, ray):
         return .05
 
-    def render_light(self, intersection, ray):
+    def render_light(self, intersection, ray, obj=None):
+        if self.stats is not None:
+            start = time.time()
         value = 0
-        for light in self.lights:
-            value += light.get_light_contribution(intersection, ray, self)
+        if not self.is_lighting_culled():
+            for light in self.lights:
+                value += light.get_light_contribution(intersection, ray, self, obj)
+        else:
+            if obj is None:
+                result = self.get_first_ray_intersection(ray)
+                obj = result[0] if result else None
+            if obj is not None:
+                points = numpy.array([intersection], dtype=numpy.float_)
+                directions = numpy.subtract([ray[1]], [ray[0]], dtype=numpy.float_)
+                unit_normals = vectormath.get_facing_normals(obj.get_unit_normals(points), directions)
+                value = self.get_light_values(points, unit_normals)[0]
+        if self.stats is not None:
+            self.stats.add_time('lighting', time.time() - start)
         return value
 
+    def is_ray_blocked(self, ray):
+        """Returns whether any object lies between the two points of ray"""
+        stats = self.stats
+        if stats is not None:
+            start = time.time()
+        tree = self.get_bvh()
+        line = bvh.get_line(ray)
+        max_proj = line[2]
+        blocked = (any(bvh.is_blocking(line, self.objects[i], max_proj, stats) for i in tree.unbounded) or
+                tree.is_ray_blocked(line, self.objects, max_proj, stats))
+        if stats is not None:
+            stats.count_shadow_rays(1, int(blocked))
+            stats.add_time('shadow', time.time() - start)
+        return blocked
+
+    def get_blocked_rays(self, origins, directions):
+        """Batched is_ray_blocked for rays from origins to origins + directions,
+        returning an array of bools"""
+        stats = self.stats
+        if stats is not None:
+            start = time.time()
+        tree = self.get_bvh()
+        max_projs = numpy.sqrt(numpy.sum(directions**2, axis=1))
+        blocked = numpy.zeros(len(origins), dtype=bool)
+        all_rays = numpy.arange(len(origins))
+        for i in tree.unbounded:
+            bvh.update_blocked_rays(i, self.objects[i], origins, directions, all_rays[~blocked],
+                    max_projs, blocked, stats)
+        tree.update_blocked_rays(self.objects, origins, directions, max_projs, blocked, stats,
+                self.get_packets(origins, directions))
+        if stats is not None:
+            stats.count_shadow_rays(len(origins), int(blocked.sum()))
+            stats.add_time('shadow', time.time() - start)
+        return blocked
+
+    def get_packets(self, origins, directions):
+        """Returns the packets to trace rays through the BVH in, or None to
+        trace them all as one
+
+        >>> w = World()
+        >>> for x in range(-3, 4):
+        ...     w.add_object(Sphere((x, 0, 0), .4))
+        >>> w.add_light(Light((0, 10, -10)))
+        >>> whole = w.render_view_values(getTestView(), 24, 24, 8, 8, batch=True)
+        >>> w.settings = RenderSettings(packet_rays=32)
+        >>> (w.render_view_values(getTestView(), 24, 24, 8, 8, batch=True) == whole).all()
+        True
+        """
+        if self.settings.packet_rays is None:
+            return None
+        return packets.get_packets(origins, directions, self.settings.packet_rays)
+
+    def get_first_ray_intersections(self, origins, directions):
+        """Batched get_first_ray_intersection
+
+        Returns an array of indices into self.objects (-1 where nothing was
+        hit), an (N, 3) array of the intersection points and an array of the
+        part of the object each ray hit, see Solid.get_ray_hits
+        """
+        stats = self.stats
+        if stats is not None:
+            start = time.time()
+        tree = self.get_bvh()
+        best_projs = numpy.repeat(numpy.inf, len(origins))
+        best_objects = numpy.repeat(-1, len(origins))
+        best_points = numpy.zeros((len(origins), 3))
+        best_parts = numpy.zeros(len(origins), dtype=numpy.int_)
+        all_rays = numpy.arange(len(origins))
+        for i in tree.unbounded:
+            bvh.update_nearest_hits(i, self.objects[i], origins, directions, all_rays,
+                    best_projs, best_objects, best_points, stats, best_parts)
+        tree.update_first_ray_intersections(self.objects, origins, directions,
+                best_projs, best_objects, best_points, stats, self.get_packets(origins, directions), best_parts)
+        if stats is not None:
+            stats.add_time('intersection', time.time() - start)
+        return best_objects, best_points, best_parts
+
+    def render_rays(self, origins, directions, bouncenum, weights=None):
+        """Batched render_ray for (N, 3) arrays of ray origins and directions
+
+        Reflected rays from every object hit are traced together, so each
+        bounce is one batch of rays
+        """
+        if weights is None:
+            weights = numpy.ones(len(origins))
+        values = numpy.empty(len(origins))
+        if not len(origins):
+            return values
+        hit_objects, points, hit_parts = self.get_first_ray_intersections(origins, directions)
+        values[hit_objects == -1] = self.render_no_intersection_value(None)
+        if self.stats is not None:
+            self.stats.count_rays(bouncenum, len(origins), int(numpy.count_nonzero(hit_objects != -1)))
+
+        # group rays by the object they hit
+        order = numpy.argsort(hit_objects, kind='mergesort')
+        starts = numpy.flatnonzero(numpy.diff(hit_objects[order])) + 1
+        groups = [group for group in numpy.split(order, starts) if hit_objects[group[0]] != -1]
+
+        # light the points hit on every object together, so each light's
+        # shadow rays for the whole bounce are traced as one batch
+        hit = numpy.flatnonzero(hit_objects != -1)
+        unit_normals = numpy.empty((len(origins), 3))
+        for group in groups:
+            unit_normals[group] = self.objects[hit_objects[group[0]]].get_unit_normals(points[group],
+                    hit_parts[group])
+        lights = numpy.zeros(len(origins))
+        lights[hit] = self.render_light_values(points[hit],
+                vectormath.get_facing_normals(unit_normals[hit], directions[hit]))
+
+        reflectivities = numpy.zeros(len(origins))
+        bounce_origins = numpy.empty((len(origins), 3))
+        bounce_directions = numpy.empty((len(origins), 3))
+        for group in groups:
+            obj = self.objects[hit_objects[group[0]]]
+            values[group], reflectivities[group] = obj.render_intersections(
+                    points[group], origins[group], directions[group], self, bouncenum, lights[group])
+            group = group[reflectivities[group] != 0]
+            bounce_origins[group], bounce_directions[group] = obj.get_bounced_rays(points[group], directions[group],
+                    hit_parts[group])
+
+        bouncing = numpy.flatnonzero(reflectivities)
+        values[bouncing] += reflectivities[bouncing] * self.render_reflections(
+                bounce_origins[bouncing], bounce_directions[bouncing], bouncenum+1,
+                weights[bouncing] * reflectivities[bouncing])
+        return values
+
+    def render_reflections(self, origins, directions, bouncenum, weights):
+        """Batched render_reflection"""
+        settings = self.settings
+        values = numpy.repeat(float(self.render_no_intersection_value(None)), len(origins))
+        if bouncenum - 1 > settings.max_depth:
+            return values
+        if settings.roulette_weight is None:
+            traced = numpy.flatnonzero(weights >= settings.min_weight)
+            values[traced] = self.render_rays(origins[traced], directions[traced], bouncenum, weights[traced])
+            return values
+        probabilities = numpy.minimum(1.0, weights / settings.roulette_weight)
+        traced = numpy.flatnonzero(self.random.random_sample(len(origins)) < probabilities)
+        traced_values = self.render_rays(origins[traced], directions[traced], bouncenum,
+                weights[traced] / probabilities[traced])
+        values[traced] += (traced_values - values[traced]) / probabilities[traced]
+        return values
+
+    def render_light_values(self, points, unit_normals):
+        """Returns the light reaching (N, 3) points on surfaces facing
+        unit_normals, tracing each light's shadow rays as one batch"""
+        if self.stats is not None:
+            start = time.time()
+        if self.is_lighting_culled():
+            values = self.get_light_values(points, unit_normals)
+        else:
+            values = numpy.zeros(len(points))
+            for light in self.lights:
+                light_vecs = light.position - points
+                cos_thetas = (numpy.sum(light_vecs * unit_normals, axis=1) /
+                        numpy.sqrt(numpy.sum(light_vecs**2, axis=1)))
+                lit = numpy.flatnonzero(cos_thetas > 0)
+                shadow_origins = (points[lit] +
+                        unit_normals[lit] * vectormath.get_ray_epsilons(points[lit])[:, numpy.newaxis])
+                lit = lit[~self.get_blocked_rays(shadow_origins, light.position - shadow_origins)]
+                values[lit] += light.brightness * cos_thetas[lit]
+        if self.stats is not None:
+            self.stats.add_time('lighting', time.time() - start)
+        return values
+
+    def get_light_values(self, points, unit_normals):
+        """Returns the light reaching (N, 3) points on surfaces facing
+        unit_normals from the lights self.get_light_index() finds near them,
+        or from samples of those with self.settings.light_samples set
+
+        >>> w = World()
+        >>> w.add_object(Checkerboard(((0,0,0), (0,0,1)), ((0,0,0), (1,0,0))))
+        >>> for x in range(-10, 11):
+        ...     w.add_light(Light((x, 1, 0), radius=3))
+        >>> points, unit_normals = numpy.array([[0., 0, 0], [30, 0, 0]]), numpy.array([[0., 1, 0]] * 2)
+        >>> exact = w.render_light_values(points, unit_normals)
+        >>> contributions = [light.get_light_contribution(points[0], ((0, 5, 0), (0, 0, 0)), w, w.objects[0])
+        ...         for light in w.lights]
+        >>> exact[1], abs(sum(contributions) - exact[0]) < 1e-12
+        (0.0, True)
+        >>> stats = RenderStats()
+        >>> with w.using_settings(RenderSettings(light_samples=2, seed=0), stats=stats):
+        ...     sampled = numpy.mean([w.get_light_values(points, unit_normals) for i in range(400)], axis=0)
+        >>> stats.shadow_rays, abs(sampled[0] - exact[0]) < .05 * exact[0], sampled[1]
+        (800, True, 0.0)
+        """
+        index = self.get_light_index()
+        values = numpy.zeros(len(points))
+        batch_points = index.get_batch_points()
+        for start in xrange(0, len(points), batch_points):
+            batch = slice(start, start + batch_points)
+            pair_points, pair_lights, weights = index.get_samples(points[batch], unit_normals[batch],
+                    self.settings.light_samples, self.random)
+            pair_origins = points[batch][pair_points]
+            shadow_origins = (pair_origins + unit_normals[batch][pair_points] *
+                    vectormath.get_ray_epsilons(pair_origins)[:, numpy.newaxis])
+            lit = ~self.get_blocked_rays(shadow_origins, index.positions[pair_lights] - shadow_origins)
+            values[batch] = numpy.bincount(pair_points[lit], weights[lit], minlength=len(values[batch]))
+        return values
+
+    def render_rows(self, view, w_samples, h_samples, viewscreen_width, viewscreen_height,
+            start_row, end_row, batch=True, settings=None, stats=None):
+        """Returns an (end_row - start_row, w_samples) array of values for
+        a band of rows, counted from the bottom of the image
+
+        settings, if given, are used instead of self.settings for this band,
+        and the work done is counted on stats if that's given
+        """
+        with self.using_settings(settings, start_row, stats):
+            if self.settings.samples > 1:
+                return self.render_supersampled_rows(view, w_samples, h_samples,
+                        viewscreen_width, viewscreen_height, start_row, end_row, batch)
+            if batch:
+                origins, directions = view.get_ray_arrays(w_samples, h_samples,
+                        viewscreen_width, viewscreen_height, start_row, end_row)
+                values = self.render_rays(origins, directions, 1)
+            else:
+                values = []
+                for row in xrange(start_row, end_row):
+                    for ray in view.get_ray_generator(w_samples, h_samples,
+                            viewscreen_width, viewscreen_height, row, row + 1):
+                        values.append(self.render_ray(ray, 1))
+                    sys.stderr.write(str(row + 1)+'/'+str(h_samples)+'\n')
+                values = numpy.array(values, dtype=numpy.float_)
+        return values.reshape(end_row - start_row, w_samples)
+
+    def render_supersampled_rows(self, view, w_samples, h_samples, viewscreen_width, viewscreen_height,
+            start_row, end_row, batch=True):
+        """render_rows with a grid of rays per pixel, refining only pixels at
+        edges if self.settings.adaptive_threshold is set"""
+        threshold = self.settings.adaptive_threshold
+        if threshold is None:
+            rows, cols = numpy.mgrid[start_row:end_row, 0:w_samples]
+            values = self.render_supersamples(view, w_samples, h_samples, viewscreen_width, viewscreen_height,
+                    cols.flatten(), rows.flatten(), batch)
+            return values.reshape(end_row - start_row, w_samples)
+
+        # the rows either side of the band are rendered too, so pixels at its
+        # edges are compared with all their neighbours
+        first_row = max(start_row - 1, 0)
+        last_row = min(end_row + 1, h_samples)
+        rows, cols = numpy.mgrid[first_row:last_row, 0:w_samples]
+        points = view.get_pixel_points(w_samples, h_samples, viewscreen_width, viewscreen_height,
+                cols.flatten(), rows.flatten())
+        centers = self.render_points(view, points, batch).reshape(last_row - first_row, w_samples)
+        values = centers[start_row - first_row:end_row - first_row]
+        rows, cols = numpy.nonzero(get_edge_pixels(centers, threshold)[start_row - first_row:end_row - first_row])
+        values[rows, cols] = self.render_supersamples(view, w_samples, h_samples,
+                viewscreen_width, viewscreen_height, cols, rows + start_row, batch)
+        return values
+
+    def render_supersamples(self, view, w_samples, h_samples, viewscreen_width, viewscreen_height,
+            cols, rows, batch=True):
+        """Returns values for the pixels at cols and rows, each the mean of
+        a grid of self.settings.samples by self.settings.samples rays
+
+        The rays of at most SUPERSAMPLE_BATCH_RAYS rays' worth of pixels
+        are traced at once.
+        """
+        samples = self.settings.samples
+        grid_rows, grid_cols = numpy.mgrid[0:samples, 0:samples]
+        values = numpy.empty(len(cols))
+        pixels_per_batch = max(1, SUPERSAMPLE_BATCH_RAYS // samples**2)
+        for start in xrange(0, len(cols), pixels_per_batch):
+            end = min(start + pixels_per_batch, len(cols))
+            if self.settings.jitter:
+                row_offsets = (grid_rows.flatten() + self.random.random_sample((end - start, samples**2))) / samples
+                col_offsets = (grid_cols.flatten() + self.random.random_sample((end - start, samples**2))) / samples
+            else:
+                row_offsets = (grid_rows.flatten()[numpy.newaxis] + .5) / samples
+                col_offsets = (grid_cols.flatten()[numpy.newaxis] + .5) / samples
+            sample_rows = rows[start:end, numpy.newaxis] + (row_offsets - .5)
+            sample_cols = cols[start:end, numpy.newaxis] + (col_offsets - .5)
+            points = view.get_pixel_points(w_samples, h_samples, viewscreen_width, viewscreen_height,
+                    sample_cols.flatten(), sample_rows.flatten())
+            values[start:end] = self.render_points(view, points, batch).reshape(end - start, samples**2).mean(axis=1)
+        return values
+
+    def render_points(self, view, points, batch=True):
+        """Returns values of the rays from the camera through (N, 3) points
+        on the view plane"""
+        if batch:
+            origins = numpy.repeat(view.camera_position[numpy.newaxis], len(points), axis=0)
+            return self.render_rays(origins, points - origins, 1)
+        return numpy.array([self.render_ray((view.camera_position, point), 1) for point in points],
+                dtype=numpy.float_)
+
+    @contextlib.contextmanager
+    def using_settings(self, settings, start_row=0, stats=None):
+        """Renders with settings instead of self.settings inside a with block,
+        drawing random numbers for a band of rows starting at start_row and
+        counting work on stats"""
+        previous_settings = self.settings
+        if settings is not None:
+            self.settings = settings
+        self.random = self.settings.get_random(start_row)
+        self.stats = stats
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.settings = previous_settings
+            self.stats = None
+            if stats is not None:
+                stats.add_time('total', time.time() - start)
+
+    def render_pixels(self, view, w_samples, h_samples, viewscreen_width, viewscreen_height,
+            cols, rows, batch=True, settings=None, stats=None):
+        """Returns an array of values for the pixels at cols and rows, rows
+        counted from the bottom of the image"""
+        with self.using_settings(settings, rows[0] if len(rows) else 0, stats):
+            if self.settings.samples > 1:
+                return self.render_supersamples(view, w_samples, h_samples, viewscreen_width, viewscreen_height,
+                        cols, rows, batch)
+            points = view.get_pixel_points(w_samples, h_samples, viewscreen_width, viewscreen_height, cols, rows)
+            return self.render_points(view, points, batch)
+
+    def render_progressive(self, view, w_samples, h_samples, viewscreen_width, viewscreen_height,
+            batch=True, settings=None, steps=(8, 4, 2, 1), band_rows=16, preview_path=None, flush_seconds=10,
+            stats=None):
+        """Renders a view coarse to fine, yielding (values, fraction done)
+        every band_rows rows of each pass
+
+        The first pass renders every steps[0]th pixel of every steps[0]th row,
+        and each later pass the pixels of its finer grid not rendered yet, so
+        no pixel is rendered twice. values is an (h_samples, w_samples) array
+        with the first row at the top, in which pixels not rendered yet show
+        the nearest pixel of the last finished pass.
+
+        With preview_path set, the preview is saved there as a PNG after each
+        pass, and during a pass whenever flush_seconds have passed.
+        """
+        self.get_bvh()
+        values = numpy.zeros((h_samples, w_samples), dtype=FRAMEBUFFER_DTYPE)
+        done = numpy.zeros((h_samples, w_samples), dtype=bool)
+        all_rows, all_cols = numpy.mgrid[0:h_samples, 0:w_samples]
+        finished_step = None
+        last_flush = time.time()
+        for step in steps:
+            todo = (all_rows % step == 0) & (all_cols % step == 0) & ~done
+            for start_row in xrange(0, h_samples, band_rows * step):
+                rows, cols = numpy.nonzero(todo[start_row:start_row + band_rows * step])
+                if not len(rows):
+                    continue
+                rows += start_row
+                values[rows, cols] = self.render_pixels(view, w_samples, h_samples,
+                        viewscreen_width, viewscreen_height, cols, rows, batch, settings, stats)
+                done[rows, cols] = True
+                preview = get_preview(values, done, finished_step)
+                if preview_path is not None and time.time() - last_flush > flush_seconds:
+                    save_image(get_image(preview[::-1]), preview_path)
+                    last_flush = time.time()
+                yield preview[::-1], done.mean()
+            finished_step = step
+            if preview_path is not None:
+                save_image(get_image(get_preview(values, done, finished_step)[::-1]), preview_path)
+                last_flush = time.time()
+
+    def render_view_values(self, view, w_samples, h_samples, viewscreen_width, viewscreen_height,
+            batch=True, processes=None, settings=None, checkpoint_dir=None, stats=None):
+        """Renders a whole view, returning an (h_samples, w_samples)
+        FRAMEBUFFER_DTYPE array of values with the first row at the top of
+        the image
+
+        processes > 1 splits the view into bands of rows rendered by a pool
+        of that many worker processes. With checkpoint_dir set, finished rows
+        are saved there, and rows saved by an earlier run of the same render
+        aren't rendered again. Rays, intersection tests and time spent are
+        counted on stats, a RenderStats, if it's given.
+        """
+        if checkpoint_dir is not None:
+            values = checkpoint.render_rows(self, view, w_samples, h_samples,
+                    viewscreen_width, viewscreen_height, checkpoint_dir, batch, processes, settings, stats=stats)
+        elif processes and processes > 1:
+            values = parallel.render_rows(self, view, w_samples, h_samples,
+                    viewscreen_width, viewscreen_height, batch, processes, settings=settings, stats=stats)
+        else:
+            values = self.render_rows(view, w_samples, h_samples,
+                    viewscreen_width, viewscreen_height, 0, h_samples, batch, settings, stats)
+        return values[::-1].astype(FRAMEBUFFER_DTYPE)
+
     def debug_render_view(self, view, w_samples, h_samples, width, height):
         for ray in view.get_ray_generator(w_samples, h_samples, width, height):
             print ray
             print self.render_ray(ray, 1)
 
-    def render_images(self, w_samples, h_samples, viewscreen_width, viewscreen_height):
+    def render_images(self, w_samples, h_samples, viewscreen_width, viewscreen_height, batch=False, processes=None,
+            settings=None, path='/tmp/lastImage.png', checkpoint_dir=None):
         """"""
-        for view in self.views:
-            im = self.render_view(view, w_samples, h_samples, viewscreen_width, viewscreen_height)
-            im.save('/tmp/lastImage.png')
+        for i, view in enumerate(self.views):
+            view_checkpoint_dir = None
+            if checkpoint_dir is not None:
+                view_checkpoint_dir = os.path.join(checkpoint_dir, 'view'+str(i))
+            im = self.render_view(view, w_samples, h_samples, viewscreen_width, viewscreen_height, batch, processes,
+                    settings, view_checkpoint_dir)
+            im.save(path)
             im.show()
 
-    def render_asciis(self, w_samples, h_samples, viewscreen_width, viewscreen_height):
+    def render_asciis(self, w_samples, h_samples, viewscreen_width, viewscreen_height, batch=False, processes=None,
+            settings=None):
         """"""
         for view in self.views:
-            s = self.render_ascii(view, w_samples, h_samples, viewscreen_width, viewscreen_height)
+            s = self.render_ascii(view, w_samples, h_samples, viewscreen_width, viewscreen_height, batch, processes,
+                    settings)
             print
             print s
             print
 
-    def render_view(self, view, w_samples, h_samples, viewscreen_width, viewscreen_height):
+    def render_view(self, view, w_samples, h_samples, viewscreen_width, viewscreen_height, batch=False, processes=None,
+            settings=None, checkpoint_dir=None, stats=None, bits=8, gamma=1., clamp=True, values_path=None):
+        """Renders a view to an image
+
+        With batch=True all rays of the frame are traced together as arrays,
+        which is much faster and produces the same image. processes > 1
+        renders bands of rows in that many worker processes. settings is a
+        RenderSettings to use instead of self.settings, and can supersample
+        pixels to antialias edges. checkpoint_dir is
+        where to save finished rows so a killed render can be resumed.
+        stats is a RenderStats to count the render's work on.
+
+        bits, gamma and clamp are passed to get_image. With values_path set
+        the rendered values are also saved there as an .npy file.
+        """
         sys.stderr.write('Rendering view '+str(view)+'\n')
-        im = Image.new("1", (w_samples, h_samples))
-        pixels = im.load()
-        w_counter = 0
-        h_counter = 0
-        for ray in view.get_ray_generator(w_samples, h_samples, viewscreen_width, viewscreen_height):
-            global bounces
-            bounces = []
-            r = self.render_ray(ray, 1)
-            # height switches so as to correspond with PIL Image indexing,
-            #  so width corresponds to first view vector, height to the second
-
-            #TODO figure out what values Image wants in pixel array
-            pixels[w_counter, (h_samples - h_counter - 1)] = int(256*r)
-            w_counter = w_counter + 1
-            if w_counter == w_samples:
-                w_counter = 0
-                h_counter = h_counter + 1
-                sys.stderr.write(str(h_counter)+'/'+str(h_samples)+'\n')
-        return im
-
-    def render_ascii(self, view, w_samples, h_samples, viewscreen_width, viewscreen_height):
+        self.get_bvh()
+        values = self.render_view_values(view, w_samples, h_samples, viewscreen_width, viewscreen_height,
+                batch, processes, settings, checkpoint_dir, stats)
+        if values_path is not None:
+            save_values(values, values_path)
+        return get_image(values, bits, gamma, clamp)
+
+    def render_ascii(self, view, w_samples, h_samples, viewscreen_width, viewscreen_height, batch=False, processes=None,
+            settings=None, stats=None, gamma=1., clamp=True):
         sys.stderr.write('Rendering view '+str(view)+'\n')
-        im = numpy.zeros((h_samples, w_samples), dtype=numpy.character)
-        w_counter = 0
-        h_counter = 0
-
-        def get_ascii_char(r):
-            """Returns a representative ascii char based on a 0-1 value
-
-            Takes the whole pixel into account, not parts of it - hence
-            characters that change the intensity of the whole space are used
-            """
-            zeroToTen = int((r+.0499) * 10)
-            zeroToTenDict = {
-                    0:' ',
-                    1:'.',
-                    2:'-',
-                    3:'~',
-                    4:'o',
-                    5:'e',
-                    6:'O',
-                    8:'0',
-                    9:'&',
-                    10:'#',
-                    }
-            char = zeroToTenDict.get(zeroToTen, '?')
-            return char
-
-        for ray in view.get_ray_generator(w_samples, h_samples, viewscreen_width, viewscreen_height):
-            global bounces
-            bounces = []
-            r = self.render_ray(ray, 1)
-            # height switches so as to correspond with PIL Image indexing,
-            #  so width corresponds to first view vector, height to the second
-
-            im[(h_samples - h_counter - 1), w_counter] = get_ascii_char(r)
-            w_counter = w_counter + 1
-            if w_counter == w_samples:
-                w_counter = 0
-                h_counter = h_counter + 1
-                sys.stderr.write(str(h_counter)+'/'+str(h_samples)+'\n')
-        newlines = numpy.zeros((h_samples, 1), dtype=numpy.character)
-        newlines[:] = '\n'
-        with_newlines = numpy.hstack([im, newlines])
-        s = ''.join(with_newlines.flat)
-        return s
+        self.get_bvh()
+        values = self.render_view_values(view, w_samples, h_samples, viewscreen_width, viewscreen_height,
+                batch, processes, settings, stats=stats)
+        return get_ascii_text(values, gamma, clamp)
 
     def __repr__(self):
         s = 'World with views:'
@@ -418,6 +1262,168 @@ class World(object):
             s = s + '\n' + repr(obj)
         return s
 
+ASCII_CHARS = {
+        0:' ',
+        1:'.',
+        2:'-',
+        3:'~',
+        4:'o',
+        5:'e',
+        6:'O',
+        8:'0',
+        9:'&',
+        10:'#',
+        }
+
+def get_edge_pixels(values, threshold):
+    """Returns a bool array flagging the pixels whose value differs from
+    one of their four neighbours' by more than threshold
+
+    >>> get_edge_pixels(numpy.array([[0, 0, 0], [0, 0, 1.]]), .5).astype(int).tolist()
+    [[0, 0, 1], [0, 1, 1]]
+    """
+    edges = numpy.zeros(values.shape, dtype=bool)
+    across = numpy.abs(numpy.diff(values, axis=1)) > threshold
+    edges[:, 1:] |= across
+    edges[:, :-1] |= across
+    down = numpy.abs(numpy.diff(values, axis=0)) > threshold
+    edges[1:] |= down
+    edges[:-1] |= down
+    return edges
+
+def get_ascii_char(r):
+    """Returns a representative ascii char based on a 0-1 value
+
+    Takes the whole pixel into account, not parts of it - hence
+    characters that change the intensity of the whole space are used
+    """
+    zeroToTen = int((r+.0499) * 10)
+    char = ASCII_CHARS.get(zeroToTen, '?')
+    return char
+
+def get_ascii_chars(values):
+    """Array version of get_ascii_char
+
+    >>> get_ascii_chars(numpy.array([[0, .5], [.7, 1.]])).tolist()
+    [[' ', 'e'], ['?', '#']]
+    """
+    table = numpy.array([ASCII_CHARS.get(i, '?') for i in range(11)] + ['?'], dtype=numpy.character)
+    indices = ((values + .0499) * 10).astype(int)
+    indices[(indices < 0) | (indices > 10)] = 11
+    return table[indices]
+
+def get_ascii_text(values, gamma=1., clamp=True):
+    """Returns rendered values as lines of ASCII characters, gamma and
+    clamp as for get_tone_mapped
+
+    >>> get_ascii_text(numpy.array([[0., .5], [1, .25]]))
+    ' e\\n#-\\n'
+    """
+    im = get_ascii_chars(get_tone_mapped(values, gamma, clamp))
+    newlines = numpy.zeros((len(values), 1), dtype=numpy.character)
+    newlines[:] = '\n'
+    with_newlines = numpy.hstack([im, newlines])
+    return ''.join(with_newlines.flat)
+
+def get_tone_mapped(values, gamma=1., clamp=True):
+    """Returns values as a FRAMEBUFFER_DTYPE array from 0 to 1 for display
+
+    Values outside 0-1 are clipped to it, or with clamp False the values
+    are instead scaled down so the brightest is 1. gamma brightens (> 1)
+    or darkens (< 1) the values in between.
+
+    >>> get_tone_mapped(numpy.array([-.5, .25, 2]), 2).tolist()
+    [0.0, 0.5, 1.0]
+    >>> get_tone_mapped(numpy.array([0, 1, 2.]), clamp=False).tolist()
+    [0.0, 0.5, 1.0]
+    """
+    values = numpy.asarray(values, dtype=FRAMEBUFFER_DTYPE)
+    if not clamp and values.size and values.max() > 1:
+        values = values / values.max()
+    values = numpy.clip(values, 0, 1)
+    if gamma != 1:
+        values **= 1. / gamma
+    return values
+
+def get_image(values, bits=8, gamma=1., clamp=True):
+    """Returns a greyscale PIL image of an (h, w) array of values, or an
+    RGB one of an (h, w, 3) array, the first row at the top
+
+    rows of values match PIL Image indexing, so width corresponds to the
+    first view vector, height to the second. bits is 8 or, for greyscale
+    images, 16; gamma and clamp are passed to get_tone_mapped.
+
+    >>> im = get_image(numpy.array([[0, .5, 1, 2]]))
+    >>> im.mode, list(im.getdata())
+    ('L', [0, 128, 255, 255])
+    >>> im = get_image(numpy.array([[0, .5, 1, 2]]), 16)
+    >>> im.mode, list(im.getdata())
+    ('I;16', [0, 32768, 65535, 65535])
+    """
+    if bits not in (8, 16):
+        raise ValueError('Images can have 8 or 16 bits per channel, not '+str(bits))
+    if bits == 16 and numpy.ndim(values) == 3:
+        raise ValueError('RGB images can only have 8 bits per channel')
+    dtype = numpy.uint8 if bits == 8 else numpy.uint16
+    levels = get_tone_mapped(values, gamma, clamp) * numpy.iinfo(dtype).max + .5
+    return Image.fromarray(levels.astype(dtype))
+
+@contextlib.contextmanager
+def atomic_write(path):
+    """Yields a file that replaces path once the with block finishes, so
+    path is never left half written, even with other threads or processes
+    writing it at the same time
+
+    The file is made by tempfile.mkstemp, so it's only readable and
+    writable by its owner, whatever the umask: finding the umask means
+    setting it, which isn't safe with other threads running.
+
+    >>> path = os.path.join(tempfile.mkdtemp(), 'out.txt')
+    >>> with atomic_write(path) as f:
+    ...     f.write('partial')
+    ...     os.path.exists(path)
+    False
+    >>> open(path).read(), os.listdir(os.path.dirname(path))
+    ('partial', ['out.txt'])
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.partial')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+        os.rename(temp_path, path)
+    except:
+        os.remove(temp_path)
+        raise
+
+def save_image(im, path):
+    """Saves an image as a PNG without ever leaving a half written file at path"""
+    with atomic_write(path) as f:
+        im.save(f, 'PNG')
+
+def save_values(values, path):
+    """Saves rendered values as an .npy file, for compositing at full
+    precision, without ever leaving a half written file at path"""
+    with atomic_write(path) as f:
+        numpy.save(f, values)
+
+def get_preview(values, done, step):
+    """Returns values with pixels not done replaced by the one at the
+    corner of their cell in a grid of every step'th pixel
+
+    >>> values = numpy.arange(16.).reshape(4, 4)
+    >>> done = numpy.zeros((4, 4), dtype=bool)
+    >>> done[::2, ::2] = done[1, 1] = True
+    >>> get_preview(values, done, 2)[1].tolist()
+    [0.0, 5.0, 2.0, 2.0]
+    """
+    if step is None:
+        return values.copy()
+    rows = numpy.arange(values.shape[0]) // step * step
+    cols = numpy.arange(values.shape[1]) // step * step
+    preview = values[rows[:, numpy.newaxis], cols]
+    preview[done] = values[done]
+    return preview
+
 def getTestView():
     return View(((0,0,0), (1,0,0)), ((0,0,0), (0,1,0)), 2)
 
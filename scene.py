@@ -0,0 +1,300 @@
+"""Scene files: spheres, checkerboards, lights, views and render settings
+
+Scenes are saved and loaded in two forms holding the same things, chosen
+by the file's extension:
+
+* .json, for writing by hand:
+
+    {"spheres": [{"center": [0, 0, 0], "radius": 1, "reflectivity": 0.5, "color": 0.8}],
+     "checkerboards": [{"origin": [0, -5, 0], "axis1": [0, 0, 5], "axis2": [5, 0, 0]}],
+     "lights": [{"position": [100, 100, 0]}, {"position": [0, 2, 5], "brightness": 0.3, "radius": 10}],
+     "views": [{"camera": [0, 0, -10], "target": [0, 0, 0], "distance": 4}],
+     "settings": {"max_depth": 15, "samples": 2}}
+
+  Sphere and checkerboard reflectivities default to .5, and sphere colors
+  are random as with Sphere. Lights have a brightness of 1 and reach
+  everywhere unless given a brightness and a radius, as for Light. A view
+  is either a camera and target, with optional distance and up, as for
+  View.from_camera, or a width_ray, height_ray and distance as for View.
+
+* .npz, for generated scenes of many spheres, holding one array per
+  attribute as written by packed.PackedWorld.save.
+
+Either loads straight into a packed.PackedWorld, its arrays filled from the
+file without making a Sphere for each sphere.
+
+    w = scene.load('spheres.npz')
+    scene.save(w, 'spheres.json')
+"""
+import json
+import os
+import random
+import numpy
+import packed
+import raycast
+
+SCENE_KEYS = ('spheres', 'checkerboards', 'lights', 'views', 'settings')
+
+# the fields of each kind of item in a scene, with the shape of the numbers
+# they hold and whether they have to be there
+SPHERE_FIELDS = {'center': ((3,), True), 'radius': ((), True), 'color': ((), False), 'reflectivity': ((), False)}
+CHECKERBOARD_FIELDS = {'origin': ((3,), True), 'axis1': ((3,), True), 'axis2': ((3,), True),
+        'reflectivity': ((), False)}
+LIGHT_FIELDS = {'position': ((3,), True), 'brightness': ((), False), 'radius': ((), False)}
+CAMERA_VIEW_FIELDS = {'camera': ((3,), True), 'target': ((3,), True), 'distance': ((), False), 'up': ((3,), False)}
+RAY_VIEW_FIELDS = {'width_ray': ((2, 3), True), 'height_ray': ((2, 3), True), 'distance': ((), True)}
+
+def is_whole(value):
+    return isinstance(value, (int, long)) and not isinstance(value, bool)
+
+def is_number(value):
+    return (isinstance(value, (int, long, float)) and not isinstance(value, bool) and
+            abs(value) < float('inf'))
+
+def is_numbers(value, shape):
+    """Returns whether value is a number, for a shape of (), or lists of
+    numbers nested to the shape given
+
+    >>> is_numbers([[0, 1, 2], [3, 4, 5.]], (2, 3)), is_numbers([0, 1, float('nan')], (3,))
+    (True, False)
+    """
+    if not shape:
+        return is_number(value)
+    return isinstance(value, list) and len(value) == shape[0] and all(is_numbers(x, shape[1:]) for x in value)
+
+# each RenderSettings argument: (what it should be, a test of values, whether it can be null)
+SETTINGS = {
+        'max_depth': ('a whole number, at least 0', lambda x: is_whole(x) and x >= 0, False),
+        'min_weight': ('a number, at least 0', lambda x: is_number(x) and x >= 0, False),
+        'roulette_weight': ('a number above 0', lambda x: is_number(x) and x > 0, True),
+        'seed': ('a whole number from 0 to 2**32 - 1', lambda x: is_whole(x) and 0 <= x < 2**32, True),
+        'samples': ('a whole number, at least 1', lambda x: is_whole(x) and x >= 1, False),
+        'jitter': ('true or false', lambda x: isinstance(x, bool), False),
+        'adaptive_threshold': ('a number, at least 0', lambda x: is_number(x) and x >= 0, True),
+        'light_samples': ('a whole number, at least 1', lambda x: is_whole(x) and x >= 1, True),
+        'packet_rays': ('a whole number, at least 1', lambda x: is_whole(x) and x >= 1, True),
+        }
+
+def check_fields(item, kind, fields):
+    """Raises ValueError if item, a kind of thing in a JSON scene file,
+    isn't a dict of the numbers fields describe
+
+    >>> check_fields({'center': [0, 0, 0], 'radius': 1}, 'sphere', SPHERE_FIELDS)
+    >>> check_fields({'center': [0, 0], 'radius': 1}, 'sphere', SPHERE_FIELDS)
+    Traceback (most recent call last):
+    ...
+    ValueError: A sphere's center should be 3 numbers
+    >>> check_fields({'center': [0, 0, 0]}, 'sphere', SPHERE_FIELDS)
+    Traceback (most recent call last):
+    ...
+    ValueError: A sphere has no radius
+    """
+    if not isinstance(item, dict):
+        raise ValueError('A '+kind+' should be a JSON object')
+    unknown = set(item) - set(fields)
+    if unknown:
+        raise ValueError('Unknown '+kind+' keys '+', '.join(sorted(unknown)))
+    for key, (shape, required) in sorted(fields.items()):
+        if key not in item:
+            if required:
+                raise ValueError('A '+kind+' has no '+key)
+        elif not is_numbers(item[key], shape):
+            raise ValueError('A '+kind+"'s "+key+' should be '+
+                    ('a number' if not shape else ' by '.join(map(str, shape))+' numbers'))
+
+def check_items(description, key, kind, fields):
+    """Raises ValueError if description[key], if it's there, isn't a list
+    of kind items as check_fields checks"""
+    items = description.get(key, [])
+    if not isinstance(items, list):
+        raise ValueError(key+' should be a list')
+    for item in items:
+        check_fields(item, kind, fields)
+
+def get_settings(description):
+    """Returns the RenderSettings described by a dict from a JSON scene
+    file, raising ValueError if it isn't a valid one
+
+    >>> get_settings({'samples': 2, 'light_samples': None}).samples
+    2
+    >>> get_settings({'samples': 0})
+    Traceback (most recent call last):
+    ...
+    ValueError: The samples setting should be a whole number, at least 1
+    >>> get_settings({'bogus': 1})
+    Traceback (most recent call last):
+    ...
+    ValueError: Unknown settings bogus
+    """
+    if not isinstance(description, dict):
+        raise ValueError('settings should be a JSON object')
+    unknown = set(description) - set(SETTINGS)
+    if unknown:
+        raise ValueError('Unknown settings '+', '.join(sorted(unknown)))
+    for key, value in sorted(description.items()):
+        expected, is_valid, nullable = SETTINGS[key]
+        if not (is_valid(value) or (nullable and value is None)):
+            raise ValueError('The '+key+' setting should be '+expected+(' or null' if nullable else ''))
+    return raycast.RenderSettings(**description)
+
+def get_arrays(description):
+    """Returns the arrays of packed.PackedWorld.from_arrays for a scene
+    described as in a JSON scene file
+
+    >>> arrays = get_arrays({'spheres': [{'center': [0, 0, 0], 'radius': 1, 'color': .5}],
+    ...         'views': [{'camera': [0, 0, -10], 'target': [0, 0, 0]}]})
+    >>> arrays['sphere_reflectivities'].tolist(), arrays['view_distances'].tolist()
+    ([0.5], [-4.0])
+    >>> get_arrays({'lights': [{'position': [0, 9, 0]}, {'position': [0, 1, 0], 'radius': 5}]})['light_radii'].tolist()
+    [inf, 5.0]
+
+    Missing or malformed fields raise ValueError.
+
+    >>> get_arrays({'spheres': [{'center': [0, 0, 0]}]})
+    Traceback (most recent call last):
+    ...
+    ValueError: A sphere has no radius
+    """
+    if not isinstance(description, dict):
+        raise ValueError('A scene should be a JSON object')
+    unknown = set(description) - set(SCENE_KEYS)
+    if unknown:
+        raise ValueError('Unknown scene keys '+', '.join(sorted(unknown)))
+    check_items(description, 'spheres', 'sphere', SPHERE_FIELDS)
+    check_items(description, 'checkerboards', 'checkerboard', CHECKERBOARD_FIELDS)
+    check_items(description, 'lights', 'light', LIGHT_FIELDS)
+    if not isinstance(description.get('views', []), list):
+        raise ValueError('views should be a list')
+    spheres = description.get('spheres', [])
+    checkerboards = description.get('checkerboards', [])
+    lights = description.get('lights', [])
+    views = [get_view(view) for view in description.get('views', [])]
+    arrays = {
+            'sphere_centers': numpy.array([sphere['center'] for sphere in spheres], dtype=numpy.float_),
+            'sphere_radii': numpy.array([sphere['radius'] for sphere in spheres], dtype=numpy.float_),
+            'sphere_colors': numpy.array([sphere['color'] if 'color' in sphere else min(1, random.random() + .1)
+                for sphere in spheres], dtype=numpy.float_),
+            'sphere_reflectivities': numpy.array([sphere.get('reflectivity', .5) for sphere in spheres],
+                dtype=numpy.float_),
+            'plane_origins': numpy.array([board['origin'] for board in checkerboards], dtype=numpy.float_),
+            'plane_axes1': numpy.array([board['axis1'] for board in checkerboards], dtype=numpy.float_),
+            'plane_axes2': numpy.array([board['axis2'] for board in checkerboards], dtype=numpy.float_),
+            'plane_reflectivities': numpy.array([board.get('reflectivity', .5) for board in checkerboards],
+                dtype=numpy.float_),
+            'light_positions': numpy.array([light['position'] for light in lights], dtype=numpy.float_).reshape(-1, 3),
+            'light_brightnesses': numpy.array([light.get('brightness', 1) for light in lights], dtype=numpy.float_),
+            'light_radii': numpy.array([light.get('radius', numpy.inf) for light in lights], dtype=numpy.float_),
+            'view_width_rays': numpy.array([view.screen_width_ray for view in views]).reshape(-1, 2, 3),
+            'view_height_rays': numpy.array([view.screen_height_ray for view in views]).reshape(-1, 2, 3),
+            'view_distances': numpy.array([view.camera_distance for view in views]),
+            }
+    if 'settings' in description:
+        get_settings(description['settings'])
+        arrays['settings'] = numpy.array(json.dumps(description['settings']))
+    return arrays
+
+def get_view(description):
+    """Returns the View described by a dict from a JSON scene file,
+    raising ValueError if it isn't a valid one"""
+    if not isinstance(description, dict):
+        raise ValueError('A view should be a JSON object')
+    if 'camera' in description:
+        check_fields(description, 'view', CAMERA_VIEW_FIELDS)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            view = raycast.View.from_camera(description['camera'], description['target'],
+                    description.get('distance', 4), description.get('up', (0, 1, 0)))
+        if not numpy.isfinite(view.screen_height_ray).all():
+            raise ValueError("A view's camera should be away from its target, and not looking straight up")
+        return view
+    check_fields(description, 'view', RAY_VIEW_FIELDS)
+    return raycast.View(tuple(map(tuple, description['width_ray'])), tuple(map(tuple, description['height_ray'])),
+            description['distance'])
+
+def get_description(arrays):
+    """Returns the description of a scene for a JSON scene file, given the
+    arrays of packed.PackedWorld.get_arrays"""
+    description = {
+            'spheres': [{'center': center, 'radius': radius, 'color': color, 'reflectivity': reflectivity}
+                for center, radius, color, reflectivity in
+                zip(*[arrays[name].tolist() for name in packed.SPHERE_ARRAYS])],
+            'checkerboards': [{'origin': origin, 'axis1': axis1, 'axis2': axis2, 'reflectivity': reflectivity}
+                for origin, axis1, axis2, reflectivity in
+                zip(*[arrays[name].tolist() for name in packed.PLANE_ARRAYS])],
+            'lights': [get_light_description(position, brightness, radius) for position, brightness, radius in
+                zip(*[arrays[name].tolist() for name in packed.LIGHT_ARRAYS])],
+            'views': [{'width_ray': width_ray, 'height_ray': height_ray, 'distance': distance}
+                for width_ray, height_ray, distance in
+                zip(*[arrays[name].tolist() for name in packed.VIEW_ARRAYS])],
+            }
+    if 'settings' in arrays:
+        description['settings'] = json.loads(str(arrays['settings']))
+    return description
+
+def get_light_description(position, brightness, radius):
+    """Returns the dict describing a light in a JSON scene file, which has
+    no radius if it reaches everywhere"""
+    description = {'position': position, 'brightness': brightness}
+    if radius != float('inf'):
+        description['radius'] = radius
+    return description
+
+def load_json(f):
+    """Returns a packed.PackedWorld of the JSON scene read from file f"""
+    return packed.PackedWorld.from_arrays(get_arrays(json.load(f)))
+
+def dump_json(world, f):
+    """Writes world as a JSON scene to file f, a line for each object,
+    light and view"""
+    description = get_description(world.get_arrays())
+    f.write('{')
+    for i, key in enumerate(key for key in SCENE_KEYS if key in description):
+        f.write(',\n' if i else '\n')
+        if key == 'settings':
+            f.write(' "settings": '+json.dumps(description[key], sort_keys=True))
+            continue
+        f.write(' '+json.dumps(key)+': [')
+        f.write(','.join('\n  '+json.dumps(item, sort_keys=True) for item in description[key]))
+        f.write('\n ]' if description[key] else ']')
+    f.write('\n}\n')
+
+def load(path):
+    """Returns a packed.PackedWorld of the scene in a .json or .npz file"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.json':
+        with open(path) as f:
+            return load_json(f)
+    if extension == '.npz':
+        return packed.PackedWorld.load(path)
+    raise ValueError('Unknown scene file extension '+repr(extension)+', expected .json or .npz')
+
+def save(world, path):
+    """Saves a World of Spheres and Checkerboards, or a PackedWorld, to a
+    .json or .npz file
+
+    >>> import tempfile
+    >>> w = raycast.World()
+    >>> w.add_object(raycast.Sphere((0,0,0), 1, color=.5))
+    >>> w.add_object(raycast.Checkerboard(((0,-2,0), (0,-2,1)), ((0,-2,0), (1,-2,0))))
+    >>> w.add_light(raycast.Light((10, 10, -10)))
+    >>> w.add_view(raycast.View(((0,0,-5), (1,0,-5)), ((0,0,-5), (0,1,-5)), -4))
+    >>> directory = tempfile.mkdtemp()
+    >>> save(w, os.path.join(directory, 'scene.json'))
+    >>> from_json = load(os.path.join(directory, 'scene.json'))
+    >>> save(from_json, os.path.join(directory, 'scene.npz'))
+    >>> from_npz = load(os.path.join(directory, 'scene.npz'))
+    >>> a = w.render_view_values(w.views[0], 20, 20, 6, 6)
+    >>> (a == from_json.render_view_values(from_json.views[0], 20, 20, 6, 6)).all()
+    True
+    >>> (a == from_npz.render_view_values(from_npz.views[0], 20, 20, 6, 6)).all()
+    True
+    """
+    if not isinstance(world, packed.PackedWorld):
+        world = packed.PackedWorld.from_world(world)
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.json':
+        with open(path, 'w') as f:
+            dump_json(world, f)
+    elif extension == '.npz':
+        world.save(path)
+    else:
+        raise ValueError('Unknown scene file extension '+repr(extension)+', expected .json or .npz')
@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+"""A long running render service, taking scenes over HTTP and answering
+with PNG or ASCII renders of them
+
+    python server.py --port 8000 --processes 4 --cache-dir /var/cache/raycast
+    curl --data @request.json http://localhost:8000/render > view.png
+
+A request is a JSON object POSTed to /render:
+
+    {"scene": {"spheres": [...], "lights": [...], ...},
+     "view": {"camera": [0, 0, -10], "target": [0, 0, 0]},
+     "width": 320, "height": 240, "viewscreen_width": 7, "viewscreen_height": 7,
+     "format": "png"}
+
+scene is described as in a JSON scene file (see scene.py), view as one of
+its views and defaults to the scene's first. format is "png" or "ascii".
+A request for more than MAX_SAMPLES primary rays - width * height *
+samples**2 - or with a max_depth over MAX_DEPTH is refused with 400, as is
+one with anything missing or malformed.
+
+Renders run in a pool of worker processes started with the server, so
+numpy and PIL are imported once, and each worker keeps the last few
+worlds it built, BVHs and all. At most max_queued renders wait at once;
+beyond that requests are refused with 503. Every result is saved in
+cache_dir under the SHA-1 of its request, so a repeated request is answered
+from the file without rendering, and one arriving while the same render is
+under way waits for it rather than starting another.
+"""
+import argparse
+import BaseHTTPServer
+import collections
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import random
+import SocketServer
+import StringIO
+import tempfile
+import threading
+import packed
+import raycast
+import scene
+
+log = logging.getLogger('raycast.server')
+
+FORMATS = {'png': ('.png', 'image/png'), 'ascii': ('.txt', 'text/plain')}
+REQUEST_KEYS = ('scene', 'view', 'width', 'height', 'viewscreen_width', 'viewscreen_height', 'format')
+MAX_REQUEST_BYTES = 64 * 2**20 # larger scenes should be rendered from .npz files
+MAX_SAMPLES = 4096 * 4096 # primary rays of a render, width * height * samples**2
+MAX_DEPTH = 32 # reflections followed from each pixel
+WORLD_CACHE_SIZE = 4 # worlds each worker keeps built
+CHUNK_BYTES = 2**16 # of responses written at a time
+
+worlds = collections.OrderedDict() # scene key: World, most recently used last, in a worker process
+
+class QueueFull(Exception):
+    pass
+
+def get_request(description):
+    """Returns a render request dict with defaults filled in, raising
+    ValueError if description isn't a valid one
+
+    >>> get_request({'scene': {}, 'width': 4, 'height': 3, 'viewscreen_width': 2, 'viewscreen_height': 2})['format']
+    'png'
+    >>> get_request({'scene': {}, 'width': 4})
+    Traceback (most recent call last):
+    ...
+    ValueError: Missing request keys height, viewscreen_height, viewscreen_width
+    >>> get_request({'scene': {}, 'width': 4, 'height': 3, 'viewscreen_width': float('nan'), 'viewscreen_height': 2})
+    Traceback (most recent call last):
+    ...
+    ValueError: viewscreen_width should be a positive number
+    >>> get_request({'scene': {'settings': {'samples': 1024}}, 'width': 16, 'height': 8,
+    ...         'viewscreen_width': 2, 'viewscreen_height': 2})
+    Traceback (most recent call last):
+    ...
+    ValueError: width * height * samples**2 is limited to 16777216 rays
+    >>> get_request({'scene': {'settings': {'bogus': 1}}, 'width': 4, 'height': 3,
+    ...         'viewscreen_width': 2, 'viewscreen_height': 2})
+    Traceback (most recent call last):
+    ...
+    ValueError: Unknown settings bogus
+
+    The rest of the scene is checked by scene.get_arrays as it's built in
+    a worker, whose ValueErrors reach the handler in the same way.
+    """
+    if not isinstance(description, dict):
+        raise ValueError('A request should be a JSON object')
+    unknown = set(description) - set(REQUEST_KEYS)
+    if unknown:
+        raise ValueError('Unknown request keys '+', '.join(sorted(unknown)))
+    missing = set(REQUEST_KEYS) - set(description) - set(['view', 'format'])
+    if missing:
+        raise ValueError('Missing request keys '+', '.join(sorted(missing)))
+    request = dict(description)
+    request.setdefault('view', None)
+    request.setdefault('format', 'png')
+    if request['format'] not in FORMATS:
+        raise ValueError('Unknown format '+repr(request['format'])+', expected one of '+', '.join(sorted(FORMATS)))
+    for name in ('width', 'height'):
+        if isinstance(request[name], bool) or not isinstance(request[name], (int, long)) or request[name] < 2:
+            raise ValueError(name+' should be a whole number of samples, at least 2')
+    for name in ('viewscreen_width', 'viewscreen_height'):
+        # json reads NaN and Infinity too, and nan fails every comparison
+        if (isinstance(request[name], bool) or not isinstance(request[name], (int, long, float)) or
+                not 0 < request[name] < float('inf')):
+            raise ValueError(name+' should be a positive number')
+        request[name] = float(request[name])
+    if not isinstance(request['scene'], dict):
+        raise ValueError('A scene should be a JSON object')
+    settings = scene.get_settings(request['scene'].get('settings', {}))
+    if request['width'] * request['height'] * settings.samples**2 > MAX_SAMPLES:
+        raise ValueError('width * height * samples**2 is limited to '+str(MAX_SAMPLES)+' rays')
+    if settings.max_depth > MAX_DEPTH:
+        raise ValueError('The max_depth setting is limited to '+str(MAX_DEPTH))
+    if request['view'] is not None:
+        scene.get_view(request['view'])
+    return request
+
+def get_key(description):
+    """Returns the SHA-1 hex digest of a JSON description, the same
+    however its dicts are ordered
+
+    >>> get_key({'a': 1, 'b': [2, 3]}) == get_key({'b': [2, 3], 'a': 1})
+    True
+    """
+    return hashlib.sha1(json.dumps(description, sort_keys=True, separators=(',', ':'))).hexdigest()
+
+def get_world(scene_description):
+    """Returns the world of a scene description, reusing one this process
+    built before for the same description"""
+    key = get_key(scene_description)
+    world = worlds.pop(key, None)
+    if world is None:
+        random.seed(key) # so spheres without colors get the same ones every time
+        world = packed.PackedWorld.from_arrays(scene.get_arrays(scene_description))
+        world.get_bvh()
+    worlds[key] = world
+    while len(worlds) > WORLD_CACHE_SIZE:
+        worlds.popitem(last=False)
+    return world
+
+def render_request(request):
+    """Returns the bytes of the PNG or ASCII render a request asks for
+
+    >>> text = render_request(get_request({'scene': {'spheres': [{'center': [0, 0, 0], 'radius': 1}],
+    ...         'lights': [{'position': [0, 10, -10]}]}, 'view': {'camera': [0, 0, -5], 'target': [0, 0, 0]},
+    ...         'width': 16, 'height': 8, 'viewscreen_width': 6, 'viewscreen_height': 6, 'format': 'ascii'}))
+    >>> [len(line) for line in text.splitlines()] == [16] * 8
+    True
+    """
+    world = get_world(request['scene'])
+    if request['view'] is not None:
+        view = scene.get_view(request['view'])
+    elif world.views:
+        view = world.views[0]
+    else:
+        raise ValueError('The request has no view and the scene has none either')
+    values = world.render_view_values(view, request['width'], request['height'],
+            request['viewscreen_width'], request['viewscreen_height'], batch=True)
+    if request['format'] == 'ascii':
+        return raycast.get_ascii_text(values)
+    f = StringIO.StringIO()
+    raycast.get_image(values).save(f, 'PNG')
+    return f.getvalue()
+
+def save_result(data, path):
+    """Writes data to path without ever leaving a half written file there,
+    even with other threads or processes saving the same path"""
+    with raycast.atomic_write(path) as f:
+        f.write(data)
+
+class RenderJob(object):
+    """A render under way in the pool, which any number of threads can wait
+    for; an AsyncResult only wakes one of the threads waiting on it"""
+    def __init__(self, result):
+        self.result = result
+        self.error = None
+        self.done = threading.Event()
+
+    def save(self, path):
+        """Waits for the render and saves it to path, called by one thread"""
+        try:
+            save_result(self.result.get(), path)
+        except Exception as e:
+            self.error = e
+        self.done.set()
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+
+class RenderService(object):
+    """Renders requests in a pool of processes workers, caching results in cache_dir"""
+    def __init__(self, cache_dir, processes=None, max_queued=64):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.cache_dir = cache_dir
+        self.max_queued = max_queued
+        self.pool = multiprocessing.Pool(processes)
+        self.lock = threading.Lock()
+        self.jobs = {} # request key: RenderJob of each render under way
+
+    def get_path(self, key, format):
+        return os.path.join(self.cache_dir, key + FORMATS[format][0])
+
+    def get_result(self, request):
+        """Returns (path of the result, whether it was in the cache), rendering
+        it if it wasn't, or waiting for the render if one is under way"""
+        key = get_key(request)
+        path = self.get_path(key, request['format'])
+        if os.path.exists(path):
+            return path, True
+        with self.lock:
+            # a render that finished since the check above has saved its
+            # result before leaving self.jobs, so look for the file again
+            if os.path.exists(path):
+                return path, True
+            job = self.jobs.get(key)
+            started = job is None
+            if started:
+                if len(self.jobs) >= self.max_queued:
+                    raise QueueFull()
+                job = RenderJob(self.pool.apply_async(render_request, (request,)))
+                self.jobs[key] = job
+        if started:
+            try:
+                job.save(path)
+            finally:
+                with self.lock:
+                    del self.jobs[key]
+        job.wait()
+        return path, False
+
+    def get_queued(self):
+        with self.lock:
+            return len(self.jobs)
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+class RenderHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != '/render':
+            self.send_error(404, 'POST render requests to /render')
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        if length > MAX_REQUEST_BYTES:
+            self.send_error(413, 'Requests are limited to '+str(MAX_REQUEST_BYTES)+' bytes')
+            return
+        try:
+            request = get_request(json.loads(self.rfile.read(length)))
+            path, cached = self.server.service.get_result(request)
+        except QueueFull:
+            self.send_error(503, 'Too many renders queued, try again later')
+            return
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        except Exception as e:
+            log.exception('Render failed')
+            self.send_error(500, 'Render failed: '+str(e))
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', FORMATS[request['format']][1])
+        self.send_header('Content-Length', str(os.path.getsize(path)))
+        self.send_header('X-Cache', 'hit' if cached else 'miss')
+        self.end_headers()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_BYTES), ''):
+                self.wfile.write(chunk)
+
+    def do_GET(self):
+        if self.path != '/status':
+            self.send_error(404, 'GET /status, or POST render requests to /render')
+            return
+        body = json.dumps({'queued': self.server.service.get_queued(), 'max_queued': self.server.service.max_queued})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.info('%s %s', self.address_string(), format % args)
+
+class RenderServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """HTTP server answering each request in a thread of its own with the
+    renders of a RenderService
+
+    >>> import urllib2
+    >>> server = RenderServer(('127.0.0.1', 0), RenderService(tempfile.mkdtemp(), processes=1))
+    >>> thread = threading.Thread(target=server.serve_forever)
+    >>> thread.start()
+    >>> url = 'http://127.0.0.1:%d/render' % server.server_address[1]
+    >>> request = json.dumps({'scene': {'spheres': [{'center': [0, 0, 0], 'radius': 1}],
+    ...         'lights': [{'position': [0, 10, -10]}], 'views': [{'camera': [0, 0, -5], 'target': [0, 0, 0]}]},
+    ...         'width': 16, 'height': 12, 'viewscreen_width': 6, 'viewscreen_height': 6})
+    >>> response = urllib2.urlopen(url, request)
+    >>> response.info()['Content-Type'], response.info()['X-Cache'], response.read()[1:4]
+    ('image/png', 'miss', 'PNG')
+    >>> urllib2.urlopen(url, request).info()['X-Cache']
+    'hit'
+    >>> try:
+    ...     urllib2.urlopen(url, json.dumps({'scene': {'spheres': [{'center': [0, 0, 0]}]},
+    ...             'width': 16, 'height': 12, 'viewscreen_width': 6, 'viewscreen_height': 6}))
+    ... except urllib2.HTTPError as e:
+    ...     e.code
+    400
+    >>> server.shutdown()
+    >>> server.server_close()
+    """
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        BaseHTTPServer.HTTPServer.__init__(self, address, RenderHandler)
+        self.service = service
+
+    def server_close(self):
+        BaseHTTPServer.HTTPServer.server_close(self)
+        self.service.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--processes', type=int, default=None, help='render workers, by default one per core')
+    parser.add_argument('--max-queued', type=int, default=64, help='renders waiting at once before refusing more')
+    parser.add_argument('--cache-dir', default=os.path.join(tempfile.gettempdir(), 'raycast-cache'))
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    server = RenderServer((args.host, args.port), RenderService(args.cache_dir, args.processes, args.max_queued))
+    log.info('Serving renders on http://%s:%d/render, caching in %s', args.host, args.port, args.cache_dir)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
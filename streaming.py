@@ -0,0 +1,192 @@
+"""Renders views straight to PNG, PGM or ASCII files a band of rows at a time
+
+    streaming.save_view(world, view, 'poster.png', 40000, 30000, 7, 7, processes=8)
+    streaming.render_view(world, view, sys.stdout, 200, 80, 7, 7, format='ascii')
+
+Bands are rendered from the top of the image down, and each is tone mapped
+and handed to an encoder that compresses and writes it before the next is
+rendered, so memory grows with the band size rather than the image size.
+With processes > 1 the bands are rendered in a pool of workers but written
+in order, and only a few bands per worker are rendered ahead of the one
+being written.
+
+As values aren't all known until the end, clamp can't be False here; the
+values are always clipped to 0-1 as with get_tone_mapped's default.
+"""
+import os
+import struct
+import sys
+import zlib
+import numpy
+import parallel
+import raycast
+
+BAND_PIXELS = 2**16 # samples in each band by default, as rows of the image's width
+FORMATS = {'.png': 'png', '.pgm': 'pgm', '.txt': 'ascii'}
+
+def get_bands_from_top(num_rows, band_rows):
+    """Returns (start_row, end_row) pairs covering num_rows rows counted from
+    the bottom, the band at the top first
+
+    >>> get_bands_from_top(10, 4)
+    [(6, 10), (2, 6), (0, 2)]
+    """
+    return [(max(0, end - band_rows), end) for end in xrange(num_rows, 0, -band_rows)]
+
+def get_levels(values, bits=8, gamma=1.):
+    """Returns tone mapped values as the integers get_image would store for them"""
+    dtype = numpy.uint8 if bits == 8 else numpy.uint16
+    return (raycast.get_tone_mapped(values, gamma) * numpy.iinfo(dtype).max + .5).astype(dtype)
+
+class PNGWriter(object):
+    """Writes a greyscale PNG to a file a band of rows at a time
+
+    Each row is stored with the PNG "sub" filter and the image data is
+    compressed as it comes, written out in IDAT chunks whenever zlib has
+    some ready.
+
+    >>> import StringIO, PIL.Image
+    >>> f = StringIO.StringIO()
+    >>> writer = PNGWriter(f, 3, 2)
+    >>> writer.write_rows(numpy.array([[0, 128, 255]], dtype=numpy.uint8))
+    >>> writer.write_rows(numpy.array([[1, 2, 3]], dtype=numpy.uint8))
+    >>> writer.close()
+    >>> list(PIL.Image.open(StringIO.StringIO(f.getvalue())).getdata())
+    [0, 128, 255, 1, 2, 3]
+    """
+    def __init__(self, f, width, height, bits=8):
+        if bits not in (8, 16):
+            raise ValueError('Images can have 8 or 16 bits per channel, not '+str(bits))
+        self.f = f
+        self.width = width
+        self.height = height
+        self.bits = bits
+        self.rows_written = 0
+        self.compressor = zlib.compressobj(6)
+        f.write('\x89PNG\r\n\x1a\n')
+        self.write_chunk('IHDR', struct.pack('>IIBBBBB', width, height, bits, 0, 0, 0, 0))
+
+    def write_chunk(self, kind, data):
+        self.f.write(struct.pack('>I', len(data)))
+        self.f.write(kind)
+        self.f.write(data)
+        self.f.write(struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    def write_rows(self, levels):
+        """Writes a (rows, width) array of uint8 or, for 16 bits, uint16 levels"""
+        data = levels.astype('>u2' if self.bits == 16 else numpy.uint8).view(numpy.uint8).reshape(len(levels), -1)
+        step = self.bits // 8
+        filtered = numpy.empty((len(data), data.shape[1] + 1), dtype=numpy.uint8)
+        filtered[:, 0] = 1 # sub: each byte less the same byte of the pixel before
+        filtered[:, 1:step+1] = data[:, :step]
+        numpy.subtract(data[:, step:], data[:, :-step], filtered[:, step+1:])
+        compressed = self.compressor.compress(filtered.tostring())
+        if compressed:
+            self.write_chunk('IDAT', compressed)
+        self.rows_written += len(levels)
+
+    def close(self):
+        if self.rows_written != self.height:
+            raise ValueError('Wrote '+str(self.rows_written)+' rows of a '+str(self.height)+' row image')
+        self.write_chunk('IDAT', self.compressor.flush())
+        self.write_chunk('IEND', '')
+
+class PGMWriter(object):
+    """Writes a binary greyscale PGM to a file a band of rows at a time
+
+    >>> import StringIO
+    >>> f = StringIO.StringIO()
+    >>> writer = PGMWriter(f, 2, 1, 16)
+    >>> writer.write_rows(numpy.array([[1, 65535]], dtype=numpy.uint16))
+    >>> writer.close()
+    >>> f.getvalue()
+    'P5\\n2 1\\n65535\\n\\x00\\x01\\xff\\xff'
+    """
+    def __init__(self, f, width, height, bits=8):
+        if bits not in (8, 16):
+            raise ValueError('Images can have 8 or 16 bits per channel, not '+str(bits))
+        self.f = f
+        self.height = height
+        self.bits = bits
+        self.rows_written = 0
+        f.write('P5\n%d %d\n%d\n' % (width, height, 2**bits - 1))
+
+    def write_rows(self, levels):
+        self.f.write(levels.astype('>u2' if self.bits == 16 else numpy.uint8).tostring())
+        self.rows_written += len(levels)
+
+    def close(self):
+        if self.rows_written != self.height:
+            raise ValueError('Wrote '+str(self.rows_written)+' rows of a '+str(self.height)+' row image')
+
+def render_bands(world, view, w_samples, h_samples, viewscreen_width, viewscreen_height,
+        batch=True, processes=None, settings=None, stats=None, band_rows=None):
+    """Yields FRAMEBUFFER_DTYPE arrays of the values of bands of band_rows
+    rows, from the top of the image down, each with its first row at the top"""
+    if band_rows is None:
+        band_rows = max(1, BAND_PIXELS // w_samples)
+    bands = get_bands_from_top(h_samples, band_rows)
+    world.get_bvh()
+    if processes and processes > 1:
+        results = parallel.render_bands(world, view, w_samples, h_samples, viewscreen_width, viewscreen_height,
+                bands, batch, processes, settings, stats, ordered=True)
+    else:
+        results = ((start_row, world.render_rows(view, w_samples, h_samples, viewscreen_width, viewscreen_height,
+                start_row, end_row, batch, settings, stats)) for start_row, end_row in bands)
+    rows_done = 0
+    for start_row, values in results:
+        rows_done += len(values)
+        sys.stderr.write(str(rows_done)+'/'+str(h_samples)+'\n')
+        yield values[::-1].astype(raycast.FRAMEBUFFER_DTYPE)
+
+def render_view(world, view, f, w_samples, h_samples, viewscreen_width, viewscreen_height, format='png',
+        bits=8, gamma=1., batch=True, processes=None, settings=None, stats=None, band_rows=None):
+    """Renders a view to file f as a PNG or PGM image, or with format 'ascii'
+    as lines of text, writing each band of rows as soon as it's rendered
+
+    bits and gamma are as for get_image, and the rest as for
+    World.render_view_values.
+    """
+    bands = render_bands(world, view, w_samples, h_samples, viewscreen_width, viewscreen_height,
+            batch, processes, settings, stats, band_rows)
+    if format == 'ascii':
+        for values in bands:
+            f.write(raycast.get_ascii_text(values, gamma))
+        return
+    if format == 'png':
+        writer = PNGWriter(f, w_samples, h_samples, bits)
+    elif format == 'pgm':
+        writer = PGMWriter(f, w_samples, h_samples, bits)
+    else:
+        raise ValueError('Unknown format '+repr(format)+', expected png, pgm or ascii')
+    for values in bands:
+        writer.write_rows(get_levels(values, bits, gamma))
+    writer.close()
+
+def save_view(world, view, path, w_samples, h_samples, viewscreen_width, viewscreen_height, bits=8, gamma=1.,
+        batch=True, processes=None, settings=None, stats=None, band_rows=None):
+    """Renders a view to a .png, .pgm or .txt file at path, a band at a time,
+    without ever leaving a half written file there
+
+    >>> import tempfile
+    >>> w = raycast.World()
+    >>> w.add_object(raycast.Sphere((0,0,0), 1))
+    >>> w.add_object(raycast.Checkerboard(((0,-2,0), (0,-2,5)), ((0,-2,0), (5,-2,0))))
+    >>> w.add_light(raycast.Light((10, 10, -10)))
+    >>> v = raycast.View(((0,0,-5), (1,0,-5)), ((0,0,-5), (0,1,-5)), -4)
+    >>> path = os.path.join(tempfile.mkdtemp(), 'view.png')
+    >>> save_view(w, v, path, 24, 18, 6, 6, band_rows=5)
+    >>> image = w.render_view(v, 24, 18, 6, 6, batch=True)
+    >>> list(raycast.Image.open(path).getdata()) == list(image.getdata())
+    True
+    >>> save_view(w, v, path, 24, 18, 6, 6, band_rows=4, processes=2)
+    >>> list(raycast.Image.open(path).getdata()) == list(image.getdata())
+    True
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in FORMATS:
+        raise ValueError('Unknown image file extension '+repr(extension)+', expected one of '+
+                ', '.join(sorted(FORMATS)))
+    with raycast.atomic_write(path) as f:
+        render_view(world, view, f, w_samples, h_samples, viewscreen_width, viewscreen_height, FORMATS[extension],
+                bits, gamma, batch, processes, settings, stats, band_rows)
@@ -36,6 +36,61 @@ def get_line_intersections_with_sphere(line, center, radius):
     else:
         raise Exception("logic error!")
 
+def get_rays_ts_with_sphere(origins, directions, center, center_square, radius_square, out=None):
+    """Returns a (2, N) array of the parametric distances t at which rays
+    origins + t*directions cross a sphere, nan where a ray misses
+
+    center_square is get_squared_lengths(center) and radius_square radius**2,
+    which only need working out once per sphere. These may also be arrays of
+    many spheres, in which case the leading dimensions of everything
+    broadcast together; (N, 1, 3) rays and (M, 3) centers give (2, N, M)
+    ts. The result is written into out if it's given.
+
+    The roots are worked out as q/a and c/q rather than (-b +- root)/2a,
+    which would lose the nearer root to cancellation when b**2 is much
+    larger than 4ac, as it is for small or distant spheres.
+
+    >>> get_rays_ts_with_sphere(numpy.array([[0.,0,3], [0,5,3]]), numpy.array([[0.,0,-1], [0,0,-1]]),
+    ...         numpy.zeros(3), 0., 1.)[:, 0].tolist()
+    [4.0, 2.0]
+    >>> get_rays_ts_with_sphere(numpy.array([[[0.,0,3]]]), numpy.array([[[0.,0,-1]]]),
+    ...         numpy.array([[0.,0,0], [0,0,-5]]), numpy.array([0., 25]), numpy.array([1., 4]))[:, 0].tolist()
+    [[4.0, 10.0], [2.0, 6.0]]
+    """
+    x1, y1, z1 = origins[..., 0], origins[..., 1], origins[..., 2]
+    dx, dy, dz = directions[..., 0], directions[..., 1], directions[..., 2]
+    x3, y3, z3 = center[..., 0], center[..., 1], center[..., 2]
+
+    a = dx**2 + dy**2 + dz**2
+    b = 2*(dx*(x1 - x3) + dy*(y1 - y3) + dz*(z1 - z3))
+    c = center_square + x1**2 + y1**2 + z1**2 - 2*(x3*x1 + y3*y1 + z3*z1) - radius_square
+    radicand = b**2 - 4*a*c
+
+    if out is None:
+        out = numpy.empty((2,) + radicand.shape)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        q = b + numpy.copysign(numpy.sqrt(radicand), b)
+        q *= -.5
+        numpy.divide(q, a, out[0])
+        numpy.divide(c, q, out[1])
+    return out
+
+def get_rays_ts_with_plane(origins, directions, unit_normal, offset, out=None):
+    """Returns an (N,) array of the parametric distances t at which rays
+    origins + t*directions cross the plane of points p with
+    dot(p, unit_normal) == offset, nan where a ray is parallel
+
+    The result is written into out if it's given.
+
+    >>> get_rays_ts_with_plane(numpy.array([[0.,0,-10], [3,3,3]]), numpy.array([[0.,0,5], [1,0,0]]),
+    ...         numpy.array([0.,0,1]), 0.).tolist()
+    [2.0, nan]
+    """
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        t = numpy.divide(offset - numpy.dot(origins, unit_normal), numpy.dot(directions, unit_normal), out)
+    t[~numpy.isfinite(t)] = numpy.nan
+    return t
+
 def get_line_intersections_with_plane(line, points):
     """Returns a list of intersection points
 
@@ -60,14 +115,46 @@ def get_line_intersections_with_plane(line, points):
     return [p]
 
 def get_line_intersection_with_triangle(line, points):
+    """Returns a list of the intersection point, empty if the line misses
+
+    >>> [p.tolist() for p in get_line_intersection_with_triangle([[0.,0,-10], [0,0,-5]], [[0.,0,0], [1,0,0], [0,1,0]])]
+    [[0.0, 0.0, 0.0]]
+    >>> [p.tolist() for p in get_line_intersection_with_triangle([[10,10,10], [5,5,5]], [[0.,0,0], [1,0,0], [0,1,0]])]
+    [[0.0, 0.0, 0.0]]
+    >>> get_line_intersection_with_triangle([[2.,2,-10], [2,2,-5]], [[0.,0,0], [1,0,0], [0,1,0]])
+    []
     """
-    >>> get_line_intersections_with_plane([[0.,0,-10], [0,0,-5]], [[0.,0,0], [1,0,0], [0,1,0]])
-    array([ 0.,  0.,  0.])
-    >>> get_line_intersections_with_plane([[10,10,10], [5,5,5]], [[0.,0,0], [1,0,0], [0,1,0]])
-    array([ 0.,  0.,  0.])
+    lp1, lp2 = numpy.array(line, dtype=numpy.float_)
+    p1, p2, p3 = numpy.array(points, dtype=numpy.float_)
+    t = get_rays_ts_with_triangles(lp1[numpy.newaxis], (lp2 - lp1)[numpy.newaxis],
+            p1[numpy.newaxis], (p2 - p1)[numpy.newaxis], (p3 - p1)[numpy.newaxis])[0, 0]
+    if numpy.isnan(t):
+        return []
+    return [lp1 + (lp2 - lp1)*t]
+
+def get_rays_ts_with_triangles(origins, directions, vertices, edges1, edges2):
+    """Returns an (N, M) array of the parametric distances t at which N rays
+    origins + t*directions cross M triangles, nan where a ray misses
+
+    Triangles are given as (M, 3) arrays of a corner and the two edges from
+    it, and are tested with the Moller-Trumbore algorithm: the barycentric
+    coordinates of the crossing come out of the same triple products as t.
+
+    >>> get_rays_ts_with_triangles(numpy.array([[.2,.2,-10], [2,2,-10]]), numpy.array([[0.,0,5], [0,0,5]]),
+    ...         numpy.array([[0.,0,0]]), numpy.array([[1.,0,0]]), numpy.array([[0.,1,0]])).tolist()
+    [[2.0], [nan]]
     """
-    intersection = get_intersection_with_plane(line, points)
-    raise NotImplementedError()
+    directions = directions[:, numpy.newaxis]
+    pvecs = numpy.cross(directions, edges2)
+    tvecs = origins[:, numpy.newaxis] - vertices
+    qvecs = numpy.cross(tvecs, edges1)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        inverse_dets = 1 / numpy.sum(edges1 * pvecs, axis=-1)
+        us = numpy.sum(tvecs * pvecs, axis=-1) * inverse_dets
+        vs = numpy.sum(directions * qvecs, axis=-1) * inverse_dets
+        ts = numpy.sum(edges2 * qvecs, axis=-1) * inverse_dets
+        ts[~((us >= 0) & (vs >= 0) & (us + vs <= 1) & numpy.isfinite(ts))] = numpy.nan
+    return ts
 
 def get_position_from_plane_and_distance(width_ray, height_ray, distance):
     """
@@ -122,6 +209,61 @@ def get_projection_of_ray_onto_ray(ray1, ray2):
     result = numpy.dot(ray1[1] - ray1[0], ray2[1] - ray2[0]) / get_distance(*ray2)
     return result
 
+RAY_EPSILON = 1e-6
+
+def get_ray_epsilons(points):
+    """Returns distances to move points off the surface they lie on before
+    tracing rays from them, scaled with the size of the coordinates
+
+    >>> get_ray_epsilons(numpy.array([[0., .5, 0], [-2000, 0, 0]])).tolist()
+    [1e-06, 0.002]
+    """
+    return RAY_EPSILON * numpy.maximum(1.0, numpy.abs(points).max(axis=-1))
+
+def get_facing_normals(unit_normals, directions):
+    """Returns (N, 3) unit_normals, each flipped if needed to face back
+    along the ray direction that hit its surface
+
+    >>> get_facing_normals(numpy.array([[0.,1,0], [0,1,0]]), numpy.array([[0.,-1,1], [0,2,0]])).tolist()
+    [[0.0, 1.0, 0.0], [-0.0, -1.0, -0.0]]
+    """
+    facing_away = numpy.sum(unit_normals * directions, axis=-1) > 0
+    return numpy.where(facing_away[..., numpy.newaxis], -unit_normals, unit_normals)
+
+def get_bounced_rays(points, directions, unit_normals):
+    """Returns origins and directions of rays along directions reflected
+    across unit_normals at points
+
+    The direction is worked out as the difference of two points, like the
+    scalar Solid.get_bounced_ray, so that batched and scalar renders bounce
+    rays exactly the same way.
+
+    >>> origins, directions = get_bounced_rays(numpy.array([[0.,0,1]]), numpy.array([[0.,-1,-1]]),
+    ...         numpy.array([[0.,0,1]]))
+    >>> directions.round(9).tolist()
+    [[0.0, -0.707106781, 0.707106781]]
+    """
+    unit_ray_vecs = get_unit_vectors(directions)
+    dots = numpy.sum(unit_ray_vecs * unit_normals, axis=1)[:, numpy.newaxis]
+    bounce_vecs = unit_ray_vecs - 2 * unit_normals * dots
+    return points, (points + bounce_vecs) - points
+
+def get_squared_lengths(vectors):
+    """Returns the squared lengths of vectors along their last axis
+
+    >>> get_squared_lengths(numpy.array([[1.,2,2], [0,0,-3]])).tolist()
+    [9.0, 9.0]
+    """
+    return vectors[..., 0]**2 + vectors[..., 1]**2 + vectors[..., 2]**2
+
+def get_unit_vectors(vectors):
+    """Returns (N, 3) vectors scaled to length one
+
+    >>> get_unit_vectors(numpy.array([[0.,3,0], [0,0,-2]])).tolist()
+    [[0.0, 1.0, 0.0], [0.0, 0.0, -1.0]]
+    """
+    return vectors / numpy.sqrt(numpy.sum(vectors * vectors, axis=-1))[..., numpy.newaxis]
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod(optionflags=doctest.ELLIPSIS)
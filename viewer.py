@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+"""An interactive ASCII viewer for checking scene layouts in a terminal
+
+    python viewer.py scene.json --width 120 --height 45
+
+w/s move the camera forward and back, a/d left and right, r/f up and
+down; j/l or the left and right arrow keys turn it, i/k or the up and down
+arrows tilt it, and q quits.
+
+Each view is rendered coarse to fine, every steps[0]th pixel first, and
+drawn after every chunk of pixels, so the first frame after a key press
+appears within a few tens of milliseconds. Chunks are sized so each takes
+about CHUNK_SECONDS, and the keyboard is checked between them: a key
+press abandons whatever of the current view is still to be rendered and
+starts on the new one. The pixels of the last few views are kept, so
+moving back to a view shows it straight away and carries on refining it
+where it was left.
+"""
+import argparse
+import collections
+import contextlib
+import os
+import select
+import sys
+import time
+import numpy
+import raycast
+import scene
+
+STEPS = (4, 2, 1)
+CHUNK_SECONDS = .05 # rendering between checks of the keyboard
+MIN_CHUNK_PIXELS = 16
+MOVE_STEP = .5 # distance moved by each key press
+TURN_DEGREES = 10. # angle turned or tilted by each key press
+CACHED_VIEWS = 16
+
+MOVES = {
+        'w': ('move', 'forward', 1), 's': ('move', 'forward', -1),
+        'd': ('move', 'right', 1), 'a': ('move', 'right', -1),
+        'r': ('move', 'up', 1), 'f': ('move', 'up', -1),
+        'l': ('turn', 'yaw', 1), 'j': ('turn', 'yaw', -1),
+        'i': ('turn', 'pitch', 1), 'k': ('turn', 'pitch', -1),
+        }
+ARROWS = {'\x1b[A': 'i', '\x1b[B': 'k', '\x1b[C': 'l', '\x1b[D': 'j'}
+HELP = 'wasd move, r/f up/down, arrows or ijkl turn, q quits'
+
+def get_rotated(vector, axis, angle):
+    """Returns vector rotated by angle radians about the unit vector axis
+
+    >>> get_rotated(numpy.array([1., 0, 0]), numpy.array([0., 1, 0]), numpy.pi / 2).round(9).tolist()
+    [0.0, 0.0, -1.0]
+    """
+    cos, sin = numpy.cos(angle), numpy.sin(angle)
+    return vector * cos + numpy.cross(axis, vector) * sin + axis * numpy.dot(axis, vector) * (1 - cos)
+
+def get_moved_view(view, key, step=MOVE_STEP, degrees=TURN_DEGREES):
+    """Returns view moved or turned as key asks, see MOVES
+
+    Moving forward and right follow the view; moving up and turning left
+    and right go about the world's y axis, so the horizon stays level.
+
+    >>> v = raycast.View.from_camera((0, 0, -5), (0, 0, 0))
+    >>> get_moved_view(v, 'w', 2).camera_position.tolist()
+    [0.0, 0.0, -3.0]
+    >>> turned = v
+    >>> for i in range(9):
+    ...     turned = get_moved_view(turned, 'l')
+    >>> (turned.camera_position.round(9) + 0).tolist(), (turned.unit_w_vec.round(9) + 0).tolist()
+    ([0.0, 0.0, -5.0], [0.0, 0.0, -1.0])
+    """
+    kind, direction, sign = MOVES[key]
+    position = view.camera_position
+    center = view.screen_width_ray[0]
+    forward = (center - position) / numpy.linalg.norm(center - position)
+    right, up = view.unit_w_vec, view.unit_h_vec
+    if kind == 'move':
+        vector = {'forward': forward, 'right': right, 'up': numpy.array([0., 1, 0])}[direction]
+        offset = vector * step * sign
+        return raycast.View(tuple(map(tuple, view.screen_width_ray + offset)),
+                tuple(map(tuple, view.screen_height_ray + offset)), view.camera_distance)
+    axis = numpy.array([0., 1, 0]) if direction == 'yaw' else right
+    angle = numpy.radians(degrees) * sign * (1 if direction == 'yaw' else -1)
+    forward, right, up = [get_rotated(vector, axis, angle) for vector in (forward, right, up)]
+    center = position + forward * numpy.linalg.norm(view.screen_width_ray[0] - position)
+    return raycast.View((tuple(center), tuple(center + right)), (tuple(center), tuple(center + up)),
+            view.camera_distance)
+
+def get_view_key(view):
+    """Returns a hashable key the same for views a few key presses apart
+    that come back to the same place"""
+    return tuple(numpy.concatenate([view.screen_width_ray.flatten(), view.screen_height_ray.flatten(),
+            [view.camera_distance]]).round(6).tolist())
+
+class Frame(object):
+    """The pixels of one view rendered so far, first row at the top"""
+    def __init__(self, view, h_samples, w_samples, steps=STEPS):
+        self.view = view
+        self.values = numpy.zeros((h_samples, w_samples), dtype=raycast.FRAMEBUFFER_DTYPE)
+        self.done = numpy.zeros((h_samples, w_samples), dtype=bool)
+        self.steps = list(steps)
+        self.finished_step = None
+
+    def get_todo(self):
+        """Returns the rows and columns of the pixels of the current pass
+        not rendered yet, top row first"""
+        rows, cols = numpy.mgrid[0:self.done.shape[0], 0:self.done.shape[1]]
+        step = self.steps[0]
+        return numpy.nonzero((rows % step == 0) & (cols % step == 0) & ~self.done)
+
+    def get_preview(self):
+        step = self.finished_step if self.finished_step is not None else self.steps[0]
+        return raycast.get_preview(self.values, self.done, step)
+
+    def get_fraction_done(self):
+        return self.done.mean()
+
+class Viewer(object):
+    """Renders a world's views a chunk at a time as the camera moves about
+
+    >>> w = raycast.World()
+    >>> w.add_object(raycast.Sphere((0,0,0), 1))
+    >>> w.add_object(raycast.Checkerboard(((0,-2,0), (0,-2,5)), ((0,-2,0), (5,-2,0))))
+    >>> w.add_light(raycast.Light((10, 10, -10)))
+    >>> viewer = Viewer(w, raycast.View.from_camera((0, 0, -5), (0, 0, 0)), 24, 12, 6, 6)
+    >>> chunks = 0
+    >>> while viewer.refine():
+    ...     chunks += 1
+    >>> full = w.render_view_values(viewer.frame.view, 24, 12, 6, 6, batch=True)
+    >>> chunks > 0, viewer.frame.get_fraction_done(), (viewer.get_values() == full).all()
+    (True, 1.0, True)
+    >>> viewer.move('w')
+    >>> viewer.refine(), viewer.frame.get_fraction_done() < 1
+    (True, True)
+    >>> viewer.move('s')
+    >>> viewer.refine(), viewer.frame.get_fraction_done()
+    (False, 1.0)
+    """
+    def __init__(self, world, view, w_samples, h_samples, viewscreen_width, viewscreen_height,
+            settings=None, steps=STEPS, cached_views=CACHED_VIEWS):
+        self.world = world
+        self.w_samples = w_samples
+        self.h_samples = h_samples
+        self.viewscreen_width = viewscreen_width
+        self.viewscreen_height = viewscreen_height
+        self.settings = settings
+        self.steps = steps
+        self.cached_views = cached_views
+        self.frames = collections.OrderedDict() # view key: Frame, most recently shown last
+        self.chunk_pixels = MIN_CHUNK_PIXELS
+        world.get_bvh()
+        world.get_light_index()
+        self.set_view(view)
+
+    def set_view(self, view):
+        """Shows view, carrying on from where its pixels were left if it
+        was shown before"""
+        key = get_view_key(view)
+        self.frame = self.frames.pop(key, None) or Frame(view, self.h_samples, self.w_samples, self.steps)
+        self.frames[key] = self.frame
+        while len(self.frames) > self.cached_views:
+            self.frames.popitem(last=False)
+
+    def move(self, key, step=MOVE_STEP, degrees=TURN_DEGREES):
+        self.set_view(get_moved_view(self.frame.view, key, step, degrees))
+
+    def refine(self):
+        """Renders the next chunk of pixels of the current view, returning
+        False if it's already finished"""
+        frame = self.frame
+        if not frame.steps:
+            return False
+        rows, cols = frame.get_todo()
+        rows, cols = rows[:self.chunk_pixels], cols[:self.chunk_pixels]
+        start = time.time()
+        frame.values[rows, cols] = self.world.render_pixels(frame.view, self.w_samples, self.h_samples,
+                self.viewscreen_width, self.viewscreen_height, cols, self.h_samples - 1 - rows, True,
+                self.settings)
+        frame.done[rows, cols] = True
+        if len(rows) == self.chunk_pixels:
+            seconds_per_pixel = (time.time() - start) / len(rows)
+            self.chunk_pixels = max(MIN_CHUNK_PIXELS, int(CHUNK_SECONDS / max(seconds_per_pixel, 1e-9)))
+        if not len(frame.get_todo()[0]):
+            frame.finished_step = frame.steps.pop(0)
+        return True
+
+    def get_values(self):
+        """Returns the current view's values, pixels not rendered yet
+        filled in from the coarser pass before"""
+        return self.frame.get_preview()
+
+    def get_status(self):
+        position = ', '.join('%.1f' % x for x in self.frame.view.camera_position)
+        return 'camera (%s) %3d%% done | %s' % (position, 100 * self.frame.get_fraction_done(), HELP)
+
+@contextlib.contextmanager
+def cbreak(f):
+    """Reads f a key at a time without echo inside a with block, if it's a
+    terminal"""
+    if not f.isatty():
+        yield
+        return
+    import termios
+    import tty
+    attributes = termios.tcgetattr(f)
+    tty.setcbreak(f.fileno())
+    try:
+        yield
+    finally:
+        termios.tcsetattr(f, termios.TCSADRAIN, attributes)
+
+def read_key(f, timeout=None):
+    """Returns the next key pressed, an arrow key's escape sequence
+    translated to the letter for it, or None if none is pressed within
+    timeout seconds; '' at the end of input"""
+    if not select.select([f], [], [], timeout)[0]:
+        return None
+    key = os.read(f.fileno(), 1)
+    if key == '\x1b':
+        while len(key) < 3 and select.select([f], [], [], .01)[0]:
+            key += os.read(f.fileno(), 1)
+        return ARROWS.get(key)
+    return key
+
+def get_terminal_size(f):
+    """Returns the columns and lines of the terminal f is, 80 by 24 if it isn't one"""
+    try:
+        import fcntl
+        import struct
+        import termios
+        lines, columns = struct.unpack('hh', fcntl.ioctl(f.fileno(), termios.TIOCGWINSZ, '1234'))
+    except (ImportError, IOError):
+        return 80, 24
+    return columns, lines
+
+def run(viewer, stdin=sys.stdin, stdout=sys.stdout, gamma=1.):
+    """Shows viewer's views in the terminal, moving as keys are pressed on
+    stdin, until q is pressed or input ends"""
+    stdout.write('\x1b[2J\x1b[?25l') # clear the screen, hide the cursor
+    try:
+        with cbreak(stdin):
+            drawn = None
+            while True:
+                refining = viewer.refine()
+                if refining or viewer.frame is not drawn:
+                    drawn = viewer.frame
+                    stdout.write('\x1b[H'+raycast.get_ascii_text(viewer.get_values(), gamma)+
+                            viewer.get_status()[:viewer.w_samples]+'\x1b[K')
+                    stdout.flush()
+                key = read_key(stdin, 0 if refining else None)
+                if key in ('q', ''):
+                    break
+                if key in MOVES:
+                    viewer.move(key)
+    finally:
+        stdout.write('\x1b[?25h\n')
+        stdout.flush()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('scene', nargs='?', help='.json or .npz scene file, by default the demo scene')
+    parser.add_argument('--view', type=int, default=0, help="which of the scene's views to start from")
+    parser.add_argument('--width', type=int, default=None, help='characters across, by default the terminal width')
+    parser.add_argument('--height', type=int, default=None, help='lines, by default the terminal height less one')
+    parser.add_argument('--viewscreen', type=float, nargs=2, default=(7., 7.), metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--gamma', type=float, default=1.)
+    args = parser.parse_args(argv)
+
+    if args.scene is None:
+        import demo
+        world = demo.get_world()
+    else:
+        world = scene.load(args.scene)
+    if not world.views:
+        parser.error('The scene has no views to start from')
+    columns, lines = get_terminal_size(sys.stdout)
+    viewer = Viewer(world, world.views[args.view], args.width or columns, args.height or lines - 1,
+            args.viewscreen[0], args.viewscreen[1], world.settings)
+    run(viewer, gamma=args.gamma)
+
+if __name__ == '__main__':
+    main()